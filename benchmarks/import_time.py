@@ -0,0 +1,77 @@
+"""
+Measure how long each module of the integration takes to import and check which ones load the BLE backend.
+
+Every module is imported in a fresh interpreter. Modules that Home Assistant loads to set up the integration
+or to render the config flow must not import bleak, only ble_control does. Modules whose dependencies are
+not installed are reported as skipped.
+
+    python benchmarks/import_time.py [--repeat 5] [--json results.json]
+"""
+
+import sys
+import json
+import argparse
+import subprocess
+from statistics import median
+
+BACKEND_MODULES = ["bleak"]
+LIGHT_MODULES = ["const", "config_flow", "desk_control", "scanner", "adapter_scheduler", "desk_group",
+                 "cover", "sensor", "switch", "button", "diagnostics"]
+BACKEND_MODULE = "ble_control"
+
+PROBE = """
+import sys, time, json
+sys.path.insert(0, {path!r})
+from integration import load
+started = time.perf_counter()
+try:
+    load({module!r})
+except ImportError as e:
+    print(json.dumps({{"skipped": str(e)}}))
+else:
+    print(json.dumps({{"seconds": time.perf_counter() - started,
+                      "backend": [name for name in {backend!r} if name in sys.modules]}}))
+"""
+
+
+def probe(module):
+    code = PROBE.format(path=sys.path[0], module=module, backend=BACKEND_MODULES)
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure(module, repeat):
+    results = [probe(module) for _ in range(repeat)]
+    if "skipped" in results[0]:
+        return results[0]
+    return {"seconds": median(result["seconds"] for result in results), "backend": results[0]["backend"]}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    failed = []
+    print(f"{'module':20} {'import ms':>10}  backend")
+    for module in LIGHT_MODULES + [BACKEND_MODULE]:
+        result = results[module] = measure(module, args.repeat)
+        if "skipped" in result:
+            print(f"{module:20} {'skipped':>10}  {result['skipped']}")
+            continue
+        print(f"{module:20} {result['seconds'] * 1000:10.1f}  {', '.join(result['backend']) or '-'}")
+        if module != BACKEND_MODULE and result["backend"]:
+            failed.append(module)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if failed:
+        print(f"Modules loading the BLE backend: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
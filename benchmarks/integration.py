@@ -0,0 +1,21 @@
+"""
+Import helper for running integration modules outside of Home Assistant
+"""
+
+import sys
+import types
+import importlib
+import os
+
+INTEGRATION_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                "custom_components", "idasen-desk-controller")
+PACKAGE = "idasen_desk_controller"
+
+
+def load(module):
+    """Import a module of the integration without running its __init__, which needs Home Assistant"""
+    if PACKAGE not in sys.modules:
+        package = types.ModuleType(PACKAGE)
+        package.__path__ = [INTEGRATION_PATH]
+        sys.modules[PACKAGE] = package
+    return importlib.import_module(f"{PACKAGE}.{module}")
@@ -0,0 +1,58 @@
+"""
+Replay a recorded height trace through BLEController and compare its commands with the recorded ones.
+
+    python benchmarks/replay_trace.py trace.bin [--speed 10]
+"""
+
+import sys
+import asyncio
+import argparse
+from integration import load
+
+ble_control = load("ble_control")
+trace_recorder = load("trace_recorder")
+
+COMMAND_NAMES = {
+    bytes(ble_control.COMMAND_UP): "up",
+    bytes(ble_control.COMMAND_DOWN): "down",
+    bytes(ble_control.COMMAND_STOP): "stop",
+    bytes(ble_control.COMMAND_WAKEUP): "wakeup",
+}
+
+
+def describe(data):
+    return COMMAND_NAMES.get(bytes(data), data.hex())
+
+
+def recorded_commands(path):
+    first = None
+    commands = []
+    for kind, timestamp, data in trace_recorder.TraceReader(path):
+        first = timestamp if first is None else first
+        if kind == trace_recorder.KIND_COMMAND:
+            commands.append(((timestamp - first) / 1e9, describe(data)))
+    return commands
+
+
+async def replay(path, speed):
+    controller = ble_control.BLEController(height_speed_callback=lambda height, speed: None,
+                                           connection_change_callback=lambda: None)
+    writes = await trace_recorder.replay(path, controller, speed=speed)
+    return [(timestamp, describe(data)) for timestamp, uuid, data in writes if uuid == ble_control.UUID_COMMAND]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trace")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 1 is real time")
+    args = parser.parse_args()
+
+    recorded = recorded_commands(args.trace)
+    replayed = asyncio.run(replay(args.trace, args.speed))
+    print("recorded: " + ", ".join(f"{name}@{timestamp:.2f}s" for timestamp, name in recorded))
+    print("replayed: " + ", ".join(f"{name}@{timestamp:.2f}s" for timestamp, name in replayed))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
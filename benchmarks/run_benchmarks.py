@@ -0,0 +1,537 @@
+"""
+Benchmarks for BLEController against the simulated desk.
+
+Reports time-to-target, overshoot, final error and GATT writes per move, connect and reconnect latency,
+get_current_state latency and the longest time the event loop was blocked.
+With --group N it also moves a group of N desks together and reports the group move latency for
+different limits of concurrent moves per adapter.
+With --presets N it alternates N times between the sit and stand presets and compares the final error
+and GATT writes with percentage moves to the same heights.
+With --on-demand N it moves an on-demand desk N times with idle gaps and reports the connect-on-demand
+latency and the share of time the desk held an adapter slot.
+With --drag N it sends N targets 0.1s apart, like a dragged slider, and reports the final error, the GATT
+writes and the command queue statistics.
+With --stall it mutes the notifications of the desk and reports how the polling fallback moves it.
+With --motion it moves a DeskController and compares the height it publishes, extrapolated by the motion
+model, with the last notified height, both measured against the height of the desk at publish time.
+With --decode N it decodes N notifications and reports the cost per notification of the previous decoding,
+of the raw decoder and of the whole notification path through DeskController.
+
+    python benchmarks/run_benchmarks.py [--mode reference|pulse|both] [--group N] [--presets N] [--on-demand N]
+                                        [--drag N] [--stall] [--motion]
+                                        [--decode N] [--json results.json]
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import struct
+import argparse
+import tempfile
+from statistics import mean
+from integration import load
+from simulated_desk import SimulatedDesk, SimulatedRadio
+
+ble_control = load("ble_control")
+device_cache = load("device_cache")
+adapter_scheduler = load("adapter_scheduler")
+scanner = load("scanner")
+desk_control = load("desk_control")
+desk_group = load("desk_group")
+height_decoder = load("height_decoder")
+const = load("const")
+
+ADAPTER = "sim0"
+MOVE_TARGETS = [1000, 760, 1150, 900, 1010, 700]
+STATE_READS = 20
+GROUP_TARGETS = [70, 20, 50]
+
+
+class LoopMonitor:
+    """Measures the longest delay of a short sleep, which is how long the event loop was blocked"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.max_lag = 0
+        self._task = None
+
+    def __enter__(self):
+        self.max_lag = 0
+        self._task = asyncio.get_event_loop().create_task(self._run())
+        return self
+
+    def __exit__(self, *args):
+        self._task.cancel()
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.max_lag = max(self.max_lag, time.monotonic() - started - self.interval)
+
+
+def create_controller(desk, cache_path):
+    return ble_control.BLEController(
+        address=desk.address,
+        height_speed_callback=lambda height, speed: None,
+        connection_change_callback=lambda: None,
+        device_cache=device_cache.get_device_cache(cache_path),
+        scheduler=adapter_scheduler.AdapterScheduler([ADAPTER], rssi_lookup=lambda adapter, address: desk.rssi),
+        client_factory=desk.client)
+
+
+async def wait_until(predicate, timeout=60):
+    started = time.monotonic()
+    while not predicate():
+        if time.monotonic() - started > timeout:
+            return None
+        await asyncio.sleep(0.01)
+    return time.monotonic() - started
+
+
+async def bench_connect(desk, cache_path):
+    results = {}
+    with LoopMonitor() as monitor:
+        controller = create_controller(desk, cache_path)
+        started = time.monotonic()
+        await controller.start_monitoring()
+        results["cold_connect_s"] = time.monotonic() - started
+        results["cold_connect_source"] = controller.last_connect_source
+        await controller.disconnect()
+
+        controller = create_controller(desk, cache_path)
+        started = time.monotonic()
+        await controller.start_monitoring()
+        results["cached_connect_s"] = time.monotonic() - started
+        results["cached_connect_source"] = controller.last_connect_source
+        results["cache_saved_s"] = results["cold_connect_s"] - results["cached_connect_s"]
+
+        desk.drop_connections()
+        results["reconnect_s"] = await wait_until(lambda: controller.is_connected)
+        results["loop_blocked_max_ms"] = monitor.max_lag * 1000
+    return controller, results
+
+
+async def bench_state(controller, desk):
+    durations = []
+    with LoopMonitor() as monitor:
+        for _ in range(STATE_READS):
+            started = time.monotonic()
+            await controller.get_current_state()
+            durations.append(time.monotonic() - started)
+    return {
+        "get_current_state_ms": mean(durations) * 1000,
+        "loop_blocked_max_ms": monitor.max_lag * 1000,
+    }
+
+
+async def bench_moves(controller, desk, targets):
+    moves = []
+    with LoopMonitor() as monitor:
+        for target in targets:
+            start_height = desk.height
+            desk.reset_stats()
+            result = await controller.move_to_position(target)
+            target_raw = controller._mm_to_raw(target)
+            direction = 1 if target_raw > start_height else -1
+            overshoot = max([direction * (height - target_raw) for _, height in desk.trajectory] + [0]) / 10
+            moves.append({
+                "target_mm": target,
+                "reason": result.reason,
+                "time_to_target_s": result.duration,
+                "error_mm": (desk.height - target_raw) / 10,
+                "overshoot_mm": overshoot,
+                "gatt_writes": desk.writes,
+                "notifications": desk.notifications,
+            })
+    return {
+        "moves": moves,
+        "time_to_target_s": mean(move["time_to_target_s"] for move in moves),
+        "abs_error_mm": mean(abs(move["error_mm"]) for move in moves),
+        "overshoot_mm": mean(move["overshoot_mm"] for move in moves),
+        "gatt_writes_per_move": mean(move["gatt_writes"] for move in moves),
+        "loop_blocked_max_ms": monitor.max_lag * 1000,
+    }
+
+
+async def run(mode, targets):
+    radio = SimulatedRadio()
+    scanner.replace_scanner(ADAPTER, radio.scanner)
+    desk = SimulatedDesk(supports_reference_input=(mode == "reference"))
+    radio.desks.append(desk)
+    with tempfile.TemporaryDirectory() as directory:
+        cache_path = os.path.join(directory, "cache.json")
+        controller, connect = await bench_connect(desk, cache_path)
+        state = await bench_state(controller, desk)
+        moves = await bench_moves(controller, desk, targets)
+        await controller.disconnect()
+    return {"connect": connect, "state": state, "move": moves}
+
+
+async def bench_group(size, max_moves_per_adapter, cache_path):
+    radio = SimulatedRadio()
+    scanner.replace_scanner(ADAPTER, radio.scanner)
+    desks = [SimulatedDesk(address=f"F4:E5:29:00:01:{index:02X}", name=f"Desk {index:04d}",
+                           height=1000 + 400 * index) for index in range(size)]
+    radio.desks.extend(desks)
+    cache = device_cache.DeviceCache(cache_path)
+    scheduler = adapter_scheduler.AdapterScheduler([ADAPTER], max_connections=size,
+                                                   rssi_lookup=lambda adapter, address: -60)
+    fleet = desk_group.DeskFleet(max_moves_per_adapter=max_moves_per_adapter)
+    controllers = []
+    for index, desk in enumerate(desks):
+        controller = desk_control.DeskController(desk.name, desk.address, device_cache=cache,
+                                                 scheduler=scheduler, client_factory=desk.client,
+                                                 history_path=f"{cache_path}.{index}.history")
+        await controller.start_monitoring()
+        fleet.add(controller)
+        controllers.append(controller)
+
+    group = fleet.groups[desk_group.GROUP_ALL]
+    moves = []
+    with LoopMonitor() as monitor:
+        for target in GROUP_TARGETS:
+            result = await group.move_to_position(target)
+            moves.append({
+                "target_percent": target,
+                "duration_s": result.duration,
+                "slowest_desk_s": max(move.duration for move in result.results.values()),
+                "max_error_mm": result.max_error,
+                "reached": result.reached,
+            })
+    for controller in controllers:
+        await controller.disconnect()
+    return {
+        "desks": size,
+        "max_moves_per_adapter": max_moves_per_adapter,
+        "moves": moves,
+        "duration_s": mean(move["duration_s"] for move in moves),
+        "loop_blocked_max_ms": monitor.max_lag * 1000,
+    }
+
+
+async def run_group(size):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for limit in sorted({1, desk_group.GROUP_MAX_MOVES_PER_ADAPTER, size}):
+            results.append(await bench_group(size, limit, os.path.join(directory, f"cache{limit}.json")))
+    return results
+
+
+async def bench_presets(mode, rounds, cache_path):
+    radio = SimulatedRadio()
+    scanner.replace_scanner(ADAPTER, radio.scanner)
+    desk = SimulatedDesk(supports_reference_input=(mode == "reference"))
+    radio.desks.append(desk)
+    controller = desk_control.DeskController(
+        desk.name, desk.address, device_cache=device_cache.DeviceCache(cache_path),
+        scheduler=adapter_scheduler.AdapterScheduler([ADAPTER], rssi_lookup=lambda adapter, address: desk.rssi),
+        client_factory=desk.client, history_path=f"{cache_path}.history")
+    await controller.start_monitoring()
+
+    async def move(preset_name, use_preset):
+        preset = controller.presets.get(preset_name)
+        desk.reset_stats()
+        if use_preset:
+            await controller.move_to_preset(preset_name)
+        else:
+            await controller.move_to_position(controller.calibration.mm_to_percentage(preset.height))
+        return {"error_mm": abs(desk.height - preset.raw_height) / 10, "gatt_writes": desk.writes}
+
+    results = {}
+    for use_preset in (False, True):
+        moves = []
+        for _ in range(rounds):
+            for preset_name in (const.PRESET_STAND, const.PRESET_SIT):
+                moves.append(await move(preset_name, use_preset))
+        results["preset" if use_preset else "percentage"] = {
+            "abs_error_mm": mean(entry["error_mm"] for entry in moves),
+            "last_abs_error_mm": mean(entry["error_mm"] for entry in moves[-2:]),
+            "gatt_writes_per_move": mean(entry["gatt_writes"] for entry in moves),
+        }
+    await controller.disconnect()
+    return results
+
+
+async def bench_on_demand(moves, cache_path, idle_timeout=0.5, idle_gap=1.0):
+    radio = SimulatedRadio()
+    scanner.replace_scanner(ADAPTER, radio.scanner)
+    desk = SimulatedDesk()
+    radio.desks.append(desk)
+    scheduler = adapter_scheduler.AdapterScheduler([ADAPTER], rssi_lookup=lambda adapter, address: desk.rssi)
+    controller = desk_control.DeskController(
+        desk.name, desk.address, device_cache=device_cache.DeviceCache(cache_path), scheduler=scheduler,
+        client_factory=desk.client, connection_mode=const.CONNECTION_MODE_ON_DEMAND, idle_timeout=idle_timeout,
+        history_path=f"{cache_path}.history")
+    await controller.start_monitoring()
+    with LoopMonitor() as monitor:
+        for target in MOVE_TARGETS[:moves]:
+            await asyncio.sleep(idle_gap)
+            slots = scheduler.connections(ADAPTER)
+            await controller.move_to_position(controller.calibration.mm_to_percentage(target))
+    connection = controller.connection.diagnostics()
+    connects = controller.instrumentation.histograms["connect_on_demand"]
+    await controller.disconnect()
+    return {
+        "connect_on_demand_s": connects.total / connects.count,
+        "connect_on_demand_max_s": connects.max,
+        "idle_disconnects": connection["idle_disconnects"],
+        "slots_before_last_move": slots,
+        "slot_usage": connection["slot_usage"],
+        "loop_blocked_max_ms": monitor.max_lag * 1000,
+    }
+
+
+async def bench_drag(mode, steps, cache_path, interval=0.1):
+    radio = SimulatedRadio()
+    scanner.replace_scanner(ADAPTER, radio.scanner)
+    desk = SimulatedDesk(height=500, supports_reference_input=(mode == "reference"))
+    radio.desks.append(desk)
+    controller = create_controller(desk, cache_path)
+    await controller.start_monitoring()
+    desk.reset_stats()
+    targets = [800 + 300 * step // steps for step in range(1, steps + 1)]
+    started = time.monotonic()
+    with LoopMonitor() as monitor:
+        moves = []
+        for target in targets:
+            moves.append(asyncio.create_task(controller.move_to_position(target)))
+            await asyncio.sleep(interval)
+        results = await asyncio.gather(*moves)
+    duration = time.monotonic() - started
+    queue = controller.diagnostics()["command_queue"]
+    await controller.disconnect()
+    return {
+        "duration_s": duration,
+        "final_error_mm": (desk.height - controller._mm_to_raw(targets[-1])) / 10,
+        "superseded": sum(1 for result in results if result.reason == const.STOP_REASON_SUPERSEDED),
+        "gatt_writes": desk.writes,
+        "command_queue": queue,
+        "loop_blocked_max_ms": monitor.max_lag * 1000,
+    }
+
+
+async def bench_stall(mode, targets, cache_path):
+    radio = SimulatedRadio()
+    scanner.replace_scanner(ADAPTER, radio.scanner)
+    desk = SimulatedDesk(supports_reference_input=(mode == "reference"))
+    radio.desks.append(desk)
+    controller = create_controller(desk, cache_path)
+    await controller.start_monitoring()
+    desk.notifications_muted = True
+    moves = await bench_moves(controller, desk, targets)
+    notifications = controller.diagnostics()["notifications"]
+    await controller.disconnect()
+    return {"move": moves, "notifications": notifications}
+
+
+async def bench_motion(mode, targets, cache_path):
+    radio = SimulatedRadio()
+    scanner.replace_scanner(ADAPTER, radio.scanner)
+    desk = SimulatedDesk(supports_reference_input=(mode == "reference"))
+    radio.desks.append(desk)
+    controller = desk_control.DeskController(
+        desk.name, desk.address, device_cache=device_cache.DeviceCache(cache_path),
+        scheduler=adapter_scheduler.AdapterScheduler([ADAPTER], rssi_lookup=lambda adapter, address: desk.rssi),
+        client_factory=desk.client, history_path=f"{cache_path}.history")
+    await controller.start_monitoring()
+    predicted_errors = []
+    sample_errors = []
+
+    def published():
+        if controller.motion.is_moving:
+            predicted_errors.append(abs(controller.motion.predict() - desk.height) / 10)
+            sample_errors.append(abs(controller.motion.height_raw - desk.height) / 10)
+
+    controller.register_callback(published)
+    received = controller.updates_received
+    publishes = controller.updates_published
+    for target in targets:
+        await controller.move_to_position(controller.calibration.mm_to_percentage(target))
+    results = {
+        "notifications": controller.updates_received - received,
+        "publishes": controller.updates_published - publishes,
+        "predicted_abs_error_mm": mean(predicted_errors) if predicted_errors else None,
+        "predicted_max_error_mm": max(predicted_errors, default=None),
+        "sample_abs_error_mm": mean(sample_errors) if sample_errors else None,
+        "sample_max_error_mm": max(sample_errors, default=None),
+    }
+    await controller.disconnect()
+    return results
+
+
+def _raw_to_mm(raw):
+    return (raw / 10) + const.MIN_HEIGHT
+
+
+def _raw_to_speed(raw):
+    return (raw / 100)
+
+
+def _format_height_speed(height, speed):
+    return int(_raw_to_mm(height)), int(_raw_to_speed(speed))
+
+
+def decode_previous(data):
+    """The float conversion every notification ran before the raw decoder, copied as the baseline"""
+    height_raw, speed_raw = struct.unpack("<Hh", data)
+    return _format_height_speed(height_raw, speed_raw)
+
+
+async def bench_decode(count, cache_path):
+    notifications = [struct.pack("<Hh", 1000 + index % 5000, 3000 - index % 6000) for index in range(1000)]
+    results = {}
+
+    def per_notification(decode):
+        started = time.perf_counter()
+        for index in range(count):
+            decode(notifications[index % len(notifications)])
+        return (time.perf_counter() - started) / count * 1e9
+
+    results["previous_ns"] = per_notification(decode_previous)
+    results["raw_ns"] = per_notification(height_decoder.decode_height_speed)
+
+    desk = SimulatedDesk()
+    controller = desk_control.DeskController(
+        desk.name, desk.address, device_cache=device_cache.DeviceCache(cache_path),
+        scheduler=adapter_scheduler.AdapterScheduler([ADAPTER], rssi_lookup=lambda adapter, address: desk.rssi),
+        client_factory=desk.client, history_path=f"{cache_path}.history")
+    ble = controller._ble_controller
+    results["notification_ns"] = per_notification(lambda data: ble._height_data_callback(None, data))
+    await controller.disconnect()
+    return results
+
+
+def print_results(mode, results):
+    print(f"== {mode}")
+    connect = results["connect"]
+    print(f"connect cold {connect['cold_connect_s']:.2f}s ({connect['cold_connect_source']}), "
+          f"cached {connect['cached_connect_s']:.2f}s ({connect['cached_connect_source']}, "
+          f"{connect['cache_saved_s']:.2f}s saved), "
+          f"reconnect {connect['reconnect_s']:.2f}s, loop blocked max {connect['loop_blocked_max_ms']:.1f}ms")
+    state = results["state"]
+    print(f"get_current_state {state['get_current_state_ms']:.1f}ms, "
+          f"loop blocked max {state['loop_blocked_max_ms']:.1f}ms")
+    move = results["move"]
+    for entry in move["moves"]:
+        print(f"  move to {entry['target_mm']:4d}mm: {entry['time_to_target_s']:5.2f}s "
+              f"error {entry['error_mm']:+5.1f}mm overshoot {entry['overshoot_mm']:4.1f}mm "
+              f"writes {entry['gatt_writes']:3d} ({entry['reason']})")
+    print(f"move mean: {move['time_to_target_s']:.2f}s, |error| {move['abs_error_mm']:.1f}mm, "
+          f"overshoot {move['overshoot_mm']:.1f}mm, {move['gatt_writes_per_move']:.1f} writes, "
+          f"loop blocked max {move['loop_blocked_max_ms']:.1f}ms")
+
+
+def print_group_results(results):
+    print(f"== group of {results[0]['desks']} desks")
+    for entry in results:
+        moves = ", ".join(f"{move['target_percent']}% {move['duration_s']:.2f}s" for move in entry["moves"])
+        print(f"{entry['max_moves_per_adapter']} moves per adapter: mean {entry['duration_s']:.2f}s ({moves}), "
+              f"loop blocked max {entry['loop_blocked_max_ms']:.1f}ms")
+
+
+def print_preset_results(mode, results):
+    print(f"== presets {mode}")
+    for name, entry in results.items():
+        print(f"{name}: error {entry['abs_error_mm']:.1f}mm (last round {entry['last_abs_error_mm']:.1f}mm), "
+              f"{entry['gatt_writes_per_move']:.1f} GATT writes per move")
+
+
+def print_on_demand_results(results):
+    print("== on demand")
+    print(f"connect {results['connect_on_demand_s']:.2f}s (max {results['connect_on_demand_max_s']:.2f}s), "
+          f"{results['idle_disconnects']} idle disconnects, slot usage {results['slot_usage'] * 100:.0f}%, "
+          f"loop blocked max {results['loop_blocked_max_ms']:.1f}ms")
+
+
+def print_drag_results(mode, results):
+    queue = results["command_queue"]
+    print(f"== drag {mode}")
+    print(f"{results['duration_s']:.2f}s, error {results['final_error_mm']:.1f}mm, {results['superseded']} superseded, "
+          f"{results['gatt_writes']} GATT writes, queue max depth {queue['max_depth']}, "
+          f"{queue['merged']} merged, {queue['dropped']} dropped")
+
+
+def print_stall_results(mode, results):
+    move = results["move"]
+    notifications = results["notifications"]
+    print(f"== notifications muted {mode}")
+    print(f"time to target {move['time_to_target_s']:.2f}s, error {move['abs_error_mm']:.1f}mm, "
+          f"{notifications['stalls']} stalls, {notifications['polls']} polls, "
+          f"stale for {notifications['last_stale_time']:.1f}s before polling")
+
+
+def print_motion_results(mode, results):
+    print(f"== motion model {mode}")
+    print(f"{results['notifications']} notifications, {results['publishes']} publishes, "
+          f"published height error {results['predicted_abs_error_mm']:.1f}mm "
+          f"(max {results['predicted_max_error_mm']:.1f}mm), last notified height error "
+          f"{results['sample_abs_error_mm']:.1f}mm (max {results['sample_max_error_mm']:.1f}mm)")
+
+
+def print_decode_results(results):
+    print("== notification decoding")
+    print(f"previous decode {results['previous_ns']:.0f}ns, raw decode {results['raw_ns']:.0f}ns, "
+          f"whole notification path {results['notification_ns']:.0f}ns")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["reference", "pulse", "both"], default="both")
+    parser.add_argument("--moves", type=int, default=len(MOVE_TARGETS))
+    parser.add_argument("--group", type=int, default=0, help="also move a group of this many desks")
+    parser.add_argument("--presets", type=int, default=0, help="also alternate this many times between presets")
+    parser.add_argument("--on-demand", type=int, default=0, help="also move an on-demand desk this many times")
+    parser.add_argument("--drag", type=int, default=0, help="also send this many targets like a dragged slider")
+    parser.add_argument("--stall", action="store_true", help="also move with muted notifications")
+    parser.add_argument("--motion", action="store_true", help="also compare the motion model with the last sample")
+    parser.add_argument("--decode", type=int, default=0, help="also time this many notification decodes")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    modes = ["reference", "pulse"] if args.mode == "both" else [args.mode]
+    results = {}
+    for mode in modes:
+        results[mode] = asyncio.run(run(mode, MOVE_TARGETS[:args.moves]))
+        print_results(mode, results[mode])
+        if args.presets:
+            with tempfile.TemporaryDirectory() as directory:
+                results[f"presets_{mode}"] = asyncio.run(
+                    bench_presets(mode, args.presets, os.path.join(directory, "cache.json")))
+            print_preset_results(mode, results[f"presets_{mode}"])
+        if args.drag:
+            with tempfile.TemporaryDirectory() as directory:
+                results[f"drag_{mode}"] = asyncio.run(
+                    bench_drag(mode, args.drag, os.path.join(directory, "cache.json")))
+            print_drag_results(mode, results[f"drag_{mode}"])
+        if args.stall:
+            with tempfile.TemporaryDirectory() as directory:
+                results[f"stall_{mode}"] = asyncio.run(
+                    bench_stall(mode, MOVE_TARGETS[:args.moves], os.path.join(directory, "cache.json")))
+            print_stall_results(mode, results[f"stall_{mode}"])
+        if args.motion:
+            with tempfile.TemporaryDirectory() as directory:
+                results[f"motion_{mode}"] = asyncio.run(
+                    bench_motion(mode, MOVE_TARGETS[:args.moves], os.path.join(directory, "cache.json")))
+            print_motion_results(mode, results[f"motion_{mode}"])
+    if args.on_demand:
+        with tempfile.TemporaryDirectory() as directory:
+            results["on_demand"] = asyncio.run(bench_on_demand(args.on_demand, os.path.join(directory, "cache.json")))
+        print_on_demand_results(results["on_demand"])
+    if args.decode:
+        with tempfile.TemporaryDirectory() as directory:
+            results["decode"] = asyncio.run(bench_decode(args.decode, os.path.join(directory, "cache.json")))
+        print_decode_results(results["decode"])
+    if args.group:
+        results["group"] = asyncio.run(run_group(args.group))
+        print_group_results(results["group"])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,300 @@
+"""
+Simulated LINAK desk that stands in for BleakClient and BleakScanner.
+Heights are in raw desk units (0.1mm above the lowest position) and speeds in raw units per second.
+"""
+
+import time
+import struct
+import asyncio
+from integration import load
+
+ble_control = load("ble_control")
+
+MAX_HEIGHT_RAW = 6500
+TICK = 0.01
+COMMAND_DURATION = 1.0
+
+HANDLES = {
+    ble_control.UUID_COMMAND: 0x0e,
+    ble_control.UUID_HEIGHT: 0x1d,
+    ble_control.UUID_REFERENCE_INPUT: 0x28,
+}
+
+
+class SimulatedCharacteristic:
+    def __init__(self, uuid, handle):
+        self.uuid = uuid
+        self.handle = handle
+
+
+class SimulatedServices:
+    """Service collection that is empty until the client ran service discovery"""
+
+    def __init__(self):
+        self.characteristics = {}
+
+    @property
+    def is_resolved(self):
+        return bool(self.characteristics)
+
+    def resolve(self):
+        for uuid, handle in HANDLES.items():
+            self.characteristics[uuid] = SimulatedCharacteristic(uuid, handle)
+
+    def get_characteristic(self, specifier):
+        if isinstance(specifier, int):
+            for characteristic in self.characteristics.values():
+                if characteristic.handle == specifier:
+                    return characteristic
+            return None
+        return self.characteristics.get(specifier)
+
+
+class SimulatedDevice:
+    def __init__(self, desk):
+        self.address = desk.address
+        self.name = desk.name
+        self.rssi = desk.rssi
+        self.details = {"path": f"/org/bluez/sim0/dev_{desk.address.replace(':', '_')}", "props": {}}
+
+
+class SimulatedDesk:
+    """Motor, controller and GATT model of one desk.
+    Movement commands run the motor for COMMAND_DURATION, the reference input is followed while it is refreshed.
+    Notifications are sent at notify_rate while moving and arrive latency seconds after the measurement."""
+
+    def __init__(self, address="F4:E5:29:00:00:01", name="Desk 0001", height=1000,
+                 max_speed=380, acceleration=800, notify_rate=16, latency=0.04, write_latency=0.02,
+                 connect_time=0.3, discovery_time=0.6, rssi=-60, supports_reference_input=True):
+        self.address = address
+        self.name = name
+        self.height = float(height)
+        self.velocity = 0.0
+        self.max_speed = max_speed
+        self.acceleration = acceleration
+        self.notify_rate = notify_rate
+        self.latency = latency
+        self.write_latency = write_latency
+        self.connect_time = connect_time
+        self.discovery_time = discovery_time
+        self.rssi = rssi
+        self.supports_reference_input = supports_reference_input
+        self.connectable = True
+        self.notifications_muted = False
+        self.writes = 0
+        self.reads = 0
+        self.notifications = 0
+        self.trajectory = []
+        self._direction = 0
+        self._reference = None
+        self._command_until = 0
+        self._clients = []
+        self._task = None
+
+    def client(self, address_or_device, device=None):
+        """Factory with the signature of BleakClient"""
+        client = SimulatedClient(self, device)
+        self._clients.append(client)
+        return client
+
+    def reset_stats(self):
+        self.writes = 0
+        self.reads = 0
+        self.notifications = 0
+        self.trajectory = []
+
+    def drop_connections(self):
+        """Simulate the desk going out of range"""
+        for client in list(self._clients):
+            if client.is_connected:
+                client.drop()
+
+    def value(self):
+        return struct.pack("<Hh", int(round(self.height)), int(self.velocity * 10))
+
+    def write(self, uuid, data):
+        now = time.monotonic()
+        if uuid == ble_control.UUID_COMMAND:
+            if data == bytes(ble_control.COMMAND_UP):
+                self._direction = 1
+                self._command_until = now + COMMAND_DURATION
+            elif data == bytes(ble_control.COMMAND_DOWN):
+                self._direction = -1
+                self._command_until = now + COMMAND_DURATION
+            elif data == bytes(ble_control.COMMAND_STOP):
+                self._direction = 0
+                self._reference = None
+        elif uuid == ble_control.UUID_REFERENCE_INPUT and self.supports_reference_input:
+            if data == bytes(ble_control.COMMAND_REFERENCE_INPUT_STOP):
+                self._reference = None
+            else:
+                self._reference = struct.unpack("<H", data)[0]
+                self._command_until = now + COMMAND_DURATION
+
+    def connected(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    def _target_velocity(self, now):
+        if now >= self._command_until:
+            return 0
+        if self._reference is not None:
+            remaining = self._reference - self.height
+            if abs(remaining) < 1:
+                return 0
+            braking_speed = (2 * self.acceleration * abs(remaining)) ** 0.5
+            return min(self.max_speed, braking_speed) * (1 if remaining > 0 else -1)
+        return self._direction * self.max_speed
+
+    async def _run(self):
+        last_tick = time.monotonic()
+        last_notify = 0
+        while any(client.is_connected for client in self._clients):
+            await asyncio.sleep(TICK)
+            now = time.monotonic()
+            dt = now - last_tick
+            last_tick = now
+            was_moving = self.velocity != 0
+
+            target = self._target_velocity(now)
+            step = self.acceleration * dt
+            if abs(target - self.velocity) <= step:
+                self.velocity = target
+            else:
+                self.velocity += step if target > self.velocity else -step
+            self.height = min(max(self.height + self.velocity * dt, 0), MAX_HEIGHT_RAW)
+            if self.height in (0, MAX_HEIGHT_RAW) and self.velocity != 0:
+                # The motor stops at the end of the range
+                self.velocity = 0
+                self._reference = None
+            if self._reference is not None and abs(self._reference - self.height) < 1 and abs(self.velocity) <= step:
+                self.height = self._reference
+                self.velocity = 0
+                self._reference = None
+
+            if self.velocity != 0:
+                self.trajectory.append((now, self.height))
+                if now - last_notify >= 1 / self.notify_rate:
+                    last_notify = now
+                    self._notify()
+            elif was_moving:
+                self._notify()
+
+    def _notify(self):
+        if self.notifications_muted:
+            return
+        self.notifications += 1
+        value = bytearray(self.value())
+        loop = asyncio.get_event_loop()
+        for client in self._clients:
+            if client.is_connected and client.notify_callback is not None:
+                loop.call_later(self.latency, client.notify_callback, HANDLES[ble_control.UUID_HEIGHT], value)
+
+
+class SimulatedClient:
+    """Implements the parts of BleakClient used by BLEController"""
+
+    def __init__(self, desk, adapter):
+        self.desk = desk
+        self.adapter = adapter
+        self.services = SimulatedServices()
+        self.notify_callback = None
+        self._connected = False
+        self._disconnected_callback = None
+
+    @property
+    def is_connected(self):
+        return self._connected
+
+    async def connect(self, timeout=None):
+        if not self.desk.connectable:
+            await asyncio.sleep(timeout or 0)
+            raise ble_control.BleakError(f"Device with address {self.desk.address} was not found")
+        await asyncio.sleep(self.desk.connect_time)
+        if isinstance(self.services, SimulatedServices) and self.services.is_resolved:
+            # bleak 0.11 adds the discovered services to the collection of the previous connection
+            raise ble_control.BleakError("This service is already present in this BleakGATTServiceCollection!")
+        await asyncio.sleep(self.desk.discovery_time)
+        self.services = SimulatedServices()
+        self.services.resolve()
+        self._connected = True
+        self.desk.connected()
+        return True
+
+    async def disconnect(self):
+        self.drop()
+        return True
+
+    def drop(self):
+        self._connected = False
+        self.notify_callback = None
+        if self._disconnected_callback is not None:
+            self._disconnected_callback(self)
+
+    def set_disconnected_callback(self, callback):
+        self._disconnected_callback = callback
+
+    async def start_notify(self, characteristic, callback):
+        self.notify_callback = callback
+
+    async def stop_notify(self, characteristic):
+        self.notify_callback = None
+
+    async def read_gatt_char(self, characteristic):
+        self._check_connected()
+        await asyncio.sleep(self.desk.write_latency)
+        self.desk.reads += 1
+        return bytearray(self.desk.value())
+
+    async def write_gatt_char(self, characteristic, data, response=False):
+        self._check_connected()
+        await asyncio.sleep(self.desk.write_latency)
+        self.desk.writes += 1
+        uuid = characteristic if isinstance(characteristic, str) else characteristic.uuid
+        self.desk.write(uuid, bytes(data))
+
+    def _check_connected(self):
+        if not self._connected:
+            raise ble_control.BleakError("Not connected")
+
+
+class SimulatedRadio:
+    """All simulated desks in range, scanner() has the signature of BleakScanner.
+    Starting discovery takes start_time and the desks advertise every advertise_interval,
+    the first advertisement arrives after half an interval on average."""
+
+    def __init__(self, advertise_interval=1.0, start_time=0.3):
+        self.desks = []
+        self.advertise_interval = advertise_interval
+        self.start_time = start_time
+
+    def scanner(self, device=None):
+        return SimulatedScanner(self, device)
+
+
+class SimulatedScanner:
+    def __init__(self, radio, adapter):
+        self.radio = radio
+        self.adapter = adapter
+        self._callback = None
+        self._task = None
+
+    def register_detection_callback(self, callback):
+        self._callback = callback
+
+    async def start(self):
+        await asyncio.sleep(self.radio.start_time)
+        self._task = asyncio.get_event_loop().create_task(self._advertise())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _advertise(self):
+        await asyncio.sleep(self.radio.advertise_interval / 2)
+        while True:
+            for desk in self.radio.desks:
+                if self._callback is not None:
+                    self._callback(SimulatedDevice(desk), None)
+            await asyncio.sleep(self.radio.advertise_interval)
@@ -2,34 +2,131 @@
 from __future__ import annotations
 
 import asyncio
+import time
 
+import voluptuous as vol
+
+from homeassistant.components.cover import ATTR_POSITION
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, ServiceCall
+from homeassistant.exceptions import HomeAssistantError
+from homeassistant.helpers import config_validation as cv
+from homeassistant.helpers.discovery import async_load_platform
 from homeassistant.helpers.typing import ConfigType
 
-from .desk_control import DeskController
-from .const import DOMAIN, PLATFORMS
+from .desk_control import DeskController, take_over_controller, load_storage
+from .desk_group import get_fleet
+from .const import (DOMAIN, PLATFORMS, CONF_GROUPS, CONF_CALIBRATION, CONF_CONNECTION_MODE, CONF_IDLE_TIMEOUT,
+                    CONNECTION_MODE_ALWAYS, DEFAULT_IDLE_TIMEOUT, GROUP_ALL, ATTR_GROUP,
+                    SERVICE_MOVE_GROUP, SERVICE_STOP_GROUP, LOGGER)
+
+CONFIG_SCHEMA = vol.Schema(
+    {
+        DOMAIN: vol.Schema(
+            {
+                vol.Optional(CONF_GROUPS, default={}): {
+                    cv.slug: vol.All(cv.ensure_list, [cv.string])
+                },
+            }
+        )
+    },
+    extra=vol.ALLOW_EXTRA,
+)
+
+MOVE_GROUP_SCHEMA = vol.Schema(
+    {
+        vol.Optional(ATTR_GROUP, default=GROUP_ALL): cv.string,
+        vol.Required(ATTR_POSITION): vol.All(vol.Coerce(float), vol.Range(min=0, max=100)),
+    }
+)
+
+STOP_GROUP_SCHEMA = vol.Schema(
+    {
+        vol.Optional(ATTR_GROUP, default=GROUP_ALL): cv.string,
+    }
+)
 
 
 async def async_setup(hass: HomeAssistant, config: ConfigType) -> bool:
     """Set up the component."""
     hass.data.setdefault(DOMAIN, {})
+    fleet = get_fleet()
+    groups = config.get(DOMAIN, {}).get(CONF_GROUPS, {})
+    for name, addresses in groups.items():
+        fleet.set_group(name, [address.upper() for address in addresses])
+    for name in fleet.groups:
+        hass.async_create_task(
+            async_load_platform(hass, "cover", DOMAIN, {ATTR_GROUP: name}, config)
+        )
+
+    def get_group(call: ServiceCall):
+        name = call.data[ATTR_GROUP]
+        if name not in fleet.groups:
+            raise HomeAssistantError(f"Unknown desk group {name}")
+        return fleet.groups[name]
+
+    async def async_move_group(call: ServiceCall) -> None:
+        await get_group(call).move_to_position(call.data[ATTR_POSITION])
+
+    async def async_stop_group(call: ServiceCall) -> None:
+        await get_group(call).stop_movement()
+
+    hass.services.async_register(DOMAIN, SERVICE_MOVE_GROUP, async_move_group,
+                                 schema=MOVE_GROUP_SCHEMA)
+    hass.services.async_register(DOMAIN, SERVICE_STOP_GROUP, async_stop_group,
+                                 schema=STOP_GROUP_SCHEMA)
     return True
 
 
 async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
-    """Set up DeskController from a config entry."""
-    controller = DeskController(entry.data["name"], entry.data["address"])
-    await controller.start_monitoring()
+    """Set up DeskController from a config entry.
+    The desk connects in the background so an unreachable desk does not delay the start of Home Assistant."""
+    started = time.monotonic()
+
+    def store_calibration(calibration):
+        hass.config_entries.async_update_entry(entry, data={**entry.data, CONF_CALIBRATION: calibration})
+
+    connection_mode = entry.options.get(CONF_CONNECTION_MODE, CONNECTION_MODE_ALWAYS)
+    idle_timeout = entry.options.get(CONF_IDLE_TIMEOUT, DEFAULT_IDLE_TIMEOUT)
+    # A new entry takes over the connection its config flow validated the desk with
+    controller = take_over_controller(entry.data["address"])
+    if controller is not None:
+        controller.name = entry.data["name"]
+        controller.calibration_callback = store_calibration
+        controller.connection.configure(connection_mode, idle_timeout)
+    else:
+        storage = await hass.async_add_executor_job(load_storage, hass.config.path(), entry.data["address"])
+        controller = DeskController(entry.data["name"], entry.data["address"],
+                                    calibration=entry.data.get(CONF_CALIBRATION),
+                                    calibration_callback=store_calibration,
+                                    connection_mode=connection_mode,
+                                    idle_timeout=idle_timeout,
+                                    **storage)
     hass.data[DOMAIN][entry.entry_id] = controller
+    get_fleet().add(controller)
+    entry.async_on_unload(entry.add_update_listener(async_update_options))
 
-    for component in PLATFORMS:
-        hass.async_create_task(
+    controller.start_background_monitoring()
+    await asyncio.gather(
+        *[
             hass.config_entries.async_forward_entry_setup(entry, component)
-        )
+            for component in PLATFORMS
+        ]
+    )
+    controller.setup_duration = time.monotonic() - started
+    controller.instrumentation.observe("setup_entry", controller.setup_duration)
+    LOGGER.debug(f"Set up {entry.data['address']} in {controller.setup_duration * 1000:.1f}ms")
     return True
 
 
+async def async_update_options(hass: HomeAssistant, entry: ConfigEntry) -> None:
+    """Apply a changed connection policy, the listener also runs when the calibration is stored."""
+    controller = hass.data[DOMAIN][entry.entry_id]
+    controller.connection.configure(entry.options.get(CONF_CONNECTION_MODE, CONNECTION_MODE_ALWAYS),
+                                    entry.options.get(CONF_IDLE_TIMEOUT, DEFAULT_IDLE_TIMEOUT))
+    controller.publish_updates()
+
+
 async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     """Unload a config entry."""
     unload_ok = all(
@@ -43,7 +140,9 @@ async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     )
     if unload_ok:
         controller = hass.data[DOMAIN][entry.entry_id]
+        get_fleet().remove(controller)
         await controller.disconnect()
+        await controller.device_cache.async_flush()
         hass.data[DOMAIN].pop(entry.entry_id)
 
     return unload_ok
@@ -0,0 +1,119 @@
+"""
+AdapterScheduler spreads desk connections across the local bluetooth adapters
+"""
+
+import os
+
+from .scanner import get_scanner
+from .const import ADAPTER_NAMES, ADAPTER_SYSFS_PATH, MAX_CONNECTIONS_PER_ADAPTER, LOGGER
+
+_SCHEDULER = None
+
+
+def get_scheduler():
+    """Return the scheduler shared by all desks"""
+    global _SCHEDULER
+    if _SCHEDULER is None:
+        _SCHEDULER = AdapterScheduler(find_adapters())
+    return _SCHEDULER
+
+
+def find_adapters(sysfs_path=ADAPTER_SYSFS_PATH):
+    """Return the names of the local bluetooth adapters.
+    The kernel lists every adapter in sysfs next to its connections (hci0:64),
+    the default adapters are used if none are listed"""
+    try:
+        adapters = sorted(name for name in os.listdir(sysfs_path)
+                          if name.startswith("hci") and ":" not in name)
+    except OSError:
+        adapters = []
+    if not adapters:
+        LOGGER.debug(f"No adapters found in {sysfs_path}, use {ADAPTER_NAMES}")
+        return list(ADAPTER_NAMES)
+    LOGGER.debug(f"Found adapters {adapters}")
+    return adapters
+
+
+def scanner_rssi(adapter, address):
+    """Return the last RSSI of the address seen by the shared scanner of the adapter"""
+    advertisement = get_scanner(adapter).get(address)
+    return None if advertisement is None else advertisement.rssi
+
+
+class AdapterScheduler:
+    """Assigns each desk to an adapter.
+    Adapters with free connection slots that can see the desk are preferred, then the adapter
+    with the fewest connections and then the one with the best RSSI.
+    rssi_lookup(adapter, address) returns None if the adapter did not see the desk,
+    tests can pass a fake lookup instead of the shared scanners."""
+
+    def __init__(self, adapters=ADAPTER_NAMES, max_connections=MAX_CONNECTIONS_PER_ADAPTER,
+                 rssi_lookup=scanner_rssi):
+        self.adapters = list(adapters)
+        self.max_connections = max_connections
+        self.migrations = 0
+        self._rssi_lookup = rssi_lookup
+        self._assignments = {}
+
+    def connections(self, adapter):
+        return sum(1 for assigned in self._assignments.values() if assigned == adapter)
+
+    def is_saturated(self, adapter):
+        return self.connections(adapter) > self.max_connections
+
+    def assign(self, address, preferred=None):
+        """Return the adapter of the address, choosing one if it has none yet"""
+        adapter = self._assignments.get(address)
+        if adapter is not None:
+            return adapter
+        if preferred in self.adapters and self.connections(preferred) < self.max_connections:
+            adapter = preferred
+        else:
+            adapter = self._best_adapter(address)
+        if self.connections(adapter) >= self.max_connections:
+            LOGGER.warning(f"All adapters are saturated, assign {address} to {adapter}")
+        self._assignments[address] = adapter
+        LOGGER.debug(f"Assigned {address} to {adapter}")
+        return adapter
+
+    def release(self, address):
+        """Free the connection slot of the address"""
+        self._assignments.pop(address, None)
+
+    def migrate(self, address):
+        """Move the address to another adapter with a free slot.
+        Return the new adapter or None if there is no better one"""
+        current = self._assignments.get(address)
+        candidates = [adapter for adapter in self.adapters
+                      if adapter != current and self.connections(adapter) < self.max_connections]
+        if not candidates:
+            return None
+        adapter = self._best_adapter(address, candidates)
+        if self._rssi_lookup(adapter, address) is None and not self.is_saturated(current):
+            # Only move to an adapter that cannot see the desk if the current one is overloaded
+            return None
+        self._assignments[address] = adapter
+        self.migrations += 1
+        LOGGER.info(f"Migrated {address} from {current} to {adapter}")
+        return adapter
+
+    def load(self):
+        """Return the connection count and the desks of every adapter"""
+        return {
+            adapter: {
+                "connections": self.connections(adapter),
+                "max_connections": self.max_connections,
+                "addresses": [address for address, assigned in self._assignments.items()
+                              if assigned == adapter],
+            }
+            for adapter in self.adapters
+        }
+
+    def _best_adapter(self, address, adapters=None):
+        def score(adapter):
+            rssi = self._rssi_lookup(adapter, address)
+            return (self.connections(adapter) >= self.max_connections,
+                    rssi is None,
+                    self.connections(adapter),
+                    -rssi if rssi is not None else 0)
+        return min(adapters or self.adapters, key=score)
@@ -3,13 +3,31 @@ BLEController handles BLE communication
 """
 
 import sys
-import os
 import struct
+import time
 import asyncio
-import pickle
-from bleak import BleakClient, BleakError, BleakScanner
+from dataclasses import dataclass
+from bleak import BleakClient, BleakError
+from bleak.backends.device import BLEDevice
 from bleak.backends.service import BleakGATTServiceCollection
-from .const import HEIGHT_TOLERANCE, MIN_HEIGHT, ADAPTER_NAME, SCAN_TIMEOUT, CONNECTION_TIMEOUT, LOGGER
+from .const import (ADAPTER_NAME, CONNECTION_TIMEOUT, MOVEMENT_TIMEOUT, SETTLE_TIMEOUT,
+                    MOVE_MODE_PULSE, MOVE_MODE_REFERENCE_INPUT, REFERENCE_INPUT_REFRESH_INTERVAL,
+                    REFERENCE_INPUT_PROBE_TIMEOUT, STOP_REASON_REACHED, STOP_REASON_USER_OVERRIDE,
+                    STOP_REASON_TIMEOUT, STOP_REASON_DISCONNECT, NOTIFICATION_LOG_SAMPLE,
+                    STOP_REASON_SUPERSEDED, STOP_REASON_STOPPED, CALIBRATION_SOURCE_DEFAULT, CALIBRATION_SOURCE_DESK, LOGGER)
+from .bluetoothctl import Bluetoothctl
+from .instrumentation import get_instrumentation
+from .device_cache import get_device_cache
+from .scanner import get_scanner
+from .adapter_scheduler import get_scheduler
+from .reconnect import ReconnectSupervisor, backoff_delay
+from .trace_recorder import (TraceRecorder, KIND_NOTIFICATION, KIND_COMMAND, KIND_REFERENCE_INPUT, KIND_MOVE,
+                             MOVE_STRUCT)
+from .calibration import HeightCalibration
+from .height_decoder import HEIGHT_SPEED, decode_height_speed, speed_raw_to_mm
+from .command_queue import CommandQueue
+from .notification_watchdog import NotificationWatchdog
+from .motion_planner import MotionPlanner, ACTION_NONE, ACTION_RESEND, ACTION_STOP
 
 IS_LINUX = sys.platform == "linux" or sys.platform == "linux2"
 IS_WINDOWS = sys.platform == "win32"
@@ -19,44 +37,129 @@ IS_MAC = sys.platform == "darwin"
 UUID_HEIGHT = '99fa0021-338a-1024-8a49-009c0215f78a'
 UUID_COMMAND = '99fa0002-338a-1024-8a49-009c0215f78a'
 UUID_REFERENCE_INPUT = '99fa0031-338a-1024-8a49-009c0215f78a'
+UUID_DPG = '99fa0011-338a-1024-8a49-009c0215f78a'
 
 COMMAND_REFERENCE_INPUT_STOP = bytearray([0x01, 0x80])
 COMMAND_UP = bytearray([0x47, 0x00])
 COMMAND_DOWN = bytearray([0x46, 0x00])
 COMMAND_STOP = bytearray([0xFF, 0x00])
+COMMAND_WAKEUP = bytearray([0xFE, 0x00])
+# DPG read of the height of the lowest position, answered with 0x01, length, valid flag, u16 offset in 0.1mm
+DPG_COMMAND_DESK_OFFSET = bytearray([0x7F, 0x81, 0x00])
 
-PICKLE_FILE = os.path.join(os.getcwd(), 'desk.pickle')
+# Parts of error messages that indicate an outdated characteristic handle, BlueZ answers with
+# org.freedesktop.DBus.Error.UnknownObject for a removed characteristic path
+STALE_HANDLE_ERRORS = ("unknownobject", "invalid handle")
+
+CONNECT_SOURCE_CLIENT = "client"
+CONNECT_SOURCE_CACHE = "cache"
+CONNECT_SOURCE_SCAN = "scan"
+
+# Pending commands with the same key are merged by the command queue
+COMMAND_KEY_MOVE = "move"
+COMMAND_KEY_REFERENCE_INPUT = "reference_input"
+
+
+@dataclass
+class MoveResult:
+    """Outcome of a move, heights are in mm"""
+    reason: str
+    target: int
+    height: int
+    duration: float
+    commands_sent: int
+
+    @property
+    def error(self):
+        """Return the distance between the final height and the target"""
+        if self.height is None:
+            return None
+        return self.height - self.target
+
+
+def is_stale_handle_error(error):
+    """Return if the error was caused by a characteristic that no longer exists"""
+    message = str(error).lower()
+    return any(keyword in message for keyword in STALE_HANDLE_ERRORS)
 
 
 class BLEController:
     def __init__(self, address=None,
                  height_speed_callback=None,
-                 connection_change_callback=None):
+                 connection_change_callback=None,
+                 device_cache=None,
+                 scheduler=None,
+                 client_factory=BleakClient,
+                 instrumentation=None,
+                 calibration=None):
         """Set up the async event loop and signal handlers"""
         LOGGER.debug("Init BLEController")
         self.client = None
         self.address = address
         self.height_speed_callback = height_speed_callback
         self.connection_change_callback = connection_change_callback
-
+        self.instrumentation = instrumentation or get_instrumentation()
+        self.calibration = calibration or HeightCalibration()
+        self.last_connect_source = None
+        self.last_connect_duration = None
+        self.connect_counts = {}
+        self._device_cache = device_cache or get_device_cache()
+        self._client_factory = client_factory
+        self._characteristics = {}
+        self._connect_lock = asyncio.Lock()
+        self._scheduler = scheduler or get_scheduler()
+        self.adapter = ADAPTER_NAME
+        self._scanner = get_scanner(ADAPTER_NAME)
+        self._scanner_acquired = False
+        self._reconnect_supervisor = ReconnectSupervisor(self._reconnect_once)
+
+        # Whether a dropped link is reconnected, set by the connection policy of the desk
+        self.reconnect_on_disconnect = True
         self._reconnect = True
         self._is_moving = False
         self._target_height = None
-        self._movement_count = 0
         self._direction = None
+        self._planner = MotionPlanner()
+        self._move_mode = None
+        # None until a move showed whether the desk follows the reference input
+        self._reference_input_supported = False if IS_WINDOWS else None
         self._move_done = None
+        self._move_generation = 0
+        self._queue = CommandQueue(self._gatt_write)
+        self._settled = asyncio.Event()
+        self._last_height_raw = None
+        self._last_speed_raw = None
+        self._started_moving = False
+        self._watchdog = NotificationWatchdog(self, self.instrumentation)
+        self._commands_sent = 0
+        self._recorder = None
+        self._clock = time.monotonic
 
     @property
     def is_connected(self):
         """Return if the client is connected"""
         return self.client is not None and self.client.is_connected
 
+    @property
+    def is_moving(self):
+        """Return if a move is running or the desk reported a speed"""
+        return self._is_moving or bool(self._last_speed_raw)
+
+    @property
+    def last_height_raw(self):
+        return self._last_height_raw
+
     async def start_monitoring(self):
         LOGGER.debug("Start Monitoring")
         self.client = await self.connect(self.address, self.client)
         if self.client is None:
             LOGGER.error(f'Cannot start monitoring for address: {self.address}')
             return
+        await self._read_initial_state()
+
+    async def _read_initial_state(self):
+        if self.calibration.source == CALIBRATION_SOURCE_DEFAULT:
+            await self._read_desk_offset()
         await self._read_state(self.client)
 
     async def get_current_state(self):
@@ -72,91 +175,218 @@ class BLEController:
             LOGGER.error(f'Could not connect to client: {self.address}')
             return None, None
         height_raw, speed_raw = await self._read_gatt_char()
+        if speed_raw == 0:
+            self.calibration.observe(height_raw)
         height, speed = self._format_height_speed(height_raw, speed_raw)
-        print("Height: {:4.0f}mm Speed: {:2.0f}mm/s".format(height, speed))
+        self.instrumentation.event("state", "Height: %dmm Speed: %dmm/s", height, speed)
         if self.height_speed_callback is not None:
-            self.height_speed_callback(height, speed)
+            self.height_speed_callback(height_raw, speed_raw)
         return height, speed
 
     async def scan(self, address=None):
-        """Scan for a bluetooth device with the configured address
+        """Look up a bluetooth device with the configured address in the shared scanner
         return it or return all devices if no address specified"""
         LOGGER.debug('Start scanning')
-        scanner = BleakScanner()
-        devices = await scanner.discover(device=ADAPTER_NAME, timeout=SCAN_TIMEOUT)
+        await self._acquire_scanner()
         if not address:
+            await self._scanner.wait_ready()
             device_dict = {}
-            for device in devices:
+            for device in self._scanner.devices():
                 device_dict[device.name] = device.address
-            LOGGER.debug(f"Found {len(devices)} devices using {ADAPTER_NAME}, devices: {device_dict}")
+            LOGGER.debug(f"Found {len(device_dict)} devices using {self._scanner.adapter}, devices: {device_dict}")
             return device_dict
-        for device in devices:
-            if (device.address == address):
-                LOGGER.debug('Scanning - Desk Found')
-                return device
+        with self.instrumentation.timed("discover"):
+            device = await self._scanner.find(address)
+        if device is not None:
+            LOGGER.debug('Scanning - Desk Found')
+            return device
         LOGGER.warn(f'Scanning - Desk {address} Not Found')
         return None
 
+    async def _acquire_scanner(self):
+        if not self._scanner_acquired:
+            self._scanner_acquired = await self._scanner.acquire()
+
+    async def _release_scanner(self):
+        if self._scanner_acquired:
+            self._scanner_acquired = False
+            await self._scanner.release()
+
     async def disconnect(self):
         LOGGER.debug("Disconnect called")
         self._reconnect = False
+        self._reconnect_supervisor.cancel()
+        self._watchdog.stop()
+        self._scheduler.release(self.address)
+        await self._release_scanner()
+        if self._recorder is not None:
+            self._recorder.flush()
         if self.client and self.client.is_connected:
             LOGGER.debug('Disconnecting')
             await self.stop_movement()
             await self.client.disconnect()
-            self.client.services = BleakGATTServiceCollection()
             LOGGER.debug('Disconnected')
+        self._queue.close()
 
-    async def pair_device(self):  # TODO
-        if IS_LINUX:
-            LOGGER.debug("Try pairing")
+    async def ensure_connected(self):
+        """Connect if the desk is not connected and return if it is connected now"""
+        self.client = await self.connect(self.address, self.client)
+        return self.client is not None
 
-    async def connect(self, address, current_client):
-        """Attempt to connect to the desk"""
-        # Attempt to load and connect to the pickled desk
+    async def release_connection(self):
+        """Drop the link and free the adapter slot, the next command connects again through the cache"""
+        LOGGER.debug(f"Release connection to {self.address}")
+        self._reconnect = False
+        self._reconnect_supervisor.cancel()
+        self._watchdog.stop()
+        self._scheduler.release(self.address)
+        await self._release_scanner()
+        if self._recorder is not None:
+            self._recorder.flush()
+        self._queue.clear()
+        client, self.client = self.client, None
+        if client is not None and client.is_connected:
+            await client.disconnect()
+
+    async def pair_device(self):
+        """Pair the desk, on MacOS and Windows pairing happens automatically while connecting"""
+        if not IS_LINUX:
+            return True
+        LOGGER.debug("Try pairing")
+        return await Bluetoothctl().pair(self.address)
+
+    async def connect(self, address, current_client, retry=True):
+        """Attempt to connect to the desk, concurrent calls wait for the running attempt.
+        Without retry only a single connect is attempted, the caller retries with its own backoff."""
+        async with self._connect_lock:
+            if self.client is not None and self.client.is_connected:
+                return await self._connect(address, self.client, retry)
+            with self.instrumentation.timed("connect"):
+                return await self._connect(address, current_client, retry)
+
+    async def _connect(self, address, current_client, retry):
         if current_client is not None and current_client.is_connected:
-            self._reconnect = True
+            self._reconnect = self.reconnect_on_disconnect
             return current_client
 
-        pickled_Desk = self._unpickle_desk(address)
-
+        started = time.monotonic()
         if current_client is not None:
             LOGGER.debug("Client available! Try connecting")
-            if (await self._connect_client(current_client)):
+            if (await self._connect_client(current_client, attempts=3 if retry else 1)):
+                self._connected(current_client, CONNECT_SOURCE_CLIENT, started)
                 return current_client
             else:
                 LOGGER.debug("Stored client invalid! Remove self.client")
                 self.client = None
-
-        if pickled_Desk is not None:
-            LOGGER.debug("Pickled desk available! Try connecting")
-            client = BleakClient(pickled_Desk, device=ADAPTER_NAME)
-            if (await self._connect_client(client)):
+                if not retry:
+                    return None
+
+        cached_desk = self._device_cache.get(address)
+        preferred_adapter = cached_desk.get("adapter") if cached_desk is not None else None
+        adapter = self._scheduler.assign(address, preferred_adapter)
+        if self._scheduler.is_saturated(adapter):
+            adapter = self._scheduler.migrate(address) or adapter
+        await self._use_adapter(adapter)
+
+        # Attempt to connect with the cached device details, this skips scanning.
+        # The cached object path belongs to the adapter it was discovered on.
+        if cached_desk is not None and preferred_adapter == adapter:
+            LOGGER.debug("Cached desk available! Try connecting")
+            client = self._client_factory(self._cached_device(cached_desk), device=adapter)
+            if (await self._connect_client(client, attempts=1)):
+                self._connected(client, CONNECT_SOURCE_CACHE, started)
                 return client
+            self._device_cache.invalidate(address)
+            if not retry:
+                return None
 
         found_desk = await self.scan(address)
         if found_desk is None:
-            LOGGER.error(f'Could not find desk {self.address}')
+            LOGGER.error(f'Could not find desk {self.address} using {adapter}')
+            self._scheduler.migrate(address)
             return None
 
-        self._remove_pickled_desk()
-        client = BleakClient(found_desk, device=ADAPTER_NAME)
-        if (await self._connect_client(client)):
-            self._pickle_desk(found_desk)
+        client = self._client_factory(found_desk, device=adapter)
+        if (await self._connect_client(client, attempts=3 if retry else 1)):
+            self._connected(client, CONNECT_SOURCE_SCAN, started, found_desk)
             return client
+        self._scheduler.migrate(address)
         return None
 
-    async def _connect_client(self, client):
+    async def _use_adapter(self, adapter):
+        """Switch to the adapter, scanning moves to the shared scanner of that adapter"""
+        if adapter == self.adapter:
+            return
+        LOGGER.debug(f"Use adapter {adapter} for {self.address}")
+        await self._release_scanner()
+        self.adapter = adapter
+        self._scanner = get_scanner(adapter)
+
+    def _connected(self, client, source, started, device=None):
+        """Record connect metrics and store the connection details in the cache"""
+        self.last_connect_source = source
+        self.last_connect_duration = time.monotonic() - started
+        self.connect_counts[source] = self.connect_counts.get(source, 0) + 1
+        LOGGER.debug(f"Connected {self.address} from {source} in {self.last_connect_duration:.2f}s")
+        self._reconnect_supervisor.connected()
+
+        cached_desk = self._device_cache.get(self.address)
+        if cached_desk is not None and self._planner.completed_moves == 0:
+            self._planner.deceleration = cached_desk.get("deceleration", self._planner.deceleration)
+            self._planner.latency = cached_desk.get("latency", self._planner.latency)
+            if self._reference_input_supported is None:
+                self._reference_input_supported = cached_desk.get("reference_input")
+
+        fields = {
+            "adapter": self.adapter,
+            "last_connect": time.time(),
+        }
+        if device is not None:
+            fields["name"] = device.name
+            fields["rssi"] = device.rssi
+            if IS_LINUX and isinstance(device.details, dict):
+                fields["path"] = device.details.get("path")
+        self._device_cache.update(self.address, **fields)
+
+    def _cached_device(self, entry):
+        """Rebuild the device from the cache, BlueZ connects directly if the object path is known"""
+        if entry.get("path") is None:
+            return entry["address"]
+        return BLEDevice(entry["address"], entry.get("name"), {"path": entry["path"], "props": {}},
+                         entry.get("rssi", 0))
+
+    def _characteristic(self, uuid, client=None):
+        """Return the resolved characteristic for the uuid.
+        It is looked up once per desk and reused across reconnects, the uuid is returned if it is unknown"""
+        characteristic = self._characteristics.get(uuid)
+        if characteristic is not None:
+            return characteristic
+        client = client or self.client
+        if client is not None and client.services is not None:
+            characteristic = client.services.get_characteristic(uuid)
+            if characteristic is not None:
+                self._characteristics[uuid] = characteristic
+                return characteristic
+        return uuid
+
+    def _invalidate_characteristics(self):
+        """Forget the resolved characteristics, they are looked up again after the next service discovery"""
+        LOGGER.debug(f"Invalidate GATT characteristics of {self.address}")
+        self._characteristics = {}
+
+    async def _connect_client(self, client, attempts=3):
         if client is None:
             LOGGER.error("Cannot connect, client is None")
             return False
 
-        for attempt in range(3):
+        for attempt in range(attempts):
             try:
                 LOGGER.debug(f'Connecting - attempt {attempt}')
                 if client.is_connected:
                     await self._setup_connection(client)
                     return True
+                # bleak 0.11 adds the discovered services to the existing collection and fails with
+                # "This service is already present" when a client that dropped connects again
                 client.services = BleakGATTServiceCollection()
                 await client.connect(timeout=CONNECTION_TIMEOUT)
                 if client.is_connected:
@@ -164,170 +394,447 @@ class BLEController:
                     return True
             except BleakError as e:
                 LOGGER.error(f'Bluetooth Error {e}')
-            await asyncio.sleep(3)
+                if is_stale_handle_error(e):
+                    self._invalidate_characteristics()
+            if attempt < attempts - 1:
+                await asyncio.sleep(backoff_delay(attempt))
         return False
 
     async def _setup_connection(self, client):
-        self._connection_change(client)
+        # The client is assigned before anyone is notified, listeners check is_connected
+        self.client = client
         client.set_disconnected_callback(self._connection_change)
-        await self._subscribe(client, UUID_HEIGHT, self._height_data_callback)
+        if not await self._subscribe(client, UUID_HEIGHT, self._notification_callback):
+            self._watchdog.subscription_failed()
+        self._watchdog.start()
         LOGGER.debug(f"Connected {self.address}")
-        self._reconnect = True
+        self._reconnect = self.reconnect_on_disconnect
+        self._connection_change(client)
 
     def _connection_change(self, client):
         if not client.is_connected:
-            client.services = BleakGATTServiceCollection()
-            self.connection_change_callback()
-            if self._reconnect:
+            self._is_moving = False
+            self._finish_move(STOP_REASON_DISCONNECT)
+            self._reconnect_supervisor.disconnected()
+            if self.connection_change_callback is not None:
+                self.connection_change_callback()
+            # The policy may have switched to on-demand while the link was up
+            if self._reconnect and self.reconnect_on_disconnect:
                 LOGGER.error('Client did disconnect. Try reconnecting!')
-                asyncio.create_task(self.connect(self.address, self.client))
-        self.connection_change_callback()
+                self._reconnect_supervisor.trigger()
+        if self.connection_change_callback is not None:
+            self.connection_change_callback()
+
+    def reconnect_in_background(self):
+        """Keep connecting with backoff until the desk is reachable"""
+        self._reconnect = True
+        self._reconnect_supervisor.trigger()
+
+    async def _reconnect_once(self):
+        # A single attempt, the supervisor backs off between attempts
+        self.client = await self.connect(self.address, self.client, retry=False)
+        if self.client is None:
+            return False
+        # The desk may have been moved with the handset while it was unreachable
+        try:
+            await self._read_initial_state()
+        except BleakError as e:
+            LOGGER.warning(f"Could not read the state of {self.address} after connecting: {e}")
+        return True
+
+    def diagnostics(self):
+        """Return connection, reconnect and planner metrics"""
+        supervisor = self._reconnect_supervisor
+        return {
+            "adapter": self.adapter,
+            "adapter_load": self._scheduler.load(),
+            "last_connect_source": self.last_connect_source,
+            "last_connect_duration": self.last_connect_duration,
+            "connect_counts": dict(self.connect_counts),
+            "reconnect": {
+                "state": supervisor.state,
+                "attempts": supervisor.attempts,
+                "total_attempts": supervisor.total_attempts,
+                "errors": supervisor.errors,
+                "reconnects": supervisor.reconnects,
+                "last_reconnect_duration": supervisor.last_reconnect_duration,
+            },
+            "planner": {
+                "deceleration": self._planner.deceleration,
+                "latency": self._planner.latency,
+                "completed_moves": self._planner.completed_moves,
+                "last_error": self._planner.last_error,
+            },
+            "reference_input_supported": self._reference_input_supported,
+            "calibration": self.calibration.as_dict(),
+            "command_queue": self._queue.diagnostics(),
+            "notifications": self._watchdog.diagnostics(),
+        }
+
+    @property
+    def reconnect_state(self):
+        """Return the state of the reconnect supervisor"""
+        return self._reconnect_supervisor.state
 
     async def move_to_position(self, position):
+        """Move the desk to the height in mm and wait until it stands still"""
+        return await self.move_to_raw(self._mm_to_raw(position))
+
+    async def move_to_raw(self, target):
+        """Move the desk to the raw height and wait until it stands still.
+        A move that is superseded by a later one returns without waiting for the desk"""
+        started = time.monotonic()
         self.client = await self.connect(self.address, self.client)
         if self.client is None:
             LOGGER.error(f'Could not connect to {self.address}')
-            return
-        self._target_height = self._mm_to_raw(position)
-        await self._move_to()
-        if self._target_height:
-            # If we were moving to a target height, wait, then print the actual final height
-            await asyncio.sleep(1)
-            height_raw, speed_raw = await self._read_gatt_char()
-            height, speed = self._format_height_speed(height_raw, speed_raw)
-            self.height_speed_callback(height, speed)
-
-    async def _move_to(self):
-        """Move the desk to a specified height"""
+            return self._move_result(STOP_REASON_DISCONNECT, None, started, target)
+        reason = await self._move_to(target)
+        if reason == STOP_REASON_SUPERSEDED:
+            self.instrumentation.count(f"move_{reason}")
+            return self._move_result(reason, self._last_height_raw, started, target)
+        height_raw = await self._settled_height()
+        if height_raw is None:
+            reason = STOP_REASON_DISCONNECT
+        else:
+            self.calibration.observe(height_raw)
+            if self.height_speed_callback is not None:
+                self.height_speed_callback(height_raw, 0)
+        result = self._move_result(reason, height_raw, started, target)
+        self.instrumentation.observe("move", result.duration)
+        self.instrumentation.count(f"move_{reason}")
+        self._device_cache.update(self.address,
+                                  deceleration=self._planner.deceleration,
+                                  latency=self._planner.latency,
+                                  reference_input=self._reference_input_supported)
+        LOGGER.debug(f"Move of {self.address} finished: {result}")
+        return result
+
+    async def _move_to(self, target):
+        """Move the desk to a specified height and return the reason it stopped"""
         height, speed = await self._read_gatt_char()
+        if self._is_moving and self._move_done is not None and not self._move_done.done():
+            if target == self._target_height:
+                # Same target as the move in progress, wait for that move
+                self.instrumentation.count("move_merged")
+                return await self._wait_for_move(asyncio.shield(self._move_done))
+            if (target > height) == (self._direction == "UP"):
+                return await self._wait_for_move(self._retarget(target))
+
+        self._commands_sent = 0
+        if self._planner.is_within_tolerance(height, target):
+            if self._is_moving:
+                # The desk passes the target while moving the other way, stop it and end that move
+                await self.stop_movement()
+            return STOP_REASON_REACHED
+        self._target_height = target
+        self._begin_move(height)
+
+        # A previous move that is still waiting has been overridden by this one
+        self._finish_move(STOP_REASON_USER_OVERRIDE)
+        loop = asyncio.get_event_loop()
+        self._move_done = loop.create_future()
+        self._move_generation += 1
+        self._settled.clear()
+        self._is_moving = True
+        self._started_moving = False
+        self._watchdog.move_started()
+        if self._reference_input_supported is False:
+            self._move_mode = MOVE_MODE_PULSE
+            asyncio.create_task(self._send_move_command())
+        else:
+            self._move_mode = MOVE_MODE_REFERENCE_INPUT
+            asyncio.create_task(self._move_with_reference_input(self._move_generation))
+        return await self._wait_for_move(self._move_done)
+
+    def _retarget(self, target):
+        """Point the move in progress at a new target in the same direction without stopping the desk.
+        The caller of the previous target returns as superseded and the new caller waits instead"""
+        LOGGER.debug(f"Retarget {self.address} from {self._target_height} to {target}")
+        self.instrumentation.count("move_retarget")
+        self._target_height = target
+        self._planner.retarget(target)
+        previous = self._move_done
+        self._move_done = asyncio.get_event_loop().create_future()
+        previous.set_result(STOP_REASON_SUPERSEDED)
+        if self._move_mode == MOVE_MODE_REFERENCE_INPUT:
+            asyncio.create_task(self._write_command(UUID_REFERENCE_INPUT, struct.pack("<H", target),
+                                                    key=COMMAND_KEY_REFERENCE_INPUT))
+        return self._move_done
+
+    async def _wait_for_move(self, move_done):
+        try:
+            return await asyncio.wait_for(move_done, timeout=MOVEMENT_TIMEOUT)
+        except asyncio.TimeoutError:
+            LOGGER.error(f'Timed out while moving {self.address}')
+            if self.is_connected:
+                await self.stop_movement()
+            return STOP_REASON_TIMEOUT
+
+    def _begin_move(self, height):
         self._direction = "UP" if self._target_height > height else "DOWN"
-        self._movement_count = 0
-
-        # loop = asyncio.get_event_loop()
-        # self._move_done = loop.create_future()
-
-        if not self._has_reached_target(height):
-            self._is_moving = True
-            if self._direction == "UP":
-                asyncio.create_task(self._move_up())
-            elif self._direction == "DOWN":
-                asyncio.create_task(self._move_down())
-            # try:
-            #     await asyncio.wait_for(self._move_done, timeout=MOVEMENT_TIMEOUT)
-            # except asyncio.TimeoutError as e:
-            #     print('Timed out while waiting for desk')
-            #     print(e)
-                #await self._unsubscribe(UUID_HEIGHT)
+        self._planner.start(self._target_height)
+        if self._recorder is not None:
+            self._recorder.record(KIND_MOVE, MOVE_STRUCT.pack(self._target_height, height))
+
+    def _replay_move(self, target, height):
+        """Start planning a recorded move, used by the trace replay"""
+        self._target_height = target
+        self._begin_move(height)
+        self._planner.command_sent(self._clock())
+        self._is_moving = True
+        self._move_mode = MOVE_MODE_PULSE
+
+    def start_recording(self, path):
+        """Record notifications and commands into the trace file"""
+        self.stop_recording()
+        self._recorder = TraceRecorder(path)
+        LOGGER.debug(f"Recording height trace of {self.address} to {path}")
+
+    def stop_recording(self):
+        if self._recorder is not None:
+            self._recorder.close()
+            self._recorder = None
+
+    async def _settled_height(self):
+        """Wait until the desk stands still and return its raw height"""
+        if self._move_mode is not None:
+            try:
+                await asyncio.wait_for(self._settled.wait(), timeout=SETTLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            self._move_mode = None
+        if self._settled.is_set():
+            return self._last_height_raw
+        if not self.is_connected:
+            return None
+        height_raw, speed_raw = await self._read_gatt_char()
+        return height_raw
+
+    def _finish_move(self, reason):
+        if self._move_done is not None and not self._move_done.done():
+            self._move_done.set_result(reason)
+
+    def _move_result(self, reason, height_raw, started, target):
+        return MoveResult(reason=reason,
+                          target=self._raw_to_mm(target),
+                          height=None if height_raw is None else self._raw_to_mm(height_raw),
+                          duration=time.monotonic() - started,
+                          commands_sent=self._commands_sent)
+
+    def _notification_callback(self, sender, data):
+        self._watchdog.notification_received()
+        self._height_data_callback(sender, data)
+
+    def process_height_data(self, data):
+        """Handle a height that was read instead of notified"""
+        self._height_data_callback(None, data)
 
     def _height_data_callback(self, sender, data):
-        height_raw, speed_raw = struct.unpack("<Hh", data)
-        height, speed = self._format_height_speed(height_raw, speed_raw)
+        if self._recorder is not None:
+            self._recorder.record(KIND_NOTIFICATION, data)
+        height_raw, speed_raw = decode_height_speed(data)
+        # Heights stay raw, they are converted to mm when entities read them
+        self.instrumentation.event("notification", "Height: %d Speed: %d (raw)", height_raw, speed_raw,
+                                   sample=NOTIFICATION_LOG_SAMPLE)
+        if speed_raw == 0 and self._last_speed_raw:
+            # The range is only extended once the desk rests, not with every notification on the way up
+            self.calibration.observe(height_raw)
+        self._last_height_raw = height_raw
+        self._last_speed_raw = speed_raw
+        if speed_raw == 0:
+            self._settled.set()
+        else:
+            self._settled.clear()
+            self._started_moving = True
 
         if self._is_moving:
-            self._movement_count = self._movement_count + 1
-            self.height_speed_callback(height, speed)
-            print("Height: {:4.0f}mm Target: {:4.0f}mm Speed: {:2.0f}mm/s".format(height, self._raw_to_mm(self._target_height), speed))
-
-            # Stop if we have reached the target OR
-            # If you touch desk control while the script is running then movement
-            # callbacks stop. The final call will have speed 0 so detect that
-            # and stop.
-            if speed == 0 or self._has_reached_target(height_raw):
-                asyncio.create_task(self.stop_movement())
+            # The planner stops when the predicted resting height reaches the
+            # target. If you touch desk control while the script is running then
+            # movement callbacks stop. The final call will have speed 0 so the
+            # planner stops as well.
+            # Otherwise the movement command is resent before the motor slows
+            # down, each command runs the desk motors for about 1 second.
+            if self._move_mode == MOVE_MODE_REFERENCE_INPUT:
+                action = self._reference_input_action(speed_raw)
+            elif not self._started_moving:
+                # A polled height can arrive before the motor starts, it is not a stop
+                action = ACTION_NONE
+            else:
+                action = self._planner.update(height_raw, speed_raw, self._clock())
+            if action == ACTION_STOP:
+                if self._move_mode == MOVE_MODE_PULSE:
+                    asyncio.create_task(self.stop_movement())
                 self._is_moving = False
                 self._direction = None
-                # try:
-                #     self._move_done.set_result(True)
-                # except asyncio.exceptions.InvalidStateError:
-                #     # This happens on windows, I dont know why
-                #     pass
-            # Or resend the movement command if we have not yet reached the
-            # target.
-            # Each movement command seems to run the desk motors for about 1
-            # second if uninterrupted and the height value is updated about 16
-            # times.
-            # Resending the command on the 6th update seems a good balance
-            # between helping to avoid overshoots and preventing stutterinhg
-            # (the motor seems to slow if no new move command has been sent)
-            elif self._direction == "UP" and self._movement_count == 6:
-                asyncio.create_task(self._move_up())
-                self._movement_count = 0
-            elif self._direction == "DOWN" and self._movement_count == 6:
-                asyncio.create_task(self._move_down())
-                self._movement_count = 0
-        self.height_speed_callback(height, speed)
+                if speed_raw == 0:
+                    self._planner.finish(height_raw)
+                if speed_raw != 0 or self._planner.is_within_tolerance(height_raw):
+                    self._finish_move(STOP_REASON_REACHED)
+                else:
+                    # The desk stopped before the target, at the end of its range or by the handset
+                    self._finish_move(STOP_REASON_STOPPED)
+            elif action == ACTION_RESEND:
+                asyncio.create_task(self._send_move_command())
+        elif self._planner.is_settling:
+            if speed_raw == 0:
+                self._planner.finish(height_raw)
+            else:
+                self._planner.settling(speed_raw, self._clock())
+        if self.height_speed_callback is not None:
+            self.height_speed_callback(height_raw, speed_raw)
 
     async def stop_movement(self):
         self._is_moving = False
         self._direction = None
-        await self.client.write_gatt_char(UUID_COMMAND, COMMAND_STOP)
+        self._finish_move(STOP_REASON_USER_OVERRIDE)
+        stop = self._queue.submit(None, UUID_COMMAND, COMMAND_STOP, priority=True)
         if not IS_WINDOWS:
             # Doesnt work on windows
-            await self.client.write_gatt_char(UUID_REFERENCE_INPUT, COMMAND_REFERENCE_INPUT_STOP)
+            stop_reference_input = self._queue.submit(None, UUID_REFERENCE_INPUT, COMMAND_REFERENCE_INPUT_STOP,
+                                                      priority=True)
+            await stop_reference_input
+        await stop
+
+    async def _write_command(self, uuid, command, key=None):
+        """Queue the command and wait until it is written, returns False if a later command replaced it"""
+        return await self._queue.submit(key, uuid, command)
+
+    async def _gatt_write(self, uuid, command):
+        self._commands_sent += 1
+        if self._recorder is not None:
+            self._recorder.record(KIND_REFERENCE_INPUT if uuid == UUID_REFERENCE_INPUT else KIND_COMMAND, command)
+        try:
+            with self.instrumentation.timed("write"):
+                await self.client.write_gatt_char(self._characteristic(uuid), command)
+        except BleakError as e:
+            if not is_stale_handle_error(e):
+                raise
+            self._invalidate_stale_characteristic(uuid)
+            await self.client.write_gatt_char(self._characteristic(uuid), command)
 
     async def _read_gatt_char(self):
-        return struct.unpack("<Hh", await self.client.read_gatt_char(UUID_HEIGHT))
+        return HEIGHT_SPEED.unpack(await self.read_height_data())
 
-    def _has_reached_target(self, height):
-        # The notified height values seem a bit behind so try to stop before
-        # reaching the target value to prevent overshooting
-        return (abs(height - self._target_height) <= 10 * HEIGHT_TOLERANCE)
+    async def read_height_data(self):
+        """Read the height characteristic and return the data as it would be notified"""
+        try:
+            with self.instrumentation.timed("read"):
+                return await self.client.read_gatt_char(self._characteristic(UUID_HEIGHT))
+        except BleakError as e:
+            if not is_stale_handle_error(e):
+                raise
+            self._invalidate_stale_characteristic(UUID_HEIGHT)
+            return await self.client.read_gatt_char(self._characteristic(UUID_HEIGHT))
+
+    def _invalidate_stale_characteristic(self, uuid):
+        """Drop a characteristic whose handle is no longer valid and resolve it again by uuid"""
+        LOGGER.warning(f"Stale GATT handle for {uuid} on {self.address}, resolving again")
+        self._characteristics.pop(uuid, None)
+
+    async def _read_desk_offset(self):
+        """Calibrate the lowest position from the desk, desks without the DPG characteristic keep the defaults"""
+        characteristic = self._characteristic(UUID_DPG)
+        if isinstance(characteristic, str):
+            return
+        try:
+            await self.client.write_gatt_char(characteristic, DPG_COMMAND_DESK_OFFSET, response=True)
+            data = await self.client.read_gatt_char(characteristic)
+        except BleakError as e:
+            LOGGER.debug(f"Could not read the desk offset of {self.address}: {e}")
+            return
+        if len(data) < 5 or data[0] != 0x01 or data[2] != 0x01:
+            LOGGER.debug(f"Desk {self.address} reports no offset: {bytes(data).hex()}")
+            return
+        offset_raw, = struct.unpack_from("<H", data, 3)
+        self.calibration.update(offset=offset_raw // 10, source=CALIBRATION_SOURCE_DESK)
+
+    def _reference_input_action(self, speed_raw):
+        """The desk decelerates to the reference input on its own, it is done once it stands still"""
+        if speed_raw != 0:
+            self._reference_input_supported = True
+            return ACTION_NONE
+        return ACTION_STOP if self._reference_input_supported else ACTION_NONE
+
+    def _move_active(self, generation):
+        """Return if the move started as the generation is still running, retargeting keeps the generation"""
+        return generation == self._move_generation and not self._move_done.done()
+
+    async def _move_with_reference_input(self, generation):
+        """Write the target height to the reference input until the desk arrives.
+        Falls back to pulse mode if the desk does not start moving"""
+        target = struct.pack("<H", self._target_height)
+        started = time.monotonic()
+        try:
+            await self._write_command(UUID_COMMAND, COMMAND_WAKEUP)
+            await self._write_command(UUID_COMMAND, COMMAND_STOP)
+            while self._move_active(generation) and self._move_mode == MOVE_MODE_REFERENCE_INPUT:
+                await self._write_command(UUID_REFERENCE_INPUT, target, key=COMMAND_KEY_REFERENCE_INPUT)
+                await asyncio.sleep(REFERENCE_INPUT_REFRESH_INTERVAL)
+                if (self._reference_input_supported is None
+                        and time.monotonic() - started > REFERENCE_INPUT_PROBE_TIMEOUT):
+                    # Notifications may have stalled, read the speed before giving up on the reference input
+                    self.process_height_data(await self.read_height_data())
+                    if not self._reference_input_supported:
+                        LOGGER.warning(f"Desk {self.address} does not follow the reference input, use pulse mode")
+                        break
+                target = struct.pack("<H", self._target_height)
+            else:
+                return
+        except BleakError as e:
+            LOGGER.warning(f"Reference input failed for {self.address}, use pulse mode: {e}")
+        if self._reference_input_supported is None:
+            self._reference_input_supported = False
+        if self._move_active(generation):
+            self._move_mode = MOVE_MODE_PULSE
+            await self._send_move_command()
+
+    async def _send_move_command(self):
+        if self._direction == "UP":
+            await self._move_up()
+        elif self._direction == "DOWN":
+            await self._move_down()
 
     async def _move_up(self):
-        await self.client.write_gatt_char(UUID_COMMAND, COMMAND_UP)
+        self._planner.command_sent(self._clock())
+        await self._write_command(UUID_COMMAND, COMMAND_UP, key=COMMAND_KEY_MOVE)
 
     async def _move_down(self):
-        await self.client.write_gatt_char(UUID_COMMAND, COMMAND_DOWN)
+        self._planner.command_sent(self._clock())
+        await self._write_command(UUID_COMMAND, COMMAND_DOWN, key=COMMAND_KEY_MOVE)
 
     async def _subscribe(self, client, uuid, callback):
-        """Listen for notifications on a characteristic"""
+        """Listen for notifications on a characteristic, return False if the subscription failed"""
         try:
-            await client.start_notify(uuid, callback)
-        except ValueError:
-            pass
+            await client.start_notify(self._characteristic(uuid, client), callback)
+        except ValueError as e:
+            LOGGER.warning(f"Could not subscribe to {uuid} of {self.address}: {e}")
+            return False
+        return True
+
+    async def resubscribe(self):
+        """Renew the height subscription and return if it succeeded"""
+        try:
+            await self._unsubscribe(UUID_HEIGHT)
+        except (BleakError, ValueError) as e:
+            LOGGER.debug(f"Could not unsubscribe from the height of {self.address}: {e}")
+        try:
+            return await self._subscribe(self.client, UUID_HEIGHT, self._notification_callback)
+        except BleakError as e:
+            LOGGER.debug(f"Could not subscribe to the height of {self.address}: {e}")
+            return False
 
     async def _unsubscribe(self, uuid):
         try:
-            await self.client.stop_notify(uuid)
+            await self.client.stop_notify(self._characteristic(uuid))
         except KeyError:
             # This happens on windows
             pass
 
-    def _unpickle_desk(self, address):
-        """Load a Bleak device config from a pickle file and check that it is the correct device"""
-        if IS_LINUX:
-            try:
-                with open(PICKLE_FILE, 'rb') as f:
-                    desk = pickle.load(f)
-                    if desk is not None and desk.address == address:
-                        return desk
-            except Exception:
-                pass
-        return None
-
-    def _pickle_desk(self, desk):
-        """Attempt to pickle the desk"""
-        if IS_LINUX and desk is not None:
-            with open(PICKLE_FILE, 'wb') as f:
-                pickle.dump(desk, f)
-
-    def _remove_pickled_desk(self):
-        """Attempt to pickle the desk"""
-        if IS_LINUX:
-            try:
-                os.remove(PICKLE_FILE)
-                LOGGER.debug('Desk pickle removed')
-            except OSError:
-                pass
-
     def _mm_to_raw(self, mm):
-        return (mm - MIN_HEIGHT) * 10
+        return self.calibration.mm_to_raw(mm)
 
     def _raw_to_mm(self, raw):
-        return (raw / 10) + MIN_HEIGHT
-
-    def _raw_to_speed(self, raw):
-        return (raw / 100)
+        return self.calibration.raw_to_mm(raw)
 
     def _format_height_speed(self, height, speed):
-        return int(self._raw_to_mm(height)), int(self._raw_to_speed(speed))
+        return self._raw_to_mm(height), speed_raw_to_mm(speed)
@@ -1,39 +1,48 @@
 # Based on ReachView code from Egor Fedorov (egor.fedorov@emlid.com) and @castis (https://gist.github.com/castis/0b7a162995d0b465ba9c84728e60ec01)
 
 
-import time
-import pexpect
-import logging
+import re
+import asyncio
+from .const import BLUETOOTHCTL_TIMEOUT, BLUETOOTHCTL_SCAN_TIME, LOGGER
 
-logger = logging.getLogger("btctl")
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*[A-Za-z]|[\x01\x02]")
 
 
-class Bluetoothctl:
-    """A wrapper for bluetoothctl utility."""
+class BluetoothctlError(Exception):
+    """Raised when a bluetoothctl command cannot be run or times out"""
 
-    def __init__(self):
-        self.process = pexpect.spawnu("bluetoothctl", echo=False)
 
-    def send(self, command, pause=0):
-        self.process.send(f"{command}\n")
-        time.sleep(pause)
-        if self.process.expect(["#", "not available", pexpect.EOF, pexpect.TIMEOUT]):
-            raise Exception(f"failed after {command}")
+class Bluetoothctl:
+    """An asyncio wrapper for bluetoothctl utility.
+    Every command runs as its own bluetoothctl process so the event loop is never blocked."""
 
-    def get_output(self, *args, **kwargs):
-        """Run a command in bluetoothctl prompt, return output as a list of lines."""
-        self.send(*args, **kwargs)
-        return self.process.before.split("\r\n")
+    def __init__(self, timeout=BLUETOOTHCTL_TIMEOUT):
+        self.timeout = timeout
 
-    def start_scan(self, pause):
-        """Start bluetooth scanning process."""
+    async def get_output(self, *args, timeout=None):
+        """Run a bluetoothctl command, return output as a list of lines."""
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "bluetoothctl", *args,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT)
+        except OSError as e:
+            raise BluetoothctlError(f"Cannot run bluetoothctl: {e}")
         try:
-            self.send("scan off")
-            time.sleep(2)
-            self.send("scan on")
-            time.sleep(pause)
-        except Exception as e:
-            logger.error(e)
+            stdout, _ = await asyncio.wait_for(process.communicate(), timeout=timeout or self.timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise BluetoothctlError(f"failed after {' '.join(args)}")
+        return ANSI_ESCAPE.sub("", stdout.decode(errors="replace")).splitlines()
+
+    async def start_scan(self, pause=BLUETOOTHCTL_SCAN_TIME):
+        """Scan for pause seconds so BlueZ knows the nearby devices."""
+        try:
+            await self.get_output("--timeout", str(pause), "scan", "on", timeout=pause + self.timeout)
+        except BluetoothctlError as e:
+            LOGGER.error(e)
 
     def parse_device_info(self, info_string):
         """Parse a string corresponding to a device."""
@@ -47,19 +56,23 @@ class Bluetoothctl:
             else:
                 if device_position > -1:
                     attribute_list = info_string[device_position:].split(" ", 2)
-                    device = {
-                        "mac_address": attribute_list[1],
-                        "name": attribute_list[2],
-                    }
+                    if len(attribute_list) == 3:
+                        device = {
+                            "mac_address": attribute_list[1],
+                            "name": attribute_list[2],
+                        }
         return device
 
-    def get_paired_devices(self):
-        """Return a list of tuples of paired devices."""
+    async def get_paired_devices(self):
+        """Return a list of paired devices."""
         paired_devices = []
         try:
-            out = self.get_output("paired-devices")
-        except Exception as e:
-            logger.error(e)
+            out = await self.get_output("paired-devices")
+            if any("Invalid command" in line for line in out):
+                # Newer BlueZ versions replaced paired-devices
+                out = await self.get_output("devices", "Paired")
+        except BluetoothctlError as e:
+            LOGGER.error(e)
         else:
             for line in out:
                 device = self.parse_device_info(line)
@@ -67,48 +80,37 @@ class Bluetoothctl:
                     paired_devices.append(device)
         return paired_devices
 
-    def pairing_process(self, mac_address, attempt=0):
+    async def pairing_process(self, mac_address):
         """Try to pair with a device by mac address."""
         try:
-            self.send(f"pair {mac_address}", 4)
-        except Exception as e:
-            logger.error(e)
+            out = await self.get_output("pair", mac_address)
+        except BluetoothctlError as e:
+            LOGGER.error(e)
             return False
-        else:
-            result_list = ["Failed to pair", "Pairing successful", "not available", pexpect.EOF]
-            result = self.process.expect(result_list)
-            print(f"Pairing result: {result_list[result]}")
-            return result == 1
-
-    def pair(self, mac_address):
-        print("Checking paired devices")
-        for device in self.get_paired_devices():
+        success = any("Pairing successful" in line or "AlreadyExists" in line for line in out)
+        LOGGER.debug(f"Pairing result for {mac_address}: {'success' if success else out[-1:]}")
+        return success
+
+    async def pair(self, mac_address):
+        LOGGER.debug("Checking paired devices")
+        for device in await self.get_paired_devices():
             if device["mac_address"] == mac_address:
-                print("Device already paired")
+                LOGGER.debug("Device already paired")
                 return True
 
-        print("Device is not paired yet! Start pairing")
-        self.start_scan(5)
+        LOGGER.debug("Device is not paired yet! Start pairing")
+        await self.start_scan()
         for attempt in range(3):
-            print(f"attempt {attempt}")
-            if self.pairing_process(mac_address, attempt):
+            LOGGER.debug(f"Pairing attempt {attempt}")
+            if await self.pairing_process(mac_address):
                 return True
         return False
 
-    def disconnect(self, mac_address):
+    async def disconnect(self, mac_address):
         """Try to disconnect to a device by mac address."""
         try:
-            self.send(f"disconnect {mac_address}", 2)
-        except Exception as e:
-            logger.error(e)
+            out = await self.get_output("disconnect", mac_address)
+        except BluetoothctlError as e:
+            LOGGER.error(e)
             return False
-        else:
-            res = self.process.expect(
-                ["Failed to disconnect", "Successful disconnected", pexpect.EOF]
-            )
-            return res == 1
-
-
-# ctl = Bluetoothctl()
-# success = ctl.pair("F4:E5:29:13:6A:3C")
-# print(f"SUCCESS: {success}")
+        return any("Successful disconnected" in line for line in out)
@@ -0,0 +1,71 @@
+"""Platform for button entity."""
+from homeassistant.components.button import ButtonEntity
+from .const import DOMAIN, PRESET_SIT
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant
+from homeassistant.exceptions import HomeAssistantError
+from homeassistant.helpers.entity_platform import AddEntitiesCallback
+
+
+async def async_setup_entry(hass: HomeAssistant,
+                            config_entry: ConfigEntry,
+                            async_add_entities: AddEntitiesCallback) -> None:
+    """Add a button per preset for passed config_entry in HA."""
+    controller = hass.data[DOMAIN][config_entry.entry_id]
+    async_add_entities([PresetButton(controller, name) for name in controller.presets.presets])
+
+
+class PresetButton(ButtonEntity):
+    """Moves the desk to a preset when pressed"""
+
+    should_poll = False
+
+    def __init__(self, controller, preset) -> None:
+        """Initialize the button."""
+        self._controller = controller
+        self._preset = preset
+
+    async def async_added_to_hass(self) -> None:
+        """Run when this Entity has been added to HA."""
+        self._controller.register_callback(self.async_write_ha_state)
+
+    async def async_will_remove_from_hass(self) -> None:
+        """Entity being removed from hass."""
+        self._controller.remove_callback(self.async_write_ha_state)
+
+    @property
+    def device_info(self):
+        """Return information to link this entity with the correct device."""
+        return {"identifiers": {(DOMAIN, self._controller.address)}}
+
+    @property
+    def available(self) -> bool:
+        """Return True if the desk is connected and the preset is set."""
+        return self._controller.is_available and self._controller.presets.get(self._preset).is_set
+
+    @property
+    def unique_id(self):
+        """Return Unique ID string."""
+        return f"{self._controller.address}_preset_{self._preset}"
+
+    @property
+    def name(self):
+        """Return the name of the button."""
+        return f"{self._controller.name} {self._preset.capitalize()}"
+
+    @property
+    def icon(self) -> str:
+        """Return the icon of the button."""
+        return "mdi:human-handsdown" if self._preset == PRESET_SIT else "mdi:human-handsup"
+
+    @property
+    def extra_state_attributes(self):
+        """Return the height and the learned offsets of the preset."""
+        return self._controller.presets.get(self._preset).as_dict()
+
+    async def async_press(self) -> None:
+        """Move the desk to the preset."""
+        try:
+            await self._controller.move_to_preset(self._preset)
+        except (ValueError, ConnectionError) as e:
+            raise HomeAssistantError(str(e)) from e
@@ -0,0 +1,95 @@
+"""
+HeightCalibration converts between raw desk heights, mm and percentages for one desk
+"""
+
+from .const import (MIN_HEIGHT, MAX_HEIGHT, HEIGHT_TOLERANCE, CALIBRATION_SOURCE_DEFAULT,
+                    CALIBRATION_SOURCE_LEARNED, LOGGER)
+
+DEFAULT_MAX_RAW = (MAX_HEIGHT - MIN_HEIGHT) * 10
+
+
+def valid_max_raw(max_raw):
+    """The percentage conversion needs a range of at least 1mm"""
+    if max_raw < 10:
+        LOGGER.warning(f"Height range of {max_raw / 10}mm is too small, use the default range")
+        return DEFAULT_MAX_RAW
+    return max_raw
+
+
+class HeightCalibration:
+    """The desk reports its height in 0.1mm above its lowest position.
+    offset is the height of the lowest position in mm and max_raw the highest raw height.
+    Both come from the desk if it exposes them, are learned from the heights it reaches
+    or default to MIN_HEIGHT and MAX_HEIGHT. A range below 1mm falls back to the default range."""
+
+    def __init__(self, offset=MIN_HEIGHT, max_raw=DEFAULT_MAX_RAW,
+                 source=CALIBRATION_SOURCE_DEFAULT):
+        self.offset = offset
+        self.max_raw = valid_max_raw(max_raw)
+        self.source = source
+        self.change_callback = None
+        self._build()
+
+    @classmethod
+    def from_dict(cls, data):
+        if not data:
+            return cls()
+        return cls(data["offset"], data["max_raw"], data.get("source", CALIBRATION_SOURCE_DEFAULT))
+
+    def as_dict(self):
+        return {"offset": self.offset, "max_raw": self.max_raw, "source": self.source}
+
+    @property
+    def min_height(self):
+        return self.offset
+
+    @property
+    def max_height(self):
+        return self._max_height
+
+    def _build(self):
+        self._max_height = self.offset + self.max_raw // 10
+        self._percent_per_mm = 100 / (self._max_height - self.offset)
+        self._tolerance_low = self.offset + HEIGHT_TOLERANCE
+        self._tolerance_high = self._max_height - HEIGHT_TOLERANCE
+
+    def update(self, offset=None, max_raw=None, source=CALIBRATION_SOURCE_LEARNED):
+        """Change the limits and notify the change callback if they differ"""
+        offset = self.offset if offset is None else offset
+        max_raw = self.max_raw if max_raw is None else valid_max_raw(max_raw)
+        if (offset, max_raw) == (self.offset, self.max_raw):
+            return
+        LOGGER.debug(f"Calibration changed from {self.offset}mm + {self.max_raw / 10}mm "
+                     f"to {offset}mm + {max_raw / 10}mm ({source})")
+        self.offset = offset
+        self.max_raw = max_raw
+        self.source = source
+        self._build()
+        if self.change_callback is not None:
+            self.change_callback()
+
+    def observe(self, raw):
+        """Extend the range if the desk reached a height above the known maximum"""
+        if raw > self.max_raw:
+            self.update(max_raw=raw)
+
+    def raw_to_mm(self, raw):
+        return self.offset + raw // 10
+
+    def mm_to_raw(self, mm):
+        return int((mm - self.offset) * 10)
+
+    def clamp_mm(self, mm):
+        return min(max(mm, self.offset), self._max_height)
+
+    def mm_to_percentage(self, mm):
+        return (mm - self.offset) * self._percent_per_mm
+
+    def percentage_to_mm(self, percentage):
+        return self.clamp_mm(int(percentage / self._percent_per_mm + self.offset))
+
+    def is_highest(self, mm):
+        return mm > self._tolerance_high
+
+    def is_lowest(self, mm):
+        return mm < self._tolerance_low
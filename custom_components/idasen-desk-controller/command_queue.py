@@ -0,0 +1,108 @@
+"""
+CommandQueue serializes the GATT writes of one desk
+"""
+
+import asyncio
+from .const import LOGGER
+
+
+class CommandQueue:
+    """Writes one command at a time in submission order.
+    A pending command with the same key as a new one is replaced by it, the newest target wins.
+    Commands without a key are never merged. Priority commands, used for stop, drop every
+    pending command that is not a priority command and are written next.
+    Every submit returns a future with True once written and False if the command was dropped."""
+
+    def __init__(self, write):
+        self._write = write
+        self._pending = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._writing = False
+        self.submitted = 0
+        self.written = 0
+        self.merged = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def submit(self, key, uuid, data, priority=False):
+        future = asyncio.get_event_loop().create_future()
+        self.submitted += 1
+        if priority:
+            kept = [command for command in self._pending if command[4]]
+            if len(kept) < len(self._pending):
+                LOGGER.debug(f"Priority command drops {len(self._pending) - len(kept)} pending commands")
+            self._drop([command for command in self._pending if not command[4]])
+            self._pending = kept
+        elif key is not None:
+            for index, command in enumerate(self._pending):
+                if command[0] == key and not command[4]:
+                    self.merged += 1
+                    self._resolve(command[3], False)
+                    del self._pending[index]
+                    break
+        self._pending.append((key, uuid, data, future, priority))
+        self.max_depth = max(self.max_depth, len(self._pending))
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        return future
+
+    def clear(self):
+        """Drop every pending command"""
+        self._drop(self._pending)
+        self._pending = []
+
+    def close(self):
+        self.clear()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def drain(self):
+        """Wait until every pending command is written"""
+        while self._pending or self._writing:
+            await asyncio.sleep(0)
+
+    def _drop(self, commands):
+        for command in commands:
+            self.dropped += 1
+            self._resolve(command[3], False)
+
+    @staticmethod
+    def _resolve(future, result):
+        if not future.done():
+            future.set_result(result)
+
+    async def _run(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            key, uuid, data, future, priority = self._pending.pop(0)
+            self._writing = True
+            try:
+                await self._write(uuid, data)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            finally:
+                self._writing = False
+            self.written += 1
+            self._resolve(future, True)
+
+    def diagnostics(self):
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "submitted": self.submitted,
+            "written": self.written,
+            "merged": self.merged,
+            "dropped": self.dropped,
+        }
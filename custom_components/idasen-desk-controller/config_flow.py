@@ -4,19 +4,38 @@ Config Flow for Idasen Desk Controller Integration
 
 import voluptuous as vol
 from homeassistant import config_entries
-from .const import DOMAIN
-from .desk_control import DeskController
-import asyncio
+from homeassistant.core import callback
+from .const import (DOMAIN, CONF_CONNECTION_MODE, CONF_IDLE_TIMEOUT, CONNECTION_MODE_ALWAYS,
+                    CONNECTION_MODE_ON_DEMAND, DEFAULT_IDLE_TIMEOUT, LOGGER)
+from .desk_control import DeskController, hand_over_controller, is_desk_name, load_ble_stack, load_storage
+from .scanner import get_scanner
+from .instrumentation import get_instrumentation
+
+INSTRUMENTATION = get_instrumentation()
+
+
+def _is_desk(device):
+    return is_desk_name(device.name)
 
 
 class IdasenControllerConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
-    """Handle a Idasen Desk Controller config flow."""
+    """Handle a Idasen Desk Controller config flow.
+    Desks come from the shared scanner, which keeps running in the background, so desks that
+    already advertise are listed at once and new ones appear whenever the form is shown again.
+    The connection that validated the desk is handed over to the new entry."""
 
     def __init__(self):
         """Initialize flow."""
-        self._found_devices = None
-        self._id = None
-        self._controller = DeskController()
+        self._found_devices = {}
+        self._scanner = get_scanner()
+        self._scanner_acquired = False
+        self._controller = None
+
+    @staticmethod
+    @callback
+    def async_get_options_flow(config_entry):
+        """Return the options flow of the connection policy."""
+        return IdasenControllerOptionsFlow(config_entry)
 
     def _get_entry(self):
         data = {
@@ -28,17 +47,46 @@ class IdasenControllerConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
             data=data,
         )
 
-    async def _get_scanned_device_names(self):
-        self._found_devices = await self._controller.scan_devices()
+    def _update_found_devices(self):
+        """Return the names of the desks the scanner has seen recently"""
+        self._found_devices = {device.name: device.address
+                               for device in self._scanner.devices() if _is_desk(device)}
         return self._found_devices.keys()
 
+    async def _discover(self):
+        """Start the background scanner and wait until the first desk advertises"""
+        if not self._scanner_acquired:
+            # The scanner imports bleak, which blocks the event loop on the first import
+            await self.hass.async_add_executor_job(load_ble_stack)
+            self._scanner_acquired = await self._scanner.acquire()
+        if not self._scanner_acquired:
+            return self._update_found_devices()
+        with INSTRUMENTATION.timed("config_flow_discovery"):
+            await self._scanner.wait_for(_is_desk)
+        return self._update_found_devices()
+
+    async def _release(self):
+        """Release the scanner and drop a connection that was not handed over"""
+        if self._scanner_acquired:
+            self._scanner_acquired = False
+            await self._scanner.release()
+        if self._controller is not None:
+            controller, self._controller = self._controller, None
+            await controller.disconnect()
+
+    @callback
+    def async_remove(self):
+        """Clean up when the flow is aborted or abandoned."""
+        if self._scanner_acquired or self._controller is not None:
+            self.hass.async_create_task(self._release())
+
     async def async_step_user(self, user_input=None):
         """Invoked when a user initiates a flow via the user interface."""
         errors = {}
 
         if user_input is not None:
-            device_names = await self._get_scanned_device_names()
-            print(device_names)
+            device_names = await self._discover()
+            INSTRUMENTATION.event("config_flow_scan", "Found devices: %s", device_names)
             if len(device_names) > 0:
                 return await self.async_step_connection()
             errors["base"] = "no_devices_found"
@@ -51,25 +99,28 @@ class IdasenControllerConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
         errors = {}
 
         if user_input is not None:
-            self._controller.name = user_input.get("name")
-            self._controller.address = self._found_devices[self._controller.name]
-            self._controller.set_device(user_input.get("name"), self._found_devices[self._controller.name])
-            print(self._controller.name)
-            print(self._controller.address)
+            name = user_input.get("name")
+            address = self._found_devices[name]
+            await self.async_set_unique_id(address)
+            self._abort_if_unique_id_configured()
+            storage = await self.hass.async_add_executor_job(load_storage, self.hass.config.path(), address)
+            self._controller = DeskController(name, address, **storage)
+            INSTRUMENTATION.event("config_flow_connect", "Connect %s (%s)", name, address)
 
+            if not await self._controller.initial_device_setup():
+                LOGGER.warning(f"Pairing {address} failed, try connecting anyway")
             height, speed = await self._controller.get_device_state()
-            #print(f"HEIGHT: {height}")
-            if height is None:
-                self._controller.set_device(None, None)
-                errors["base"] = "invalid_device"
-            if not errors:
-                await self._controller.disconnect()
-                await asyncio.sleep(3)
-                await self.async_set_unique_id(self._controller.address)
-                self._abort_if_unique_id_configured()
-                return self._get_entry()
-            await self._get_scanned_device_names()
+            if height is not None:
+                hand_over_controller(self._controller)
+                entry = self._get_entry()
+                self._controller = None
+                await self._release()
+                return entry
+            errors["base"] = "invalid_device"
+            controller, self._controller = self._controller, None
+            await controller.disconnect()
 
+        self._update_found_devices()
         default_value = None
         if self._found_devices:
             default_value = list(self._found_devices.keys())[0]
@@ -79,3 +130,26 @@ class IdasenControllerConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
         })
 
         return self.async_show_form(step_id="connection", data_schema=data_schema, errors=errors)
+
+
+class IdasenControllerOptionsFlow(config_entries.OptionsFlow):
+    """Choose whether the desk stays connected or connects on demand."""
+
+    def __init__(self, config_entry):
+        """Initialize options flow."""
+        self.config_entry = config_entry
+
+    async def async_step_init(self, user_input=None):
+        if user_input is not None:
+            return self.async_create_entry(title="", data=user_input)
+
+        options = self.config_entry.options
+        data_schema = vol.Schema({
+                vol.Required(CONF_CONNECTION_MODE,
+                             default=options.get(CONF_CONNECTION_MODE, CONNECTION_MODE_ALWAYS)):
+                    vol.In([CONNECTION_MODE_ALWAYS, CONNECTION_MODE_ON_DEMAND]),
+                vol.Required(CONF_IDLE_TIMEOUT,
+                             default=options.get(CONF_IDLE_TIMEOUT, DEFAULT_IDLE_TIMEOUT)):
+                    vol.All(vol.Coerce(int), vol.Range(min=5)),
+        })
+        return self.async_show_form(step_id="init", data_schema=data_schema)
@@ -0,0 +1,114 @@
+"""
+ConnectionPolicy decides when the link to a desk is held
+"""
+
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from .const import CONNECTION_MODE_ALWAYS, CONNECTION_MODE_ON_DEMAND, DEFAULT_IDLE_TIMEOUT, LOGGER
+
+
+class ConnectionPolicy:
+    """Always-on desks keep the link up and reconnect when it drops.
+    On-demand desks connect when a command needs the link and disconnect once no command
+    used it for idle_timeout seconds, which frees the adapter slot in between."""
+
+    def __init__(self, ble_controller, instrumentation, mode=CONNECTION_MODE_ALWAYS,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.mode = mode
+        self.idle_timeout = idle_timeout
+        self.idle_disconnects = 0
+        self._ble_controller = ble_controller
+        self._instrumentation = instrumentation
+        self._users = 0
+        self._idle_handle = None
+        self._connected_since = None
+        self._connected_time = 0.0
+        self._started = time.monotonic()
+        self._ble_controller.reconnect_on_disconnect = not self.on_demand
+
+    @property
+    def on_demand(self):
+        return self.mode == CONNECTION_MODE_ON_DEMAND
+
+    def configure(self, mode, idle_timeout):
+        """Switch the policy, a desk that becomes on-demand disconnects once it is idle"""
+        if (mode, idle_timeout) == (self.mode, self.idle_timeout):
+            return
+        LOGGER.debug(f"Connection policy of {self._ble_controller.address}: {mode}, idle timeout {idle_timeout}s")
+        self.mode = mode
+        self.idle_timeout = idle_timeout
+        self._ble_controller.reconnect_on_disconnect = not self.on_demand
+        self._cancel_idle()
+        if not self.on_demand and not self._ble_controller.is_connected:
+            asyncio.create_task(self._ble_controller.ensure_connected())
+        self._schedule_idle()
+
+    @asynccontextmanager
+    async def use(self):
+        """Hold the link while the block runs, connecting first if needed.
+        Raises ConnectionError if an on-demand desk cannot be connected"""
+        self._cancel_idle()
+        self._users += 1
+        try:
+            if self.on_demand and not self._ble_controller.is_connected:
+                with self._instrumentation.timed("connect_on_demand"):
+                    connected = await self._ble_controller.ensure_connected()
+                if not connected:
+                    raise ConnectionError(f"Could not connect to desk {self._ble_controller.address}")
+            yield
+        finally:
+            self._users -= 1
+            self._schedule_idle()
+
+    def connection_changed(self):
+        """Track how long the desk holds an adapter slot"""
+        if not self._ble_controller.is_connected:
+            self.disconnected()
+        elif self._connected_since is None:
+            self._connected_since = time.monotonic()
+
+    def _schedule_idle(self):
+        if not self.on_demand or self._users > 0:
+            return
+        self._cancel_idle()
+        loop = asyncio.get_event_loop()
+        self._idle_handle = loop.call_later(self.idle_timeout,
+                                            lambda: asyncio.create_task(self._idle_disconnect()))
+
+    def _cancel_idle(self):
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+
+    async def _idle_disconnect(self):
+        self._idle_handle = None
+        if self._users > 0 or not self._ble_controller.is_connected:
+            return
+        LOGGER.debug(f"Desk {self._ble_controller.address} idle for {self.idle_timeout}s, disconnect")
+        self.idle_disconnects += 1
+        await self._ble_controller.release_connection()
+        self.disconnected()
+
+    def disconnected(self):
+        if self._connected_since is not None:
+            self._connected_time += time.monotonic() - self._connected_since
+            self._connected_since = None
+
+    def close(self):
+        self._cancel_idle()
+        self.disconnected()
+
+    def diagnostics(self):
+        """Return the mode and how much of the time the desk held an adapter slot"""
+        connected_time = self._connected_time
+        if self._connected_since is not None:
+            connected_time += time.monotonic() - self._connected_since
+        elapsed = time.monotonic() - self._started
+        return {
+            "mode": self.mode,
+            "idle_timeout": self.idle_timeout,
+            "idle_disconnects": self.idle_disconnects,
+            "slot_seconds": connected_time,
+            "slot_usage": connected_time / elapsed if elapsed > 0 else None,
+        }
@@ -6,12 +6,116 @@ import logging
 
 LOGGER = logging.getLogger(__package__)
 DOMAIN = 'idasen-desk-controller'
-PLATFORMS = ["cover", "sensor", "switch"]
+PLATFORMS = ["button", "cover", "sensor", "switch"]
 
+# Height range of desks without calibration
 MIN_HEIGHT = 620
 MAX_HEIGHT = 1270  # 6500
 HEIGHT_TOLERANCE = 2.0
-ADAPTER_NAME = 'hci0'
+ADAPTER_NAMES = ['hci0']
+ADAPTER_NAME = ADAPTER_NAMES[0]
+ADAPTER_SYSFS_PATH = '/sys/class/bluetooth'
+MAX_CONNECTIONS_PER_ADAPTER = 5
 SCAN_TIMEOUT = 5
+SCANNER_DEVICE_MAX_AGE = 60
+HANDOVER_TIMEOUT = 120
 CONNECTION_TIMEOUT = 20
+BLUETOOTHCTL_TIMEOUT = 30
+BLUETOOTHCTL_SCAN_TIME = 5
 MOVEMENT_TIMEOUT = 30
+RECONNECT_BACKOFF_BASE = 2
+RECONNECT_BACKOFF_MAX = 300
+SETTLE_TIMEOUT = 1.5
+PUBLISH_MIN_INTERVAL = 0.25
+MOTION_MAX_EXTRAPOLATION = 0.5
+TRACE_CHUNK_RECORDS = 256
+TRACE_FILE = 'idasen_desk_trace_{address}.bin'
+
+# Height history, heights in mm and times in seconds
+HISTORY_FILE = 'idasen_desk_history_{address}.bin'
+HISTORY_BUFFER_SIZE = 4096
+HISTORY_COMPACT_INTERVAL = 300
+HISTORY_MIN_DELTA = 5
+HISTORY_DAYS = 7
+HISTORY_MAX_SIZE = 256 * 1024
+DEFAULT_STANDING_HEIGHT = 950
+STATISTICS_UPDATE_INTERVAL = 60
+
+# Notification watchdog, intervals in seconds
+WATCHDOG_STALL_TIMEOUT = 2.0
+WATCHDOG_MOVING_CHECK_INTERVAL = 0.1
+WATCHDOG_IDLE_CHECK_INTERVAL = 60
+WATCHDOG_POLL_MOVING_INTERVAL = 0.1
+WATCHDOG_POLL_IDLE_INTERVAL = 5
+WATCHDOG_RESUBSCRIBE_INTERVAL = 30
+
+# Connection policy, stored in the config entry options
+CONF_CONNECTION_MODE = 'connection_mode'
+CONF_IDLE_TIMEOUT = 'idle_timeout'
+CONNECTION_MODE_ALWAYS = 'always'
+CONNECTION_MODE_ON_DEMAND = 'on_demand'
+DEFAULT_IDLE_TIMEOUT = 60
+
+# Calibration, stored in the config entry
+CONF_CALIBRATION = 'calibration'
+CALIBRATION_SOURCE_DEFAULT = 'default'
+CALIBRATION_SOURCE_DESK = 'desk'
+CALIBRATION_SOURCE_LEARNED = 'learned'
+CALIBRATION_TOP_RAW = 8000
+SERVICE_CALIBRATE = 'calibrate'
+SERVICE_START_RECORDING = 'start_recording'
+SERVICE_STOP_RECORDING = 'stop_recording'
+
+# Desk groups
+CONF_GROUPS = 'groups'
+GROUP_ALL = 'all'
+GROUP_MAX_MOVES_PER_ADAPTER = 3
+SERVICE_MOVE_GROUP = 'move_group'
+SERVICE_STOP_GROUP = 'stop_group'
+ATTR_GROUP = 'group'
+
+# Height presets in mm, offsets in 0.1mm
+PRESET_SIT = 'sit'
+PRESET_STAND = 'stand'
+PRESET_CUSTOM = 'custom'
+PRESET_DEFAULT_HEIGHTS = {PRESET_SIT: 720, PRESET_STAND: 1100, PRESET_CUSTOM: None}
+PRESET_LEARNING_RATE = 0.5
+PRESET_MAX_OFFSET = 200
+SERVICE_MOVE_TO_PRESET = 'move_to_preset'
+SERVICE_SET_PRESET = 'set_preset'
+ATTR_PRESET = 'preset'
+ATTR_HEIGHT = 'height'
+
+# Instrumentation, timing histogram bounds in seconds
+TIMING_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+NOTIFICATION_LOG_SAMPLE = 8
+
+DEVICE_CACHE_FILE = 'idasen_desk_cache.json'
+DEVICE_CACHE_VERSION = 1
+DEVICE_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+DEVICE_CACHE_SAVE_DELAY = 1
+# Fields that only describe how the desk was last connected
+DEVICE_CACHE_CONNECTION_FIELDS = ('adapter', 'path', 'rssi', 'last_connect')
+
+# Motion planning, heights in 0.1mm and time in seconds
+MOTOR_RUN_TIME = 1.0
+COMMAND_RESEND_MARGIN = 0.5
+NOTIFICATION_LATENCY = 0.06
+MAX_STOP_LATENCY = 0.5
+DEFAULT_DECELERATION = 3000
+MIN_DECELERATION = 500
+MAX_DECELERATION = 20000
+PLANNER_LEARNING_RATE = 0.3
+
+# Movement via the reference input characteristic
+MOVE_MODE_REFERENCE_INPUT = "reference_input"
+MOVE_MODE_PULSE = "pulse"
+REFERENCE_INPUT_REFRESH_INTERVAL = 0.5
+REFERENCE_INPUT_PROBE_TIMEOUT = 1.5
+
+STOP_REASON_REACHED = "reached"
+STOP_REASON_USER_OVERRIDE = "user_override"
+STOP_REASON_TIMEOUT = "timeout"
+STOP_REASON_DISCONNECT = "disconnect"
+STOP_REASON_SUPERSEDED = "superseded"
+STOP_REASON_STOPPED = "stopped"
@@ -2,14 +2,21 @@
 
 from typing import Any
 
+import voluptuous as vol
+
 from homeassistant.components.cover import (ATTR_POSITION, SUPPORT_CLOSE,
                                             SUPPORT_OPEN, SUPPORT_SET_POSITION,
                                             SUPPORT_STOP, CoverEntity)
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.core import HomeAssistant
+from homeassistant.exceptions import HomeAssistantError
+from homeassistant.helpers import config_validation as cv, entity_platform
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 
-from .const import DOMAIN
+from .const import (DOMAIN, ATTR_GROUP, ATTR_PRESET, ATTR_HEIGHT, PRESET_DEFAULT_HEIGHTS, TRACE_FILE,
+                    SERVICE_MOVE_TO_PRESET, SERVICE_SET_PRESET, SERVICE_CALIBRATE,
+                    SERVICE_START_RECORDING, SERVICE_STOP_RECORDING)
+from .desk_group import get_fleet
 
 
 async def async_setup_entry(hass: HomeAssistant,
@@ -20,6 +27,36 @@ async def async_setup_entry(hass: HomeAssistant,
     controller = hass.data[DOMAIN][config_entry.entry_id]
     async_add_entities([DeskCover(controller)])
 
+    platform = entity_platform.async_get_current_platform()
+    platform.async_register_entity_service(
+        SERVICE_MOVE_TO_PRESET,
+        {vol.Required(ATTR_PRESET): vol.In(list(PRESET_DEFAULT_HEIGHTS))},
+        "async_move_to_preset",
+    )
+    platform.async_register_entity_service(
+        SERVICE_SET_PRESET,
+        {
+            vol.Required(ATTR_PRESET): vol.In(list(PRESET_DEFAULT_HEIGHTS)),
+            vol.Optional(ATTR_HEIGHT): cv.positive_int,
+        },
+        "async_set_preset",
+    )
+    platform.async_register_entity_service(SERVICE_CALIBRATE, {}, "async_calibrate")
+    platform.async_register_entity_service(SERVICE_START_RECORDING, {}, "async_start_recording")
+    platform.async_register_entity_service(SERVICE_STOP_RECORDING, {}, "async_stop_recording")
+
+
+async def async_setup_platform(hass: HomeAssistant,
+                               config,
+                               async_add_entities: AddEntitiesCallback,
+                               discovery_info=None
+                               ) -> None:
+    """Add the cover of a desk group, loaded through discovery by the integration."""
+    if discovery_info is None:
+        return
+    fleet = get_fleet()
+    async_add_entities([DeskGroupCover(fleet, fleet.groups[discovery_info[ATTR_GROUP]])])
+
 
 class DeskCover(CoverEntity):
     """Representation of the desk as a cover"""
@@ -63,7 +100,7 @@ class DeskCover(CoverEntity):
     @property
     def available(self) -> bool:
         """Return True if desk is available."""
-        return self._controller.is_connected
+        return self._controller.is_available
 
     @property
     def icon(self) -> str:
@@ -92,17 +129,155 @@ class DeskCover(CoverEntity):
 
     async def async_stop_cover(self, **kwargs):
         """Stop the cover."""
-        print("stop cover")
+        self._controller.instrumentation.event("stop_cover", "Stop cover")
         await self._controller.stop_movement()
 
     async def async_open_cover(self, **kwargs: Any) -> None:
         """Open the cover."""
-        await self._controller.move_to_position(100)
+        await self._move_to_position(100)
 
     async def async_close_cover(self, **kwargs: Any) -> None:
         """Close the cover."""
-        await self._controller.move_to_position(0)
+        await self._move_to_position(0)
 
     async def async_set_cover_position(self, **kwargs: Any) -> None:
         """Close the cover."""
-        await self._controller.move_to_position(kwargs[ATTR_POSITION])
+        await self._move_to_position(kwargs[ATTR_POSITION])
+
+    async def _move_to_position(self, percentage):
+        try:
+            await self._controller.move_to_position(percentage)
+        except ConnectionError as e:
+            raise HomeAssistantError(str(e)) from e
+
+    @property
+    def extra_state_attributes(self):
+        """Return the heights of the presets."""
+        attributes = {f"preset_{name}": preset.height for name, preset in self._controller.presets.presets.items()}
+        calibration = self._controller.calibration
+        attributes["min_height"] = calibration.min_height
+        attributes["max_height"] = calibration.max_height
+        attributes["calibration"] = calibration.source
+        return attributes
+
+    async def async_move_to_preset(self, preset: str) -> None:
+        """Move the desk to the preset."""
+        try:
+            await self._controller.move_to_preset(preset)
+        except (ValueError, ConnectionError) as e:
+            raise HomeAssistantError(str(e)) from e
+
+    async def async_set_preset(self, preset: str, height: int = None) -> None:
+        """Store the height, or the current height, as the preset."""
+        try:
+            self._controller.set_preset(preset, height)
+        except ValueError as e:
+            raise HomeAssistantError(str(e)) from e
+
+    async def async_calibrate(self) -> None:
+        """Learn the height range by driving the desk to its highest position."""
+        try:
+            await self._controller.calibrate()
+        except (ValueError, ConnectionError) as e:
+            raise HomeAssistantError(str(e)) from e
+
+    async def async_start_recording(self) -> None:
+        """Record a height trace of the desk into the config directory."""
+        path = self.hass.config.path(TRACE_FILE.format(address=self._controller.address.replace(":", "")))
+        try:
+            self._controller.start_recording(path)
+        except (OSError, ValueError) as e:
+            raise HomeAssistantError(f"Could not record to {path}: {e}") from e
+
+    async def async_stop_recording(self) -> None:
+        """Stop recording the height trace."""
+        self._controller.stop_recording()
+
+
+class DeskGroupCover(CoverEntity):
+    """Representation of a group of desks that move together as a cover"""
+
+    should_poll = False
+    supported_features = SUPPORT_SET_POSITION | SUPPORT_OPEN | SUPPORT_CLOSE | SUPPORT_STOP
+
+    def __init__(self, fleet, group) -> None:
+        """Initialize the cover."""
+        self._fleet = fleet
+        self._group = group
+
+    async def async_added_to_hass(self) -> None:
+        """Run when this Entity has been added to HA."""
+        self._fleet.register_callback(self.async_write_ha_state)
+
+    async def async_will_remove_from_hass(self) -> None:
+        """Entity being removed from hass."""
+        self._fleet.remove_callback(self.async_write_ha_state)
+
+    @property
+    def unique_id(self) -> str:
+        """Return Unique ID string."""
+        return f"group_{self._group.name}_cover"
+
+    @property
+    def name(self) -> str:
+        """Return the name of the group."""
+        return f"Desk group {self._group.name}"
+
+    @property
+    def available(self) -> bool:
+        """Return True if any desk of the group is available."""
+        return self._group.is_available
+
+    @property
+    def icon(self) -> str:
+        """Return the icon of the cover."""
+        return "mdi:desk"
+
+    @property
+    def current_cover_position(self):
+        """Return the mean position of the desks."""
+        return self._group.height_percentage
+
+    @property
+    def is_closed(self) -> bool:
+        """Return if all desks are on their lowest position."""
+        return all(controller.is_on_lowest for controller in self._group.controllers)
+
+    @property
+    def is_closing(self) -> bool:
+        """Return if the desks are closing or not."""
+        return self._group.speed < 0
+
+    @property
+    def is_opening(self) -> bool:
+        """Return if the desks are opening or not."""
+        return self._group.speed > 0
+
+    @property
+    def extra_state_attributes(self):
+        """Return the desks of the group and the progress of the running move."""
+        attributes = {
+            "desks": [controller.name for controller in self._group.controllers],
+            "progress": self._group.progress,
+        }
+        result = self._group.last_result
+        if result is not None:
+            attributes["last_move_duration"] = round(result.duration, 2)
+            attributes["last_move_reached"] = result.reached
+        return attributes
+
+    async def async_stop_cover(self, **kwargs):
+        """Stop all desks of the group."""
+        await self._group.stop_movement()
+
+    async def async_open_cover(self, **kwargs: Any) -> None:
+        """Open the cover."""
+        await self._group.move_to_position(100)
+
+    async def async_close_cover(self, **kwargs: Any) -> None:
+        """Close the cover."""
+        await self._group.move_to_position(0)
+
+    async def async_set_cover_position(self, **kwargs: Any) -> None:
+        """Move all desks of the group to the position."""
+        await self._group.move_to_position(kwargs[ATTR_POSITION])
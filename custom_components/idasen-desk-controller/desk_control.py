@@ -2,102 +2,363 @@
 DeskController handles Home Assistant communication
 """
 
-from .ble_control import BLEController
-from .const import HEIGHT_TOLERANCE, MIN_HEIGHT, MAX_HEIGHT, LOGGER
+import os
+import asyncio
+import time
+from dataclasses import replace
+from .instrumentation import Instrumentation
+from .device_cache import get_device_cache
+from .presets import PresetStore
+from .calibration import HeightCalibration
+from .connection_policy import ConnectionPolicy
+from .height_history import HeightHistory
+from .height_decoder import speed_raw_to_mm
+from .motion_model import MotionModel
+from .const import (DOMAIN, PUBLISH_MIN_INTERVAL, HANDOVER_TIMEOUT, CONNECTION_MODE_ALWAYS, DEFAULT_IDLE_TIMEOUT,
+                    DEVICE_CACHE_FILE, HISTORY_FILE, PRESET_SIT, PRESET_STAND, CALIBRATION_TOP_RAW,
+                    CALIBRATION_SOURCE_LEARNED, STOP_REASON_REACHED, STOP_REASON_STOPPED, LOGGER)
 
 TASKTYPE_MONITORING = "MONITORING"
 TASKTYPE_MOVE = "MOVE"
 
 DESK_NAME = "desk"
 
+_HANDED_OVER = {}
+
+
+def _history_path(storage_dir, address):
+    return os.path.join(storage_dir, HISTORY_FILE.format(address=address.replace(":", "")))
+
+
+def load_ble_stack():
+    """Import the BLE stack, importing bleak runs bluetoothctl and blocks.
+    Setup and the config flow run this in the executor before the stack is used"""
+    from . import ble_control  # noqa: F401
+
+
+def load_storage(storage_dir, address):
+    """Read the device cache and the height history of the desk and load the BLE stack.
+    This blocks, setup runs it in the executor and passes the result to DeskController"""
+    load_ble_stack()
+    device_cache = get_device_cache(os.path.join(storage_dir, DEVICE_CACHE_FILE))
+    device_cache.load()
+    history = HeightHistory(_history_path(storage_dir, address))
+    history.load()
+    return {"device_cache": device_cache, "history": history}
+
 
 class DeskController:
 
-    def __init__(self, name=None, address=None):
-        """Initalize DeskController"""
+    def __init__(self, name=None, address=None, publish_interval=PUBLISH_MIN_INTERVAL,
+                 calibration=None, calibration_callback=None, connection_mode=CONNECTION_MODE_ALWAYS,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, history_path=None, storage_dir=None, history=None,
+                 **ble_options):
+        """Initalize DeskController, the device cache and the height history are kept in storage_dir.
+        Both are read here unless they are passed in, see load_storage"""
         LOGGER.debug("Init DeskController")
         self.name = name
         self.address = address
-        self.height = 0
-        self.speed = 0
+        self.publish_interval = publish_interval
+        self.updates_received = 0
+        self.updates_published = 0
+        self._last_published = None
+        self._pending_publish = None
         self._callbacks = set()
+        self.instrumentation = Instrumentation(address or DOMAIN)
+        self.calibration = HeightCalibration.from_dict(calibration)
+        self.calibration.change_callback = self._calibration_changed
+        self.calibration_callback = calibration_callback
+        self.motion = MotionModel(self.calibration)
+        if ble_options.get("device_cache") is None:
+            ble_options["device_cache"] = get_device_cache(
+                os.path.join(storage_dir, DEVICE_CACHE_FILE) if storage_dir else None)
+        self.device_cache = ble_options["device_cache"]
+        self.presets = PresetStore(self.device_cache, address, self.calibration)
+        if history is None:
+            if history_path is None and address and storage_dir:
+                history_path = _history_path(storage_dir, address)
+            history = HeightHistory(history_path)
+            history.load()
+        self.history = history
+        self.history.calibration = self.calibration
+        if self.history.last_height:
+            self.motion.height_raw = self.calibration.mm_to_raw(self.history.last_height)
+        self._update_standing_height()
+        self.setup_duration = None
+        self.startup_connect_duration = None
+        self._monitoring_task = None
+        self._monitoring_started = None
+        # The BLE stack, and with it bleak, is only loaded once a desk is used, load_storage imported it already
+        from .ble_control import BLEController
         self._ble_controller = BLEController(address=address,
                                              height_speed_callback=self.height_speed_callback,
-                                             connection_change_callback=self.publish_updates)
+                                             connection_change_callback=self._connection_changed,
+                                             instrumentation=self.instrumentation,
+                                             calibration=self.calibration,
+                                             **ble_options)
+        self.connection = ConnectionPolicy(self._ble_controller, self.instrumentation,
+                                           connection_mode, idle_timeout)
+
+    @property
+    def height_raw(self):
+        """Return the last notified raw height"""
+        return self.motion.height_raw
+
+    @property
+    def speed_raw(self):
+        return self.motion.speed_raw
+
+    @property
+    def height(self):
+        """Return the height in mm, 0 while it is unknown. Heights are kept raw and converted when read,
+        while the desk moves the height is extrapolated from the last notification"""
+        height_raw = self.motion.predict()
+        return 0 if height_raw is None else self.calibration.raw_to_mm(height_raw)
+
+    @property
+    def speed(self):
+        """Return the speed in mm/s"""
+        return speed_raw_to_mm(self.speed_raw)
 
     @property
     def height_percentage(self):
         """Return the height of the desk in percentage, it is used for the cover"""
-        return int(self.height-MIN_HEIGHT)/((MAX_HEIGHT-MIN_HEIGHT)/100)
+        return self.calibration.mm_to_percentage(self.height)
 
     @property
     def is_on_highest(self):
         """Return if the desk is on its highest position"""
-        return MAX_HEIGHT-self.height-HEIGHT_TOLERANCE < 0
+        return self.calibration.is_highest(self.height)
 
     @property
     def is_on_lowest(self):
         """Return if the desk is on its lowest position"""
-        return MIN_HEIGHT-self.height-HEIGHT_TOLERANCE < 0
+        return self.calibration.is_lowest(self.height)
 
     @property
     def is_connected(self):
         """Return if the desk is connected"""
         return self._ble_controller.is_connected
 
+    @property
+    def is_available(self):
+        """Return if the desk can take commands, on-demand desks connect when they get one"""
+        return self.is_connected or self.connection.on_demand
+
+    @property
+    def adapter(self):
+        """Return the bluetooth adapter the desk is connected through"""
+        return self._ble_controller.adapter
+
     def set_device(self, name, address):
         self.name = name
         self.address = address
+        self.instrumentation.name = address or DOMAIN
         self._ble_controller.address = address
+        self.presets.address = address
+        self.presets.load()
+
+    def height_speed_callback(self, height_raw, speed_raw):
+        """Callback for the BLEController with the raw height and speed"""
+        self.updates_received += 1
+        self.motion.update(height_raw, speed_raw)
+        self.history.record(height_raw, speed_raw)
+        self._schedule_height_publish()
+
+    def _schedule_height_publish(self):
+        """The resting height (speed 0) is published immediately.
+        While the desk moves the motion model is published every publish_interval,
+        independent of how bursty the notifications arrive"""
+        if not self.motion.is_moving:
+            self._cancel_pending_publish()
+            self._publish_height()
+        elif self._pending_publish is None:
+            self._publish_tick()
 
-    def height_speed_callback(self, height, speed):
-        """Callback for the BLEController"""
-        print(f"Height: {height}mm Speed: {speed}mm/s")
-        self.speed = speed
-        self.height = height
+    def _publish_tick(self):
+        self._pending_publish = None
+        self._publish_height()
+        if self.motion.is_moving:
+            loop = asyncio.get_event_loop()
+            self._pending_publish = loop.call_later(self.publish_interval, self._publish_tick)
+
+    def _publish_height(self):
+        """Publish the height and speed if they changed since the last publish"""
+        published = (self.height, self.speed)
+        if published == self._last_published:
+            return
+        self._last_published = published
+        self.updates_published += 1
         self.publish_updates()
 
+    def _cancel_pending_publish(self):
+        if self._pending_publish is not None:
+            self._pending_publish.cancel()
+            self._pending_publish = None
+
     async def scan_devices(self):
         """Scan devices"""
-        print("Start scanning")
+        self.instrumentation.event("scan_devices", "Start scanning")
         filtered_devices = {}
         devices = await self._ble_controller.scan()
         for name in devices:
-            if string_contains(name, DESK_NAME):
+            if is_desk_name(name):
                 filtered_devices[name] = devices[name]
         return filtered_devices
 
     async def initial_device_setup(self):
         """Pair device"""
+        return await self._ble_controller.pair_device()
 
     async def get_device_state(self):
         """Get desk state"""
-        print("Get status")
-        height, speed = await self._ble_controller.get_current_state()
-        self.height = height
-        self.speed = speed
+        self.instrumentation.event("get_device_state", "Get status")
+        async with self.connection.use():
+            height, speed = await self._ble_controller.get_current_state()
         return height, speed
 
     async def start_monitoring(self):
-        """Start monitoring the state characteristic and get initial values"""
-        await self._ble_controller.start_monitoring()
+        """Start monitoring the state characteristic and get initial values.
+        On-demand desks disconnect again once they are idle"""
+        async with self.connection.use():
+            await self._ble_controller.start_monitoring()
+
+    def start_background_monitoring(self):
+        """Connect without blocking the setup, entities are unavailable until the desk is connected.
+        The height of the last session is shown meanwhile"""
+        self._monitoring_task = asyncio.create_task(self._background_monitoring())
+
+    async def _background_monitoring(self):
+        self._monitoring_started = time.monotonic()
+        try:
+            await self.start_monitoring()
+        except Exception as e:
+            LOGGER.error(f"Could not start monitoring {self.address}: {e}")
+        finally:
+            self._monitoring_task = None
+        if not self.is_connected and not self.connection.on_demand:
+            # The reconnect supervisor keeps trying with backoff, on-demand desks connect with the next command
+            LOGGER.warning(f"Desk {self.address} is not reachable, keep connecting in the background")
+            self._ble_controller.reconnect_in_background()
 
     async def move_to_position(self, percentage):
-        """Move to percentage"""
-        height = int(percentage*((MAX_HEIGHT-MIN_HEIGHT)/100) + MIN_HEIGHT)
-        if height < MIN_HEIGHT:
-            height = MIN_HEIGHT
-        elif height > MAX_HEIGHT:
-            height = MAX_HEIGHT
-        await self._ble_controller.move_to_position(height)
+        """Move to percentage and return the MoveResult once the desk stopped"""
+        async with self.connection.use():
+            return await self._ble_controller.move_to_position(self.calibration.percentage_to_mm(percentage))
+
+    async def calibrate(self):
+        """Drive the desk to its highest position and use the height where it stops as the maximum"""
+        self.instrumentation.event("calibrate", "Calibrate height range")
+        async with self.connection.use():
+            result = await self._ble_controller.move_to_raw(CALIBRATION_TOP_RAW)
+        # Only a desk that stopped on its own is at its highest position
+        if result.height is None or result.reason not in (STOP_REASON_REACHED, STOP_REASON_STOPPED):
+            raise ValueError(f"Calibration did not finish: {result.reason}")
+        self.calibration.update(max_raw=self.calibration.mm_to_raw(result.height),
+                                source=CALIBRATION_SOURCE_LEARNED)
+        return self.calibration
+
+    def _update_standing_height(self):
+        """Heights above the middle between the sit and stand presets count as standing"""
+        sit, stand = self.presets.get(PRESET_SIT), self.presets.get(PRESET_STAND)
+        if sit.is_set and stand.is_set:
+            self.history.standing_height = (sit.height + stand.height) // 2
+        else:
+            self.history.standing_height = (self.calibration.min_height + self.calibration.max_height) // 2
+
+    def _calibration_changed(self):
+        self.presets.recalibrate()
+        self._update_standing_height()
+        if self.calibration_callback is not None:
+            self.calibration_callback(self.calibration.as_dict())
+        self.publish_updates()
+
+    async def move_to_preset(self, name):
+        """Move to the preset and return the MoveResult measured against the preset height.
+        The desk is aimed at the precomputed height for the direction, which is corrected after every move"""
+        preset = self.presets.get(name)
+        if preset is None or not preset.is_set:
+            raise ValueError(f"Preset {name} is not set")
+        direction = preset.direction(self.height)
+        async with self.connection.use():
+            result = await self._ble_controller.move_to_raw(preset.aim(direction))
+        result = replace(result, target=preset.height)
+        self.instrumentation.count(f"preset_{name}")
+        preset.learn(direction, result)
+        self.presets.save()
+        return result
+
+    def set_preset(self, name, height=None):
+        """Store the height in mm as the preset, the current height if no height is given"""
+        preset = self.presets.get(name)
+        if preset is None:
+            raise ValueError(f"Unknown preset {name}")
+        if height is None and not self.height:
+            raise ValueError("The height of the desk is unknown")
+        preset.set_height(self.height if height is None else height)
+        self.presets.save()
+        self._update_standing_height()
+        self.publish_updates()
 
     async def stop_movement(self):
-        """Stop movement"""
-        await self._ble_controller.stop_movement()
+        """Stop movement, a desk that is not connected does not move"""
+        if self.is_connected:
+            await self._ble_controller.stop_movement()
+
+    def start_recording(self, path):
+        """Record a binary height trace for offline tuning"""
+        self._ble_controller.start_recording(path)
+
+    def stop_recording(self):
+        """Stop recording the height trace"""
+        self._ble_controller.stop_recording()
 
     async def disconnect(self):
         """Disconnect the ble client"""
+        self._cancel_pending_publish()
+        if self._monitoring_task is not None:
+            self._monitoring_task.cancel()
+            self._monitoring_task = None
+        self.connection.close()
+        self.history.compact()
         await self._ble_controller.disconnect()
+        await self.history.async_flush()
+
+    def diagnostics(self):
+        """Return the state and metrics of the desk for the diagnostics download"""
+        return {
+            "name": self.name,
+            "address": self.address,
+            "height": self.height,
+            "speed": self.speed,
+            "connected": self.is_connected,
+            "updates_received": self.updates_received,
+            "updates_published": self.updates_published,
+            "calibration": self.calibration.as_dict(),
+            "presets": {name: preset.as_dict() for name, preset in self.presets.presets.items()},
+            "connection": self.connection.diagnostics(),
+            "motion": self.motion.diagnostics(),
+            "startup": {
+                "setup_duration": self.setup_duration,
+                "connect_duration": self.startup_connect_duration,
+            },
+            "history": self.history.diagnostics(),
+            "ble": self._ble_controller.diagnostics(),
+            "instrumentation": self.instrumentation.as_dict(),
+        }
+
+    def _connection_changed(self):
+        if not self.is_connected:
+            self.motion.stop()
+        elif self._monitoring_started is not None:
+            self.startup_connect_duration = time.monotonic() - self._monitoring_started
+            self._monitoring_started = None
+            self.instrumentation.observe("startup_connect", self.startup_connect_duration)
+            LOGGER.debug(f"Desk {self.address} connected {self.startup_connect_duration:.2f}s after setup")
+        self.connection.connection_changed()
+        # Entities follow the availability, the next height is published even if it did not change
+        self._last_published = None
+        self.publish_updates()
 
     #HOME ASSISTNAT Callbacks
     def register_callback(self, callback) -> None:
@@ -114,6 +375,38 @@ class DeskController:
             callback()
 
 
+def is_desk_name(name):
+    return string_contains(name, DESK_NAME)
+
+
+def hand_over_controller(controller):
+    """Keep the connected controller of a config flow for the setup of its entry.
+    It disconnects if no entry takes it over within HANDOVER_TIMEOUT seconds"""
+    previous = take_over_controller(controller.address)
+    if previous is not None and previous is not controller:
+        asyncio.create_task(previous.disconnect())
+    handle = asyncio.get_event_loop().call_later(HANDOVER_TIMEOUT, _expire_handover, controller)
+    _HANDED_OVER[controller.address] = (controller, handle)
+
+
+def take_over_controller(address):
+    """Return the controller a config flow handed over for the address, if any"""
+    entry = _HANDED_OVER.pop(address, None)
+    if entry is None:
+        return None
+    controller, handle = entry
+    handle.cancel()
+    return controller
+
+
+def _expire_handover(controller):
+    entry = _HANDED_OVER.get(controller.address)
+    if entry is not None and entry[0] is controller:
+        del _HANDED_OVER[controller.address]
+        LOGGER.debug(f"No entry took over {controller.address}, disconnect")
+        asyncio.create_task(controller.disconnect())
+
+
 def string_contains(str1, str2):
     if str1 is None or str2 is None:
         return False
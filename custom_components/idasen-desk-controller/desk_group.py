@@ -0,0 +1,182 @@
+"""
+DeskFleet keeps track of all desks and moves groups of them together
+"""
+
+import time
+import asyncio
+from dataclasses import dataclass, field
+from .const import GROUP_ALL, GROUP_MAX_MOVES_PER_ADAPTER, STOP_REASON_REACHED, LOGGER
+
+_FLEET = None
+
+
+def get_fleet():
+    """Return the fleet shared by all config entries"""
+    global _FLEET
+    if _FLEET is None:
+        _FLEET = DeskFleet()
+    return _FLEET
+
+
+@dataclass
+class GroupMoveResult:
+    """Outcome of a group move, results holds the MoveResult of every desk by address"""
+    group: str
+    target: float
+    duration: float
+    results: dict = field(default_factory=dict)
+
+    @property
+    def reached(self):
+        """Return if every desk reached the target"""
+        return all(result is not None and result.reason == STOP_REASON_REACHED
+                   for result in self.results.values())
+
+    @property
+    def max_error(self):
+        """Return the largest distance in mm between a desk and the target"""
+        errors = [abs(result.error) for result in self.results.values()
+                  if result is not None and result.error is not None]
+        return max(errors) if errors else None
+
+
+class DeskFleet:
+    """Registry of the desk controllers of all config entries and the configured groups.
+    Moves share one semaphore per adapter so a group never runs more than
+    max_moves_per_adapter moves on the same adapter at a time."""
+
+    def __init__(self, max_moves_per_adapter=GROUP_MAX_MOVES_PER_ADAPTER):
+        self.max_moves_per_adapter = max_moves_per_adapter
+        self.groups = {GROUP_ALL: DeskGroup(self, GROUP_ALL)}
+        self._controllers = {}
+        self._adapter_semaphores = {}
+        self._callbacks = set()
+
+    @property
+    def controllers(self):
+        return list(self._controllers.values())
+
+    def add(self, controller):
+        self._controllers[controller.address] = controller
+        controller.register_callback(self.publish_updates)
+        self.publish_updates()
+
+    def remove(self, controller):
+        if self._controllers.get(controller.address) is controller:
+            del self._controllers[controller.address]
+        controller.remove_callback(self.publish_updates)
+        self.publish_updates()
+
+    def get(self, address):
+        return self._controllers.get(address)
+
+    def set_group(self, name, addresses):
+        """Create or replace the group with the desks of the addresses"""
+        self.groups[name] = DeskGroup(self, name, addresses)
+        return self.groups[name]
+
+    def adapter_semaphore(self, adapter):
+        if adapter not in self._adapter_semaphores:
+            self._adapter_semaphores[adapter] = asyncio.Semaphore(self.max_moves_per_adapter)
+        return self._adapter_semaphores[adapter]
+
+    def register_callback(self, callback) -> None:
+        """Register callback, called when any desk changes state."""
+        self._callbacks.add(callback)
+
+    def remove_callback(self, callback) -> None:
+        """Remove previously registered callback."""
+        self._callbacks.discard(callback)
+
+    def publish_updates(self) -> None:
+        """Call all registered callbacks."""
+        for callback in self._callbacks:
+            callback()
+
+
+class DeskGroup:
+    """Desks that move together, addresses None means all desks of the fleet.
+    Desks that are added to the fleet later join the group automatically."""
+
+    def __init__(self, fleet, name, addresses=None):
+        self.name = name
+        self.addresses = None if addresses is None else list(addresses)
+        self.last_result = None
+        self._fleet = fleet
+        self._move_started = {}
+        self._target = None
+
+    @property
+    def controllers(self):
+        if self.addresses is None:
+            return self._fleet.controllers
+        return [controller for controller in map(self._fleet.get, self.addresses) if controller is not None]
+
+    @property
+    def is_available(self):
+        return any(controller.is_available for controller in self.controllers)
+
+    @property
+    def is_moving(self):
+        return self._target is not None
+
+    @property
+    def height_percentage(self):
+        """Return the mean height of the connected desks in percentage"""
+        heights = [controller.height_percentage for controller in self.controllers if controller.is_available]
+        return sum(heights) / len(heights) if heights else None
+
+    @property
+    def speed(self):
+        """Return the speed of the fastest desk, negative if it moves down"""
+        return max((controller.speed for controller in self.controllers), key=abs, default=0)
+
+    @property
+    def progress(self):
+        """Return the progress of the running move from 0 to 1, averaged over the desks"""
+        if self._target is None:
+            return None
+        progresses = []
+        for controller in self.controllers:
+            start = self._move_started.get(controller.address)
+            if start is None:
+                continue
+            target = controller.calibration.percentage_to_mm(self._target)
+            distance = abs(target - start)
+            if distance == 0:
+                progresses.append(1.0)
+            else:
+                progresses.append(min(max(1 - abs(target - controller.height) / distance, 0.0), 1.0))
+        return sum(progresses) / len(progresses) if progresses else None
+
+    async def move_to_position(self, percentage):
+        """Move all desks of the group to the percentage and return once the slowest desk stopped"""
+        controllers = self.controllers
+        started = time.monotonic()
+        self._target = percentage
+        self._move_started = {controller.address: controller.height for controller in controllers}
+        LOGGER.debug(f"Move group {self.name} with {len(controllers)} desks to {percentage}%")
+        try:
+            results = await asyncio.gather(*[self._move_desk(controller, percentage)
+                                             for controller in controllers])
+        finally:
+            self._target = None
+            self._fleet.publish_updates()
+        self.last_result = GroupMoveResult(group=self.name,
+                                           target=percentage,
+                                           duration=time.monotonic() - started,
+                                           results=dict(zip(self._move_started, results)))
+        LOGGER.debug(f"Move of group {self.name} finished: {self.last_result}")
+        return self.last_result
+
+    async def _move_desk(self, controller, percentage):
+        async with self._fleet.adapter_semaphore(controller.adapter):
+            try:
+                return await controller.move_to_position(percentage)
+            except Exception as e:
+                LOGGER.error(f"Moving {controller.address} of group {self.name} failed: {e}")
+                return None
+
+    async def stop_movement(self):
+        await asyncio.gather(*[controller.stop_movement() for controller in self.controllers
+                               if controller.is_connected])
@@ -0,0 +1,126 @@
+"""
+DeviceCache stores connection details of known desks
+"""
+
+import os
+import json
+import time
+import asyncio
+import threading
+from .const import (DEVICE_CACHE_CONNECTION_FIELDS, DEVICE_CACHE_VERSION, DEVICE_CACHE_MAX_AGE, DEVICE_CACHE_SAVE_DELAY,
+                    LOGGER)
+
+_CACHES = {}
+
+
+def get_device_cache(path=None):
+    """Return the cache for the path, all controllers share one instance per file.
+    Without a path the cache is only kept in memory"""
+    if path not in _CACHES:
+        _CACHES[path] = DeviceCache(path)
+    return _CACHES[path]
+
+
+class DeviceCache:
+    """JSON file with one entry per desk address.
+    An entry holds the adapter the desk was found on, its BlueZ object path, name and last RSSI,
+    the time of the last successful connect and the learned motion and preset details.
+    The GATT services are resolved on every connect, only the scan is skipped.
+    A failed or outdated connection only removes the connection details, never the presets.
+    Changes are written DEVICE_CACHE_SAVE_DELAY seconds later in the executor, so a burst of
+    updates while connecting or moving writes the file once."""
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = None
+        self._save_handle = None
+        self._write_lock = threading.Lock()
+
+    def get(self, address):
+        """Return the entry for the address or None if it is missing.
+        Connection details older than DEVICE_CACHE_MAX_AGE are dropped, the rest of the entry is kept"""
+        entries = self._load()
+        entry = entries.get(address)
+        if entry is None:
+            return None
+        if "last_connect" in entry and time.time() - entry["last_connect"] > DEVICE_CACHE_MAX_AGE:
+            LOGGER.debug(f"Connection details of {address} are stale")
+            self.invalidate(address)
+        return entry
+
+    def update(self, address, **fields):
+        """Merge the fields into the entry of the address and write the cache"""
+        entries = self._load()
+        entry = entries.setdefault(address, {"address": address})
+        entry.update(fields)
+        self._save()
+
+    def invalidate(self, address):
+        """Forget how the desk was connected, presets and learned motion data stay"""
+        entry = self._load().get(address)
+        if entry is None:
+            return
+        removed = [entry.pop(field) for field in DEVICE_CACHE_CONNECTION_FIELDS if field in entry]
+        if removed:
+            LOGGER.debug(f"Connection details of {address} removed")
+            self._save()
+
+    def load(self):
+        """Read the file, setup calls this in the executor before the first desk uses the cache"""
+        self._load()
+
+    def _load(self):
+        if self._entries is not None:
+            return self._entries
+        self._entries = {}
+        if self.path is None:
+            return self._entries
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return self._entries
+        if not isinstance(data, dict) or not isinstance(data.get("devices"), dict):
+            LOGGER.warning(f"Ignoring malformed device cache {self.path}")
+            return self._entries
+        if data.get("version") != DEVICE_CACHE_VERSION:
+            LOGGER.debug(f"Ignoring device cache with version {data.get('version')}")
+            return self._entries
+        self._entries = {address: entry for address, entry in data["devices"].items() if isinstance(entry, dict)}
+        return self._entries
+
+    def _save(self):
+        if self.path is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(self._serialize())
+            return
+        if self._save_handle is None:
+            self._save_handle = loop.call_later(DEVICE_CACHE_SAVE_DELAY, self._save_later, loop)
+
+    def _save_later(self, loop):
+        self._save_handle = None
+        loop.run_in_executor(None, self._write, self._serialize())
+
+    async def async_flush(self):
+        """Write pending changes now, unloading a desk calls this"""
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+            await asyncio.get_running_loop().run_in_executor(None, self._write, self._serialize())
+
+    def _serialize(self):
+        return json.dumps({"version": DEVICE_CACHE_VERSION, "devices": self._entries}, indent=1)
+
+    def _write(self, data):
+        """Write to a temporary file first so a crash never leaves a truncated cache"""
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with self._write_lock:
+                with open(tmp_path, 'w') as f:
+                    f.write(data)
+                os.replace(tmp_path, self.path)
+        except OSError as e:
+            LOGGER.warning(f"Could not write device cache {self.path}: {e}")
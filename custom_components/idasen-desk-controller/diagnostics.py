@@ -0,0 +1,20 @@
+"""Diagnostics support for Idasen Desk Controller."""
+from __future__ import annotations
+
+from typing import Any
+
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant
+
+from .const import DOMAIN
+from .instrumentation import get_instrumentation
+
+
+async def async_get_config_entry_diagnostics(hass: HomeAssistant,
+                                             entry: ConfigEntry) -> dict[str, Any]:
+    """Return diagnostics for a config entry."""
+    controller = hass.data[DOMAIN][entry.entry_id]
+    return {
+        "desk": controller.diagnostics(),
+        "integration": get_instrumentation().as_dict(),
+    }
@@ -0,0 +1,17 @@
+"""
+Decoding of the height characteristic, it runs for every notification
+"""
+
+import struct
+
+# Height in 0.1mm above the lowest position and speed in 0.01mm/s, little endian
+HEIGHT_SPEED = struct.Struct("<Hh")
+
+decode_height_speed = HEIGHT_SPEED.unpack
+
+
+def speed_raw_to_mm(speed_raw):
+    """Convert the speed to whole mm/s with integer math, truncated towards zero"""
+    if speed_raw >= 0:
+        return speed_raw // 100
+    return -(-speed_raw // 100)
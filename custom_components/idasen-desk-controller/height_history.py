@@ -0,0 +1,270 @@
+"""
+HeightHistory keeps recent heights and daily usage statistics of a desk
+
+The time series file holds records of unix time u32 and height in mm u16, little endian.
+It keeps the records of the last HISTORY_DAYS days. The file is rewritten once its oldest record is a day
+past that or it grows beyond HISTORY_MAX_SIZE, then it keeps at most half of HISTORY_MAX_SIZE.
+"""
+
+import os
+import json
+import time
+import struct
+import asyncio
+from array import array
+from datetime import datetime, timedelta
+from dataclasses import dataclass, asdict
+from .calibration import HeightCalibration
+from .const import (HISTORY_BUFFER_SIZE, HISTORY_COMPACT_INTERVAL, HISTORY_DAYS, HISTORY_MAX_SIZE,
+                    HISTORY_MIN_DELTA, DEFAULT_STANDING_HEIGHT, LOGGER)
+
+HISTORY_RECORD = struct.Struct("<IH")
+
+
+@dataclass
+class DayStats:
+    """Seconds the desk spent below and above the standing height, posture changes and moves of one day"""
+    sitting: float = 0.0
+    standing: float = 0.0
+    transitions: int = 0
+    moves: int = 0
+    move_time: float = 0.0
+
+    @property
+    def average_move_duration(self):
+        return self.move_time / self.moves if self.moves else None
+
+
+class HeightHistory:
+    """Every update is O(1): it goes into a fixed size buffer and the statistics of the day
+    are advanced by the time since the previous update. The buffer is compacted into the time series
+    file every HISTORY_COMPACT_INTERVAL seconds, when it is full or when the desk comes to rest, keeping
+    only height changes of at least HISTORY_MIN_DELTA mm. Heights are recorded raw as they are notified and
+    converted to mm with the calibration when they are compacted. The daily statistics and the last height are
+    written next to it, the last height is restored as restored_height.
+    Files are written in the executor when an event loop runs, one write at a time so records stay in order."""
+
+    def __init__(self, path=None, capacity=HISTORY_BUFFER_SIZE, standing_height=DEFAULT_STANDING_HEIGHT,
+                 clock=time.time, calibration=None):
+        self.path = path
+        self.calibration = calibration or HeightCalibration()
+        self.standing_height = standing_height
+        self.days = {}
+        self.restored_height = None
+        self._clock = clock
+        self._capacity = capacity
+        self._times = array("d", bytes(8 * capacity))
+        self._heights = array("H", bytes(2 * capacity))
+        self._count = 0
+        self._last_time = None
+        self._last_height_raw = None
+        self._standing = None
+        self._move_started = None
+        self._written_height = None
+        self._last_compact = clock()
+        self._day_key = None
+        self._day_start = 0
+        self._day_end = 0
+        self._unwritten = bytearray()
+        self._stats_data = None
+        self._writing = None
+
+    @property
+    def standing_height(self):
+        return self._standing_height
+
+    @standing_height.setter
+    def standing_height(self, height):
+        """Set after every calibration change, so the raw threshold follows the calibration"""
+        self._standing_height = height
+        self._standing_raw = self.calibration.mm_to_raw(height)
+
+    def record(self, height_raw, speed, now=None):
+        now = self._clock() if now is None else now
+        if self._last_time is not None:
+            self._accumulate(self._last_time, now)
+        standing = height_raw >= self._standing_raw
+        if self._standing is not None and standing != self._standing:
+            self._day(now).transitions += 1
+        self._standing = standing
+        rested = False
+        if speed != 0:
+            if self._move_started is None:
+                self._move_started = now
+        elif self._move_started is not None:
+            day = self._day(now)
+            day.moves += 1
+            day.move_time += now - self._move_started
+            self._move_started = None
+            rested = True
+        self._last_time = now
+        self._last_height_raw = height_raw
+
+        self._times[self._count] = now
+        self._heights[self._count] = height_raw
+        self._count += 1
+        if rested or self._count == self._capacity or now - self._last_compact >= HISTORY_COMPACT_INTERVAL:
+            self.compact(now)
+
+    @property
+    def last_height(self):
+        """Return the last height in mm"""
+        if self._last_height_raw is None:
+            return self.restored_height
+        return self.calibration.raw_to_mm(self._last_height_raw)
+
+    def today(self, now=None):
+        """Return the statistics of today including the time since the last update"""
+        now = self._clock() if now is None else now
+        day = DayStats(**asdict(self._day(now)))
+        if self._last_time is not None and self._standing is not None:
+            elapsed = now - max(self._last_time, self._day_start)
+            if elapsed > 0:
+                if self._standing:
+                    day.standing += elapsed
+                else:
+                    day.sitting += elapsed
+        return day
+
+    def _day(self, timestamp):
+        if not self._day_start <= timestamp < self._day_end:
+            date = datetime.fromtimestamp(timestamp).date()
+            self._day_key = date.isoformat()
+            self._day_start = datetime.combine(date, datetime.min.time()).timestamp()
+            self._day_end = datetime.combine(date + timedelta(days=1), datetime.min.time()).timestamp()
+            if self._day_key not in self.days:
+                self.days[self._day_key] = DayStats()
+        return self.days[self._day_key]
+
+    def _accumulate(self, start, end):
+        """Add the time from start to end to the posture of the previous update, split at midnight"""
+        while start < end:
+            day = self._day(start)
+            segment_end = min(end, self._day_end)
+            if self._standing:
+                day.standing += segment_end - start
+            else:
+                day.sitting += segment_end - start
+            start = segment_end
+
+    def compact(self, now=None):
+        """Append the buffered height changes to the time series and store the daily statistics"""
+        now = self._clock() if now is None else now
+        data = bytearray()
+        raw_to_mm = self.calibration.raw_to_mm
+        for index in range(self._count):
+            height = raw_to_mm(self._heights[index])
+            if self._written_height is None or abs(height - self._written_height) >= HISTORY_MIN_DELTA:
+                data += HISTORY_RECORD.pack(int(self._times[index]), height)
+                self._written_height = height
+        self._count = 0
+        self._last_compact = now
+        self._prune(now)
+        if self.path is None:
+            return
+        self._unwritten += data
+        self._stats_data = json.dumps({"days": {key: asdict(day) for key, day in self.days.items()},
+                                       "last_height": self.last_height})
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._write(*self._take_pending())
+            return
+        if self._writing is None:
+            self._writing = loop.run_in_executor(None, self._write, *self._take_pending())
+            self._writing.add_done_callback(self._written)
+
+    def _take_pending(self):
+        data, stats = bytes(self._unwritten), self._stats_data
+        self._unwritten = bytearray()
+        self._stats_data = None
+        return data, stats
+
+    def _written(self, future):
+        """Start the next write if the buffer was compacted while the previous one ran"""
+        self._writing = None
+        if self._stats_data is not None:
+            self._writing = asyncio.get_running_loop().run_in_executor(None, self._write, *self._take_pending())
+            self._writing.add_done_callback(self._written)
+
+    async def async_flush(self):
+        """Wait until everything compacted so far is written"""
+        while self._writing is not None:
+            writing = self._writing
+            await asyncio.shield(writing)
+            if self._writing is writing:
+                # The write finished but its done callback, which starts the next write, did not run yet
+                await asyncio.sleep(0)
+
+    def _write(self, data, stats):
+        try:
+            if data:
+                with open(self.path, "ab") as f:
+                    f.write(data)
+                newest, _ = HISTORY_RECORD.unpack_from(data, len(data) - HISTORY_RECORD.size)
+                self._retain(newest)
+            tmp_path = f"{self._stats_path}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(stats)
+            os.replace(tmp_path, self._stats_path)
+        except OSError as e:
+            LOGGER.warning(f"Could not write height history {self.path}: {e}")
+
+    def _retain(self, newest):
+        """Rewrite the time series without the records that are too old or beyond the size limit.
+        Runs in the executor like every write, only the first record is read unless the file is rewritten"""
+        oldest = newest - HISTORY_DAYS * 86400
+        with open(self.path, "rb") as f:
+            first = f.read(HISTORY_RECORD.size)
+            if len(first) < HISTORY_RECORD.size:
+                return
+            if (HISTORY_RECORD.unpack(first)[0] >= oldest - 86400
+                    and os.path.getsize(self.path) <= HISTORY_MAX_SIZE):
+                return
+            data = first + f.read()
+        data = data[:len(data) - len(data) % HISTORY_RECORD.size]
+        # Keep whole records, the size limit keeps the newest ones
+        start = max(0, len(data) - HISTORY_MAX_SIZE // 2 // HISTORY_RECORD.size * HISTORY_RECORD.size)
+        while start < len(data) and HISTORY_RECORD.unpack_from(data, start)[0] < oldest:
+            start += HISTORY_RECORD.size
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data[start:])
+        os.replace(tmp_path, self.path)
+        LOGGER.debug(f"Height history {self.path} truncated to {(len(data) - start) // HISTORY_RECORD.size} records")
+
+    def _prune(self, now):
+        oldest = (datetime.fromtimestamp(now).date() - timedelta(days=HISTORY_DAYS)).isoformat()
+        for key in [key for key in self.days if key < oldest]:
+            del self.days[key]
+
+    @property
+    def _stats_path(self):
+        return f"{self.path}.json"
+
+    def load(self):
+        """Read the statistics and the last height, this blocks and belongs in the executor"""
+        if self.path is None:
+            return
+        try:
+            with open(self._stats_path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.days = {key: DayStats(**value) for key, value in data.get("days", {}).items()}
+        self.restored_height = data.get("last_height")
+
+    def diagnostics(self):
+        return {
+            "buffered": self._count,
+            "standing_height": self.standing_height,
+            "days": {key: asdict(day) for key, day in self.days.items()},
+        }
+
+
+def read_history(path):
+    """Yield the (unix time, height in mm) records of a time series file"""
+    with open(path, "rb") as f:
+        data = f.read()
+    for offset in range(0, len(data) - HISTORY_RECORD.size + 1, HISTORY_RECORD.size):
+        yield HISTORY_RECORD.unpack_from(data, offset)
@@ -0,0 +1,88 @@
+"""
+Instrumentation shared by all modules: debug events, counters and timing histograms
+"""
+
+import time
+import logging
+from contextlib import contextmanager
+from .const import DOMAIN, TIMING_BUCKETS, LOGGER
+
+_INSTRUMENTATIONS = {}
+
+
+def get_instrumentation(name=DOMAIN):
+    """Return the instrumentation with the name, components without a desk use the default one"""
+    if name not in _INSTRUMENTATIONS:
+        _INSTRUMENTATIONS[name] = Instrumentation(name)
+    return _INSTRUMENTATIONS[name]
+
+
+class Histogram:
+    """Counts observations per bucket, the last bucket takes everything above the largest bound"""
+
+    def __init__(self, buckets=TIMING_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def as_dict(self):
+        labels = [f"<={bound}" for bound in self.buckets] + [f">{self.buckets[-1]}"]
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "max": self.max,
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+class Instrumentation:
+    """Events are only formatted when debug logging is enabled.
+    Pass sample=N for events on hot paths to log only every Nth occurrence."""
+
+    def __init__(self, name):
+        self.name = name
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timed(self, name):
+        """Time the block and add it to the histogram of the operation"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started)
+
+    def event(self, name, message, *args, sample=1):
+        """Count the event and log it with lazy %-style formatting"""
+        count = self.counters.get(name, 0) + 1
+        self.counters[name] = count
+        if count % sample == 0 and LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug("[%s] " + message, self.name, *args)
+
+    def as_dict(self):
+        return {
+            "counters": dict(self.counters),
+            "timings": {name: histogram.as_dict() for name, histogram in self.histograms.items()},
+        }
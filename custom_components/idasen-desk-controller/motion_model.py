@@ -0,0 +1,60 @@
+"""
+MotionModel extrapolates the height of a moving desk between notifications
+"""
+
+import time
+from .const import MOTION_MAX_EXTRAPOLATION
+
+
+class MotionModel:
+    """Keeps the last raw height, speed and the time they arrived.
+    While the desk moves the height is extrapolated with the last speed, for at most
+    MOTION_MAX_EXTRAPOLATION seconds so a stalled notification stream does not run away,
+    and clamped to the calibrated range. Heights are in 0.1mm and speeds in 0.01mm/s.
+    Every sample that arrives while moving measures how far off the prediction was."""
+
+    def __init__(self, calibration, clock=time.monotonic):
+        self.height_raw = None
+        self.speed_raw = 0
+        self.timestamp = None
+        self.predictions = 0
+        self.max_error_raw = 0
+        self._error_total = 0
+        self._calibration = calibration
+        self._clock = clock
+
+    @property
+    def is_moving(self):
+        return self.speed_raw != 0
+
+    def update(self, height_raw, speed_raw, now=None):
+        now = self._clock() if now is None else now
+        if self.speed_raw and self.height_raw is not None:
+            error = abs(self.predict(now) - height_raw)
+            self.predictions += 1
+            self._error_total += error
+            if error > self.max_error_raw:
+                self.max_error_raw = error
+        self.height_raw = height_raw
+        self.speed_raw = speed_raw
+        self.timestamp = now
+
+    def stop(self):
+        """The desk is no longer followed, keep the last height"""
+        self.speed_raw = 0
+
+    def predict(self, now=None):
+        """Return the estimated raw height, the last height while the desk rests"""
+        if not self.speed_raw or self.height_raw is None:
+            return self.height_raw
+        now = self._clock() if now is None else now
+        elapsed = min(now - self.timestamp, MOTION_MAX_EXTRAPOLATION)
+        height_raw = self.height_raw + int(self.speed_raw * elapsed) // 10
+        return min(max(height_raw, 0), self._calibration.max_raw)
+
+    def diagnostics(self):
+        return {
+            "predictions": self.predictions,
+            "mean_error_mm": self._error_total / self.predictions / 10 if self.predictions else None,
+            "max_error_mm": self.max_error_raw / 10,
+        }
@@ -0,0 +1,113 @@
+"""
+MotionPlanner decides when to stop the desk and when to resend movement commands
+"""
+
+import time
+from .const import (HEIGHT_TOLERANCE, MOTOR_RUN_TIME, COMMAND_RESEND_MARGIN, NOTIFICATION_LATENCY, MAX_STOP_LATENCY,
+                    DEFAULT_DECELERATION, MIN_DECELERATION, MAX_DECELERATION, PLANNER_LEARNING_RATE, LOGGER)
+
+ACTION_NONE = "NONE"
+ACTION_RESEND = "RESEND"
+ACTION_STOP = "STOP"
+
+
+class MotionPlanner:
+    """Closed-loop planner working on raw desk units.
+    Heights are in 0.1mm and speeds in 0.01mm/s, as reported by the desk.
+    latency is the time from the measurement of a notified height until the desk acts on a stop
+    command sent in response to it. Both it and the deceleration are learned from how the desk
+    comes to rest after each stop: the deceleration from the notified speeds while braking,
+    the latency from the overshoot that braking does not explain."""
+
+    def __init__(self, latency=NOTIFICATION_LATENCY, deceleration=DEFAULT_DECELERATION):
+        self.latency = latency
+        self.deceleration = deceleration
+        self.completed_moves = 0
+        self.last_error = None
+        self._target = None
+        self._last_command_time = None
+        self._stop_height = None
+        self._stop_speed = None
+        self._braking = []
+
+    @property
+    def is_settling(self):
+        """Return if a stop was issued and the final height was not observed yet"""
+        return self._stop_height is not None
+
+    def start(self, target):
+        """Start planning a move towards the raw target height"""
+        self._target = target
+        self._last_command_time = None
+        self._stop_height = None
+        self._stop_speed = None
+        self._braking = []
+
+    def retarget(self, target):
+        """Change the target of the move in progress"""
+        self._target = target
+
+    def command_sent(self, now=None):
+        """Remember when the last movement command was written"""
+        self._last_command_time = time.monotonic() if now is None else now
+
+    def is_within_tolerance(self, height, target=None):
+        """Return if the height is close enough to the target, the target of the move by default"""
+        target = self._target if target is None else target
+        return abs(height - target) <= HEIGHT_TOLERANCE * 10
+
+    def predicted_stop_height(self, height, speed):
+        """Predict where the desk comes to rest if a stop is sent now"""
+        velocity = speed / 10
+        braking = velocity * abs(velocity) / (2 * self.deceleration)
+        return height + velocity * self.latency + braking
+
+    def update(self, height, speed, now=None):
+        """Process a height notification and return the action to take"""
+        now = time.monotonic() if now is None else now
+        predicted = self.predicted_stop_height(height, speed)
+        remaining = self._target - predicted
+        if speed < 0:
+            remaining = -remaining
+        if speed == 0 or remaining <= HEIGHT_TOLERANCE * 10:
+            self._stop_height = height
+            self._stop_speed = speed
+            return ACTION_STOP
+
+        # The motor keeps running for about MOTOR_RUN_TIME after each command and
+        # slows down if no new command arrives. Resend before that happens.
+        if (self._last_command_time is not None
+                and now - self._last_command_time >= MOTOR_RUN_TIME - COMMAND_RESEND_MARGIN - self.latency):
+            return ACTION_RESEND
+        return ACTION_NONE
+
+    def settling(self, speed, now=None):
+        """Process a notification that arrived after the stop, while the desk still moves"""
+        now = time.monotonic() if now is None else now
+        if self._stop_speed and abs(speed) < abs(self._stop_speed):
+            self._braking.append((now, abs(speed)))
+
+    def finish(self, final_height):
+        """Learn the deceleration and the latency from how the desk came to rest after the stop"""
+        if self._stop_height is None:
+            return
+        self.last_error = final_height - self._target
+        velocity = abs(self._stop_speed / 10)
+        if len(self._braking) >= 2:
+            (first_time, first_speed), (last_time, last_speed) = self._braking[0], self._braking[-1]
+            if last_time > first_time and first_speed > last_speed:
+                measured = (first_speed - last_speed) / 10 / (last_time - first_time)
+                measured = min(max(measured, MIN_DECELERATION), MAX_DECELERATION)
+                self.deceleration += PLANNER_LEARNING_RATE * (measured - self.deceleration)
+        if velocity > 0:
+            # The desk kept its speed for the latency and braked over the rest of the stopping distance
+            distance = abs(final_height - self._stop_height)
+            measured = (distance - velocity * velocity / (2 * self.deceleration)) / velocity
+            measured = min(max(measured, 0), MAX_STOP_LATENCY)
+            self.latency += PLANNER_LEARNING_RATE * (measured - self.latency)
+        self.completed_moves += 1
+        LOGGER.debug(f"Move finished with error {self.last_error}, "
+                     f"deceleration: {self.deceleration:.0f}, latency: {self.latency:.3f}s")
+        self._stop_height = None
+        self._stop_speed = None
+        self._braking = []
@@ -0,0 +1,128 @@
+"""
+NotificationWatchdog falls back to polling the height when notifications stall
+"""
+
+import time
+import asyncio
+from .height_decoder import decode_height_speed
+from .const import (WATCHDOG_STALL_TIMEOUT, WATCHDOG_MOVING_CHECK_INTERVAL, WATCHDOG_IDLE_CHECK_INTERVAL,
+                    WATCHDOG_POLL_MOVING_INTERVAL, WATCHDOG_POLL_IDLE_INTERVAL, WATCHDOG_RESUBSCRIBE_INTERVAL,
+                    LOGGER)
+
+
+class NotificationWatchdog:
+    """The desk only notifies while its height changes.
+    While it moves, silence longer than WATCHDOG_STALL_TIMEOUT is a stall. While it is idle the height
+    is read now and then, a height that differs from the last notification is a stall as well.
+    During a stall the height is polled, fast while moving and slow while idle, and the subscription
+    is renewed periodically. Polling ends with the first notification that arrives again."""
+
+    def __init__(self, ble_controller, instrumentation):
+        self.polling = False
+        self.stalls = 0
+        self.polls = 0
+        self.resubscribes = 0
+        self.last_stale_time = None
+        self._ble_controller = ble_controller
+        self._instrumentation = instrumentation
+        self._last_notification = time.monotonic()
+        self._last_resubscribe = None
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._last_notification = time.monotonic()
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.polling = False
+
+    def notification_received(self):
+        self._last_notification = time.monotonic()
+        if self.polling:
+            LOGGER.info(f"Height notifications of {self._ble_controller.address} restored")
+            self.polling = False
+
+    def move_started(self):
+        """The desk only notifies once it moves, silence is measured from the start of the move.
+        Wakes the idle loop so it checks at the moving interval"""
+        self._last_notification = time.monotonic()
+        self._wakeup.set()
+
+    def subscription_failed(self):
+        """Notifications cannot work at all, poll right away"""
+        self._stall(0)
+
+    def _stall(self, stale_time):
+        self.stalls += 1
+        self.last_stale_time = stale_time
+        self._instrumentation.count("notification_stalls")
+        self._instrumentation.observe("notification_stale", stale_time)
+        if not self.polling:
+            LOGGER.warning(f"Height notifications of {self._ble_controller.address} stalled "
+                           f"for {stale_time:.1f}s, poll the height")
+        self.polling = True
+        self._last_resubscribe = time.monotonic()
+
+    def _interval(self):
+        moving = self._ble_controller.is_moving
+        if self.polling:
+            return WATCHDOG_POLL_MOVING_INTERVAL if moving else WATCHDOG_POLL_IDLE_INTERVAL
+        return WATCHDOG_MOVING_CHECK_INTERVAL if moving else WATCHDOG_IDLE_CHECK_INTERVAL
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._interval())
+                self._wakeup.clear()
+                continue
+            except asyncio.TimeoutError:
+                pass
+            if not self._ble_controller.is_connected:
+                continue
+            try:
+                if self.polling:
+                    await self._poll()
+                else:
+                    await self._check()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                LOGGER.debug(f"Watchdog of {self._ble_controller.address} failed: {e}")
+
+    async def _check(self):
+        silence = time.monotonic() - self._last_notification
+        if self._ble_controller.is_moving:
+            if silence > WATCHDOG_STALL_TIMEOUT:
+                self._stall(silence)
+            return
+        last_height = self._ble_controller.last_height_raw
+        data = await self._ble_controller.read_height_data()
+        height_raw, speed_raw = decode_height_speed(data)
+        if last_height is not None and height_raw != last_height:
+            self._stall(silence)
+            self._ble_controller.process_height_data(data)
+
+    async def _poll(self):
+        self.polls += 1
+        self._instrumentation.count("notification_polls")
+        data = await self._ble_controller.read_height_data()
+        self._ble_controller.process_height_data(data)
+        if time.monotonic() - self._last_resubscribe >= WATCHDOG_RESUBSCRIBE_INTERVAL:
+            self._last_resubscribe = time.monotonic()
+            self.resubscribes += 1
+            await self._ble_controller.resubscribe()
+
+    def diagnostics(self):
+        return {
+            "polling": self.polling,
+            "stalls": self.stalls,
+            "polls": self.polls,
+            "resubscribes": self.resubscribes,
+            "last_stale_time": self.last_stale_time,
+            "seconds_since_notification": time.monotonic() - self._last_notification,
+        }
@@ -0,0 +1,99 @@
+"""
+Named height presets with a learned stop offset per direction
+"""
+
+from dataclasses import dataclass, field
+from .calibration import HeightCalibration
+from .const import PRESET_DEFAULT_HEIGHTS, PRESET_LEARNING_RATE, PRESET_MAX_OFFSET, STOP_REASON_REACHED, LOGGER
+
+DIRECTION_UP = "up"
+DIRECTION_DOWN = "down"
+
+
+@dataclass
+class Preset:
+    """A named height in mm. offsets holds the correction in 0.1mm the desk is aimed at
+    on top of the height, one per direction because the desk overshoots differently up and down"""
+    name: str
+    height: int = None
+    offsets: dict = field(default_factory=dict)
+    calibration: HeightCalibration = field(default_factory=HeightCalibration, repr=False, compare=False)
+
+    def __post_init__(self):
+        self._aims = {}
+        self.update_aims()
+
+    @property
+    def is_set(self):
+        return self.height is not None
+
+    @property
+    def raw_height(self):
+        return self.calibration.mm_to_raw(self.height)
+
+    def direction(self, height):
+        """Return the direction a desk at the height in mm moves to reach the preset"""
+        return DIRECTION_UP if self.height > height else DIRECTION_DOWN
+
+    def aim(self, direction):
+        """Return the precomputed raw height the desk is sent to for the direction"""
+        return self._aims[direction]
+
+    def learn(self, direction, result):
+        """Shift the offset of the direction against the final error of a finished move"""
+        if result.reason != STOP_REASON_REACHED or result.height is None:
+            return
+        error = (result.height - self.height) * 10
+        offset = self.offsets.get(direction, 0) - PRESET_LEARNING_RATE * error
+        self.offsets[direction] = round(min(max(offset, -PRESET_MAX_OFFSET), PRESET_MAX_OFFSET))
+        self.update_aims()
+        LOGGER.debug(f"Preset {self.name} missed by {error / 10:.1f}mm moving {direction}, "
+                     f"offset: {self.offsets[direction] / 10:.1f}mm")
+
+    def set_height(self, height):
+        """Move the preset, the learned offsets are kept"""
+        self.height = self.calibration.clamp_mm(int(height))
+        self.update_aims()
+
+    def update_aims(self):
+        if self.height is None:
+            self._aims = {}
+            return
+        max_raw = self.calibration.max_raw
+        self._aims = {direction: min(max(self.raw_height + self.offsets.get(direction, 0), 0), max_raw)
+                      for direction in (DIRECTION_UP, DIRECTION_DOWN)}
+
+    def as_dict(self):
+        return {"height": self.height, "offsets": dict(self.offsets)}
+
+
+class PresetStore:
+    """The presets of one desk, persisted in its entry of the device cache"""
+
+    def __init__(self, device_cache, address, calibration=None):
+        self._device_cache = device_cache
+        self.address = address
+        self.calibration = calibration or HeightCalibration()
+        self.presets = {}
+        self.load()
+
+    def load(self):
+        entry = self._device_cache.get(self.address) if self.address else None
+        stored = entry.get("presets", {}) if entry is not None else {}
+        self.presets = {}
+        for name, height in PRESET_DEFAULT_HEIGHTS.items():
+            data = stored.get(name, {"height": height})
+            self.presets[name] = Preset(name, data.get("height"), dict(data.get("offsets", {})), self.calibration)
+
+    def recalibrate(self):
+        """Recompute the raw heights the desk is aimed at after the calibration changed"""
+        for preset in self.presets.values():
+            preset.update_aims()
+
+    def get(self, name):
+        return self.presets.get(name)
+
+    def save(self):
+        if self.address:
+            self._device_cache.update(self.address,
+                                      presets={name: preset.as_dict() for name, preset in self.presets.items()})
@@ -0,0 +1,85 @@
+"""
+ReconnectSupervisor runs a single reconnect task per desk
+"""
+
+import time
+import random
+import asyncio
+from .const import RECONNECT_BACKOFF_BASE, RECONNECT_BACKOFF_MAX, LOGGER
+
+STATE_IDLE = "idle"
+STATE_CONNECTING = "connecting"
+STATE_BACKOFF = "backoff"
+STATE_CONNECTED = "connected"
+
+
+def backoff_delay(attempt, base=RECONNECT_BACKOFF_BASE, ceiling=RECONNECT_BACKOFF_MAX):
+    """Exponential backoff with jitter, the delay is between half and the full exponential value"""
+    delay = min(ceiling, base * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+class ReconnectSupervisor:
+    """Retries the connect callable with backoff until it succeeds.
+    Triggering while a reconnect is already running does not start another one."""
+
+    def __init__(self, connect):
+        self._connect = connect
+        self._task = None
+        self.state = STATE_IDLE
+        self.attempts = 0
+        self.total_attempts = 0
+        self.errors = 0
+        self.reconnects = 0
+        self.last_reconnect_duration = None
+
+    @property
+    def is_running(self):
+        return self._task is not None and not self._task.done()
+
+    def trigger(self):
+        """Start reconnecting unless a reconnect is already running"""
+        if self.is_running:
+            LOGGER.debug("Reconnect already running")
+            return
+        self._task = asyncio.create_task(self._run())
+
+    def cancel(self):
+        """Stop reconnecting"""
+        if self.is_running:
+            self._task.cancel()
+        self._task = None
+        self.state = STATE_IDLE
+
+    def connected(self):
+        self.state = STATE_CONNECTED
+
+    def disconnected(self):
+        if not self.is_running:
+            self.state = STATE_IDLE
+
+    async def _run(self):
+        started = time.monotonic()
+        self.attempts = 0
+        while True:
+            self.state = STATE_CONNECTING
+            self.attempts += 1
+            self.total_attempts += 1
+            try:
+                connected = await self._connect()
+            except Exception:
+                # Keep reconnecting, an unexpected error must not leave the desk disconnected for good
+                LOGGER.exception(f"Reconnect attempt {self.attempts} raised an unexpected error")
+                self.errors += 1
+                connected = False
+            if connected:
+                self.state = STATE_CONNECTED
+                self.reconnects += 1
+                self.last_reconnect_duration = time.monotonic() - started
+                LOGGER.debug(f"Reconnected after {self.attempts} attempts "
+                             f"in {self.last_reconnect_duration:.1f}s")
+                return
+            delay = backoff_delay(self.attempts - 1)
+            LOGGER.warning(f"Reconnect attempt {self.attempts} failed, retry in {delay:.1f}s")
+            self.state = STATE_BACKOFF
+            await asyncio.sleep(delay)
@@ -0,0 +1,152 @@
+"""
+SharedScanner runs one long running scanner per adapter
+bleak is imported when a scanner starts, so the config flow can list the scanner without loading it
+"""
+
+import time
+import asyncio
+from dataclasses import dataclass
+from .const import ADAPTER_NAME, SCAN_TIMEOUT, SCANNER_DEVICE_MAX_AGE, LOGGER
+
+_SCANNERS = {}
+
+
+def get_scanner(adapter=ADAPTER_NAME, scanner_factory=None):
+    """Return the shared scanner of the adapter, the factory is only used when it is created.
+    Without a factory BleakScanner is used"""
+    if adapter not in _SCANNERS:
+        _SCANNERS[adapter] = SharedScanner(adapter, scanner_factory)
+    return _SCANNERS[adapter]
+
+
+def replace_scanner(adapter, scanner_factory):
+    """Drop the shared scanner of the adapter and create a new one with the factory.
+    The benchmarks use this to scan a new simulated radio in every run"""
+    _SCANNERS.pop(adapter, None)
+    return get_scanner(adapter, scanner_factory)
+
+
+@dataclass
+class Advertisement:
+    """Latest advertisement of a device"""
+    device: object
+    rssi: int
+    last_seen: float
+
+
+class SharedScanner:
+    """Keeps a live address -> advertisement table for one adapter.
+    Controllers acquire the scanner while they need it, it stops when the last one releases it."""
+
+    def __init__(self, adapter, scanner_factory=None):
+        self.adapter = adapter
+        self._scanner_factory = scanner_factory
+        self.advertisements = {}
+        self._scanner = None
+        self._users = 0
+        self._started = None
+        self._waiters = {}
+        self._matchers = []
+
+    @property
+    def is_running(self):
+        return self._scanner is not None
+
+    async def acquire(self):
+        """Start scanning if this is the first user, return if the scanner is running"""
+        from bleak import BleakError
+        self._users += 1
+        if self._scanner is not None:
+            return True
+        LOGGER.debug(f"Start shared scanner on {self.adapter}")
+        if self._scanner_factory is None:
+            from bleak import BleakScanner
+            self._scanner_factory = BleakScanner
+        scanner = self._scanner_factory(device=self.adapter)
+        scanner.register_detection_callback(self._detection_callback)
+        try:
+            await scanner.start()
+        except BleakError as e:
+            LOGGER.error(f"Could not start scanner on {self.adapter}: {e}")
+            self._users -= 1
+            return False
+        self._scanner = scanner
+        self._started = time.monotonic()
+        return True
+
+    async def release(self):
+        """Stop scanning when the last user released the scanner"""
+        from bleak import BleakError
+        self._users = max(self._users - 1, 0)
+        if self._users > 0 or self._scanner is None:
+            return
+        LOGGER.debug(f"Stop shared scanner on {self.adapter}")
+        scanner = self._scanner
+        self._scanner = None
+        try:
+            await scanner.stop()
+        except BleakError as e:
+            LOGGER.warning(f"Could not stop scanner on {self.adapter}: {e}")
+
+    def devices(self, max_age=SCANNER_DEVICE_MAX_AGE):
+        """Return all devices seen within max_age seconds"""
+        now = time.monotonic()
+        return [advertisement.device for advertisement in self.advertisements.values()
+                if now - advertisement.last_seen <= max_age]
+
+    def get(self, address, max_age=SCANNER_DEVICE_MAX_AGE):
+        """Return the advertisement of the address if it was seen within max_age seconds"""
+        advertisement = self.advertisements.get(address)
+        if advertisement is None or time.monotonic() - advertisement.last_seen > max_age:
+            return None
+        return advertisement
+
+    async def wait_ready(self, timeout=SCAN_TIMEOUT):
+        """Wait until the scanner ran long enough to have seen all advertising devices"""
+        if self._started is None:
+            return
+        remaining = timeout - (time.monotonic() - self._started)
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+
+    async def find(self, address, timeout=SCAN_TIMEOUT):
+        """Return the device with the address, wait up to timeout seconds for its advertisement"""
+        advertisement = self.get(address)
+        if advertisement is not None:
+            return advertisement.device
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.setdefault(address, []).append(future)
+        try:
+            return await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiters = self._waiters.get(address, [])
+            if future in waiters:
+                waiters.remove(future)
+            if not waiters:
+                self._waiters.pop(address, None)
+
+    async def wait_for(self, predicate, timeout=SCAN_TIMEOUT):
+        """Return the first device the predicate accepts, without waiting if one was seen already"""
+        for device in self.devices():
+            if predicate(device):
+                return device
+        future = asyncio.get_event_loop().create_future()
+        matcher = (predicate, future)
+        self._matchers.append(matcher)
+        try:
+            return await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._matchers.remove(matcher)
+
+    def _detection_callback(self, device, advertisement_data=None):
+        self.advertisements[device.address] = Advertisement(device, device.rssi, time.monotonic())
+        for future in self._waiters.pop(device.address, []):
+            if not future.done():
+                future.set_result(device)
+        for predicate, future in self._matchers:
+            if not future.done() and predicate(device):
+                future.set_result(device)
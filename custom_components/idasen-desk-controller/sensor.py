@@ -1,7 +1,11 @@
 """Platform for sensor entity."""
 
+from datetime import timedelta
+
+from homeassistant.core import callback
 from homeassistant.helpers.entity import Entity
-from .const import DOMAIN
+from homeassistant.helpers.event import async_track_time_interval
+from .const import DOMAIN, STATISTICS_UPDATE_INTERVAL
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.core import HomeAssistant
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
@@ -13,7 +17,9 @@ async def async_setup_entry(hass: HomeAssistant,
                             ) -> None:
     """Add sensors for passed config_entry in HA."""
     controller = hass.data[DOMAIN][config_entry.entry_id]
-    async_add_entities([SpeedSensor(controller), HeightSensor(controller)])
+    async_add_entities([SpeedSensor(controller), HeightSensor(controller),
+                        SittingTimeSensor(controller), StandingTimeSensor(controller),
+                        TransitionsSensor(controller), MoveDurationSensor(controller)])
 
 
 class SensorBase(Entity):
@@ -33,7 +39,7 @@ class SensorBase(Entity):
     @property
     def available(self) -> bool:
         """Desk is available"""
-        return self._controller.is_connected
+        return self._controller.is_available
 
     async def async_added_to_hass(self):
         """Run when this Entity has been added to HA."""
@@ -100,3 +106,133 @@ class SpeedSensor(SensorBase):
     def unit_of_measurement(self):
         """Return the unit of measurement."""
         return "mm/s"
+
+
+class StatisticsSensorBase(SensorBase):
+    """Base of the daily usage statistics.
+    The statistics are kept up to date by the height history, the sensors only read today's
+    values once a minute and on desk updates. States are rounded so most writes change nothing."""
+
+    key = None
+    label = None
+
+    def __init__(self, controller):
+        """Initialize the sensor."""
+        super().__init__(controller)
+        self._remove_interval = None
+
+    @property
+    def unique_id(self):
+        """Return Unique ID string."""
+        return f"{self._controller.address}_{self.key}"
+
+    @property
+    def name(self):
+        """Return the name of the sensor."""
+        return f"{self._controller.name} {self.label}"
+
+    @property
+    def available(self) -> bool:
+        """Statistics are known while the desk is offline"""
+        return True
+
+    async def async_added_to_hass(self):
+        """Run when this Entity has been added to HA."""
+        await super().async_added_to_hass()
+        self._remove_interval = async_track_time_interval(
+            self.hass, self._interval_update, timedelta(seconds=STATISTICS_UPDATE_INTERVAL))
+
+    @callback
+    def _interval_update(self, now):
+        self.async_write_ha_state()
+
+    async def async_will_remove_from_hass(self):
+        """Entity being removed from hass."""
+        await super().async_will_remove_from_hass()
+        if self._remove_interval is not None:
+            self._remove_interval()
+            self._remove_interval = None
+
+
+class SittingTimeSensor(StatisticsSensorBase):
+    """Minutes the desk was at sitting height today"""
+
+    key = "sitting_time"
+    label = "Sitting Time Today"
+
+    @property
+    def state(self):
+        """Return the state of the sensor."""
+        return round(self._controller.history.today().sitting / 60)
+
+    @property
+    def icon(self) -> str:
+        """Return the icon of the sensor."""
+        return "mdi:chair-rolling"
+
+    @property
+    def unit_of_measurement(self):
+        """Return the unit of measurement."""
+        return "min"
+
+
+class StandingTimeSensor(StatisticsSensorBase):
+    """Minutes the desk was at standing height today"""
+
+    key = "standing_time"
+    label = "Standing Time Today"
+
+    @property
+    def state(self):
+        """Return the state of the sensor."""
+        return round(self._controller.history.today().standing / 60)
+
+    @property
+    def icon(self) -> str:
+        """Return the icon of the sensor."""
+        return "mdi:human-handsup"
+
+    @property
+    def unit_of_measurement(self):
+        """Return the unit of measurement."""
+        return "min"
+
+
+class TransitionsSensor(StatisticsSensorBase):
+    """Changes between sitting and standing today"""
+
+    key = "transitions"
+    label = "Transitions Today"
+
+    @property
+    def state(self):
+        """Return the state of the sensor."""
+        return self._controller.history.today().transitions
+
+    @property
+    def icon(self) -> str:
+        """Return the icon of the sensor."""
+        return "mdi:swap-vertical"
+
+
+class MoveDurationSensor(StatisticsSensorBase):
+    """Average duration of today's moves"""
+
+    key = "average_move_duration"
+    label = "Average Move Duration"
+
+    @property
+    def state(self):
+        """Return the state of the sensor."""
+        duration = self._controller.history.today().average_move_duration
+        return None if duration is None else round(duration, 1)
+
+    @property
+    def icon(self) -> str:
+        """Return the icon of the sensor."""
+        return "mdi:timer-outline"
+
+    @property
+    def unit_of_measurement(self):
+        """Return the unit of measurement."""
+        return "s"
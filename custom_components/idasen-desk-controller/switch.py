@@ -3,6 +3,7 @@ from homeassistant.components.switch import SwitchEntity
 from .const import DOMAIN
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.core import HomeAssistant
+from homeassistant.exceptions import HomeAssistantError
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 
 
@@ -65,4 +66,7 @@ class ConnectionSwitch(SwitchEntity):
 
     async def async_turn_on(self, **kwargs):
         """Turn the entity on."""
-        await self._controller.start_monitoring()
+        try:
+            await self._controller.start_monitoring()
+        except ConnectionError as e:
+            raise HomeAssistantError(str(e)) from e
@@ -0,0 +1,155 @@
+"""
+Binary height trace recorder and replay driver
+
+File layout, all values little endian:
+    header  "IDTR", version u16, reserved u16
+    chunk   record count u32, payload length u32, payload
+    record  kind u8, monotonic timestamp in ns i64, data length u8, data
+Chunks are only written complete, so a crash loses at most the records of the open chunk.
+"""
+
+import os
+import mmap
+import time
+import struct
+import asyncio
+from .const import TRACE_CHUNK_RECORDS, LOGGER
+
+TRACE_MAGIC = b"IDTR"
+TRACE_VERSION = 1
+
+HEADER_STRUCT = struct.Struct("<4sHH")
+CHUNK_STRUCT = struct.Struct("<II")
+RECORD_STRUCT = struct.Struct("<BqB")
+MOVE_STRUCT = struct.Struct("<HH")
+
+KIND_NOTIFICATION = 1
+KIND_COMMAND = 2
+KIND_REFERENCE_INPUT = 3
+KIND_MOVE = 4
+
+
+class TraceRecorder:
+    """Appends records to a trace file"""
+
+    def __init__(self, path, chunk_records=TRACE_CHUNK_RECORDS):
+        self.path = path
+        self.records = 0
+        self._chunk_records = chunk_records
+        self._buffer = bytearray()
+        self._count = 0
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        if not is_new:
+            _read_header(path)
+        self._file = open(path, "ab")
+        if is_new:
+            self._file.write(HEADER_STRUCT.pack(TRACE_MAGIC, TRACE_VERSION, 0))
+
+    def record(self, kind, data, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic_ns()
+        self._buffer += RECORD_STRUCT.pack(kind, timestamp, len(data))
+        self._buffer += data
+        self._count += 1
+        self.records += 1
+        if self._count >= self._chunk_records:
+            self.flush()
+
+    def flush(self):
+        """Write the open chunk"""
+        if self._count == 0:
+            return
+        self._file.write(CHUNK_STRUCT.pack(self._count, len(self._buffer)))
+        self._file.write(self._buffer)
+        self._file.flush()
+        self._buffer = bytearray()
+        self._count = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+class TraceReader:
+    """Iterates over (kind, timestamp, data) of a trace file through a memory map"""
+
+    def __init__(self, path):
+        self.path = path
+        _read_header(path)
+
+    def __iter__(self):
+        with open(self.path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offset = HEADER_STRUCT.size
+                while offset + CHUNK_STRUCT.size <= len(data):
+                    count, length = CHUNK_STRUCT.unpack_from(data, offset)
+                    offset += CHUNK_STRUCT.size
+                    end = offset + length
+                    if end > len(data):
+                        LOGGER.warning(f"Trace {self.path} ends with a truncated chunk")
+                        return
+                    while offset < end:
+                        kind, timestamp, size = RECORD_STRUCT.unpack_from(data, offset)
+                        offset += RECORD_STRUCT.size
+                        yield kind, timestamp, bytes(data[offset:offset + size])
+                        offset += size
+
+
+def _read_header(path):
+    with open(path, "rb") as f:
+        header = f.read(HEADER_STRUCT.size)
+    if len(header) < HEADER_STRUCT.size:
+        raise ValueError(f"{path} is not a height trace")
+    magic, version, _ = HEADER_STRUCT.unpack(header)
+    if magic != TRACE_MAGIC or version != TRACE_VERSION:
+        raise ValueError(f"{path} is not a height trace of version {TRACE_VERSION}")
+
+
+class ReplayClient:
+    """Stands in for the BleakClient during a replay and records the writes instead of moving a desk"""
+
+    def __init__(self, clock):
+        self.is_connected = True
+        self.services = None
+        self.writes = []
+        self.last_value = bytearray(4)
+        self._clock = clock
+
+    async def read_gatt_char(self, characteristic):
+        return self.last_value
+
+    async def write_gatt_char(self, characteristic, data, response=False):
+        self.writes.append((self._clock(), getattr(characteristic, "uuid", characteristic), bytes(data)))
+
+
+async def replay(path, controller, speed=1.0):
+    """Feed a recorded trace through the BLEController, speed > 1 replays faster than real time.
+    The controller sees trace time, so its planner behaves as it would have during the recording.
+    Returns the (time, uuid, data) writes the controller made in response."""
+    started = time.monotonic()
+    first_timestamp = None
+
+    def clock():
+        return (time.monotonic() - started) * speed
+
+    client = ReplayClient(clock)
+    previous_client, previous_clock, previous_recorder = controller.client, controller._clock, controller._recorder
+    controller.client, controller._clock, controller._recorder = client, clock, None
+    try:
+        for kind, timestamp, data in TraceReader(path):
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            delay = (timestamp - first_timestamp) / 1e9 - clock()
+            if delay > 0:
+                await asyncio.sleep(delay / speed)
+            if kind == KIND_NOTIFICATION:
+                client.last_value = bytearray(data)
+                controller._height_data_callback(None, bytearray(data))
+            elif kind == KIND_MOVE:
+                controller._replay_move(*MOVE_STRUCT.unpack(data))
+        # Let pending command tasks finish
+        await asyncio.sleep(0)
+        await controller._queue.drain()
+    finally:
+        controller.client, controller._clock, controller._recorder = previous_client, previous_clock, previous_recorder
+    return client.writes
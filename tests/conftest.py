@@ -0,0 +1,8 @@
+"""
+The tests import the integration like the benchmarks do, without Home Assistant
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
@@ -0,0 +1,42 @@
+import os
+from integration import load
+
+adapter_scheduler = load("adapter_scheduler")
+
+ADDRESSES = [f"F4:E5:29:00:00:{index:02X}" for index in range(6)]
+
+
+def test_desks_are_balanced_across_two_adapters():
+    scheduler = adapter_scheduler.AdapterScheduler(["hci0", "hci1"], max_connections=5,
+                                                   rssi_lookup=lambda adapter, address: -60)
+    for address in ADDRESSES:
+        scheduler.assign(address)
+
+    load = scheduler.load()
+    assert load["hci0"]["connections"] == 3
+    assert load["hci1"]["connections"] == 3
+
+
+def test_desk_fails_over_to_the_other_adapter():
+    seen = {"hci0": set(ADDRESSES), "hci1": set(ADDRESSES)}
+    scheduler = adapter_scheduler.AdapterScheduler(
+        ["hci0", "hci1"], max_connections=3,
+        rssi_lookup=lambda adapter, address: -60 if address in seen[adapter] else None)
+    for address in ADDRESSES[:3]:
+        scheduler.assign(address, preferred="hci0")
+    # The preferred adapter is full, the fourth desk has to use the other one
+    assert scheduler.assign(ADDRESSES[3], preferred="hci0") == "hci1"
+
+    # hci0 lost sight of a desk, it moves to the adapter that still sees it
+    seen["hci0"].discard(ADDRESSES[0])
+    assert scheduler.migrate(ADDRESSES[0]) == "hci1"
+    assert scheduler.connections("hci0") == 2
+    assert scheduler.connections("hci1") == 2
+    assert scheduler.migrations == 1
+
+
+def test_adapters_are_read_from_sysfs(tmp_path):
+    for name in ["hci1", "hci0", "hci0:64"]:
+        os.mkdir(tmp_path / name)
+    assert adapter_scheduler.find_adapters(str(tmp_path)) == ["hci0", "hci1"]
+    assert adapter_scheduler.find_adapters(str(tmp_path / "missing")) == ["hci0"]
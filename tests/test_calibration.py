@@ -0,0 +1,19 @@
+from integration import load
+
+calibration = load("calibration")
+
+
+def test_conversions_follow_the_range():
+    heights = calibration.HeightCalibration(offset=620, max_raw=6500)
+    assert heights.raw_to_mm(0) == 620
+    assert heights.raw_to_mm(6509) == 1270
+    assert heights.mm_to_percentage(945) == 50
+    assert heights.percentage_to_mm(100) == 1270
+
+
+def test_too_small_range_falls_back_to_the_default():
+    heights = calibration.HeightCalibration(offset=620, max_raw=5)
+    assert heights.max_raw == calibration.DEFAULT_MAX_RAW
+    heights.update(max_raw=0)
+    assert heights.max_raw == calibration.DEFAULT_MAX_RAW
+    assert heights.percentage_to_mm(0) == 620
@@ -0,0 +1,89 @@
+import asyncio
+from integration import load
+
+command_queue = load("command_queue")
+
+COMMAND = "command"
+REFERENCE = "reference"
+
+
+class GatedWriter:
+    """Records the writes, each write waits until the test releases it"""
+
+    def __init__(self):
+        self.written = []
+        self.release = None
+
+    async def write(self, uuid, data):
+        self.release = asyncio.get_event_loop().create_future()
+        await self.release
+        self.written.append((uuid, data))
+
+    async def write_all(self, queue):
+        while queue.depth or queue._writing:
+            await asyncio.sleep(0)
+            if self.release is not None and not self.release.done():
+                self.release.set_result(None)
+
+
+def run_queue(submit):
+    """Submit while the first command is being written, then write everything"""
+
+    async def run():
+        writer = GatedWriter()
+        queue = command_queue.CommandQueue(writer.write)
+        futures = [queue.submit(None, COMMAND, "first")]
+        await asyncio.sleep(0)
+        futures += submit(queue)
+        await writer.write_all(queue)
+        results = [await future for future in futures]
+        queue.close()
+        return writer.written, results, queue.diagnostics()
+
+    return asyncio.run(run())
+
+
+def test_commands_are_written_in_submission_order():
+    written, results, diagnostics = run_queue(lambda queue: [
+        queue.submit(None, COMMAND, "up"),
+        queue.submit("target", REFERENCE, 1000),
+        queue.submit(None, COMMAND, "wakeup"),
+    ])
+    assert written == [(COMMAND, "first"), (COMMAND, "up"), (REFERENCE, 1000), (COMMAND, "wakeup")]
+    assert results == [True] * 4
+    assert diagnostics["written"] == 4
+
+
+def test_newest_command_with_the_same_key_wins():
+    written, results, diagnostics = run_queue(lambda queue: [
+        queue.submit("target", REFERENCE, 1000),
+        queue.submit(None, COMMAND, "wakeup"),
+        queue.submit("target", REFERENCE, 1100),
+        queue.submit("target", REFERENCE, 1200),
+    ])
+    # The merged command takes the place of the newest one, behind the command submitted in between
+    assert written == [(COMMAND, "first"), (COMMAND, "wakeup"), (REFERENCE, 1200)]
+    assert results == [True, False, True, False, True]
+    assert diagnostics["merged"] == 2
+
+
+def test_stop_drops_pending_commands_and_goes_next():
+    written, results, diagnostics = run_queue(lambda queue: [
+        queue.submit(None, COMMAND, "up"),
+        queue.submit("target", REFERENCE, 1000),
+        queue.submit("stop", COMMAND, "stop", priority=True),
+        queue.submit(None, COMMAND, "down"),
+    ])
+    # The write in progress finishes, the stop overtakes everything that was pending
+    assert written == [(COMMAND, "first"), (COMMAND, "stop"), (COMMAND, "down")]
+    assert results == [True, False, False, True, True]
+    assert diagnostics["dropped"] == 2
+
+
+def test_priority_commands_are_kept():
+    written, results, _ = run_queue(lambda queue: [
+        queue.submit("stop", COMMAND, "stop", priority=True),
+        queue.submit("stop", REFERENCE, "stop", priority=True),
+    ])
+    assert written == [(COMMAND, "first"), (COMMAND, "stop"), (REFERENCE, "stop")]
+    assert results == [True, True, True]
@@ -0,0 +1,58 @@
+import json
+import asyncio
+from integration import load
+
+device_cache = load("device_cache")
+const = load("const")
+
+
+def test_malformed_cache_is_ignored(tmp_path):
+    path = tmp_path / "cache.json"
+    for data in ([1, 2], {"version": const.DEVICE_CACHE_VERSION, "devices": []}, "cache"):
+        path.write_text(json.dumps(data))
+        cache = device_cache.DeviceCache(str(path))
+        assert cache.get("F4:E5:29:00:00:01") is None
+
+
+def test_updates_are_written_once_after_the_delay(tmp_path):
+    path = tmp_path / "cache.json"
+
+    async def run():
+        cache = device_cache.DeviceCache(str(path))
+        for rssi in range(10):
+            cache.update("F4:E5:29:00:00:01", rssi=-60 - rssi, last_connect=0)
+        assert not path.exists()
+        await asyncio.sleep(const.DEVICE_CACHE_SAVE_DELAY + 0.2)
+
+    asyncio.run(run())
+    data = json.loads(path.read_text())
+    assert data["devices"]["F4:E5:29:00:00:01"]["rssi"] == -69
+
+
+def test_flush_writes_pending_changes(tmp_path):
+    path = tmp_path / "cache.json"
+
+    async def run():
+        cache = device_cache.DeviceCache(str(path))
+        cache.update("F4:E5:29:00:00:01", name="Desk 0001")
+        await cache.async_flush()
+
+    asyncio.run(run())
+    assert json.loads(path.read_text())["devices"]["F4:E5:29:00:00:01"]["name"] == "Desk 0001"
+
+
+def test_stale_connection_keeps_presets_and_learned_data():
+    cache = device_cache.DeviceCache(None)
+    cache.update("F4:E5:29:00:00:01", adapter="hci0", path="/org/bluez/hci0/dev_F4_E5_29_00_00_01", rssi=-60,
+                 last_connect=0, deceleration=800, presets={"sit": {"height": 720}})
+
+    entry = cache.get("F4:E5:29:00:00:01")
+    assert "path" not in entry and "adapter" not in entry and "last_connect" not in entry
+    assert entry["presets"] == {"sit": {"height": 720}}
+    assert entry["deceleration"] == 800
+
+
+def test_entry_without_connection_is_kept():
+    cache = device_cache.DeviceCache(None)
+    cache.update("F4:E5:29:00:00:01", presets={"stand": {"height": 1100}})
+    assert cache.get("F4:E5:29:00:00:01")["presets"] == {"stand": {"height": 1100}}
@@ -0,0 +1,55 @@
+import asyncio
+from integration import load
+
+height_history = load("height_history")
+
+
+def test_compactions_are_written_in_order(tmp_path):
+    path = str(tmp_path / "history.bin")
+
+    async def run():
+        history = height_history.HeightHistory(path, clock=lambda: 1700000000)
+        for index, height in enumerate([700, 800, 900, 1000]):
+            history.record(history.calibration.mm_to_raw(height), 0, now=1700000000 + index)
+            history.compact(1700000000 + index)
+        await history.async_flush()
+        return history
+
+    history = asyncio.run(run())
+    assert [height for _, height in height_history.read_history(path)] == [700, 800, 900, 1000]
+
+    restored = height_history.HeightHistory(path)
+    restored.load()
+    assert restored.restored_height == 1000
+    assert restored.days.keys() == history.days.keys()
+
+
+def test_standing_follows_the_calibration():
+    history = height_history.HeightHistory(clock=lambda: 1700000000)
+    history.standing_height = 950
+    history.record(history.calibration.mm_to_raw(1000), 0, now=1700000000)
+    history.calibration.update(offset=700)
+    history.standing_height = 950
+    history.record(history.calibration.mm_to_raw(900), 0, now=1700000010)
+
+    assert history.today(1700000020).standing == 10
+    assert history.last_height == 900
+
+
+def test_time_series_keeps_the_recent_days(tmp_path, monkeypatch):
+    monkeypatch.setattr(height_history, "HISTORY_MAX_SIZE", 100 * height_history.HISTORY_RECORD.size)
+    path = str(tmp_path / "history.bin")
+    start = 1700000000
+    history = height_history.HeightHistory(path, clock=lambda: start)
+    # One record every 6 hours for 30 days, without a running loop the file is written at once
+    for index in range(120):
+        now = start + index * 6 * 3600
+        history.record(history.calibration.mm_to_raw(700 + index % 2 * 400), 0, now=now)
+        history.compact(now)
+
+    records = list(height_history.read_history(path))
+    newest = start + 119 * 6 * 3600
+    assert records[-1] == (newest, 1100)
+    # The file is rewritten once the oldest record is a day past the retention window
+    assert records[0][0] >= newest - (height_history.HISTORY_DAYS + 1) * 86400
+    assert len(records) <= 100
@@ -0,0 +1,68 @@
+from integration import load
+
+motion_planner = load("motion_planner")
+const = load("const")
+
+STEP = 0.001
+
+
+class KinematicDesk:
+    """Desk that moves at a constant speed and brakes with a constant deceleration.
+    A notification arrives notify_latency after its measurement and a stop command
+    takes effect write_latency after it was sent, so the planner faces their sum as latency."""
+
+    def __init__(self, height=3000, max_speed=380, deceleration=800, notify_rate=16,
+                 notify_latency=0.1, write_latency=0.05):
+        self.height = float(height)
+        self.max_speed = max_speed
+        self.deceleration = deceleration
+        self.notify_interval = 1 / notify_rate
+        self.notify_latency = notify_latency
+        self.write_latency = write_latency
+
+    @property
+    def latency(self):
+        return self.notify_latency + self.write_latency
+
+    def move(self, planner, target):
+        """Drive to the target under control of the planner and return the final height"""
+        planner.start(target)
+        velocity = self.max_speed if target > self.height else -self.max_speed
+        now = 0.0
+        next_measurement = 0.0
+        braking_from = None
+        notifications = []
+        while True:
+            now += STEP
+            if braking_from is not None and now >= braking_from and velocity != 0:
+                change = min(abs(velocity), self.deceleration * STEP)
+                velocity -= change if velocity > 0 else -change
+                if velocity == 0:
+                    notifications.append((now + self.notify_latency, round(self.height), 0))
+            self.height += velocity * STEP
+            if velocity != 0 and now >= next_measurement:
+                next_measurement += self.notify_interval
+                notifications.append((now + self.notify_latency, round(self.height), round(velocity * 10)))
+            while notifications and notifications[0][0] <= now:
+                _, height, speed = notifications.pop(0)
+                if braking_from is None:
+                    if planner.update(height, speed, now) == motion_planner.ACTION_STOP:
+                        braking_from = now + self.write_latency
+                elif speed != 0:
+                    planner.settling(speed, now)
+                else:
+                    planner.finish(height)
+                    return height
+
+
+def test_latency_is_learned_from_the_stopping_distance():
+    desk = KinematicDesk()
+    planner = motion_planner.MotionPlanner()
+    # The default deceleration is far off, both values need a few moves to converge
+    for target in [4500, 2000, 5000, 2500, 4000, 1500, 4200, 2200, 4800, 3000] * 2:
+        final = desk.move(planner, target)
+
+    # The notification interval is 0.0625s, the planner has to see past it
+    assert abs(planner.latency - desk.latency) < 0.02
+    assert abs(planner.deceleration - desk.deceleration) < 80
+    assert abs(final - 3000) <= const.HEIGHT_TOLERANCE * 10
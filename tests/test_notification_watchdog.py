@@ -0,0 +1,50 @@
+import time
+import asyncio
+import struct
+from integration import load
+
+notification_watchdog = load("notification_watchdog")
+instrumentation = load("instrumentation")
+const = load("const")
+
+
+class StalledDesk:
+    """BLE controller side of the watchdog, the desk moves but sends no notifications"""
+
+    address = "F4:E5:29:00:00:01"
+    is_connected = True
+
+    def __init__(self):
+        self.is_moving = False
+        self.last_height_raw = 1000
+        self.reads = []
+
+    async def read_height_data(self):
+        self.reads.append(time.monotonic())
+        return struct.pack("<Hh", self.last_height_raw, 3000 if self.is_moving else 0)
+
+    def process_height_data(self, data):
+        self.last_height_raw, _ = struct.unpack("<Hh", data)
+
+    async def resubscribe(self):
+        return False
+
+
+def test_stall_during_move_is_polled_right_away():
+    async def run():
+        desk = StalledDesk()
+        watchdog = notification_watchdog.NotificationWatchdog(desk, instrumentation.Instrumentation("test"))
+        watchdog.start()
+        # The idle loop sleeps for the idle interval, starting a move has to wake it
+        await asyncio.sleep(0.05)
+        desk.is_moving = True
+        started = time.monotonic()
+        watchdog.move_started()
+        await asyncio.sleep(const.WATCHDOG_STALL_TIMEOUT + 0.3)
+        watchdog.stop()
+        return started, desk.reads, watchdog
+
+    started, reads, watchdog = asyncio.run(run())
+    assert watchdog.stalls == 1
+    assert reads
+    assert reads[0] - started <= const.WATCHDOG_STALL_TIMEOUT + 0.2
@@ -0,0 +1,27 @@
+import asyncio
+from integration import load
+
+reconnect = load("reconnect")
+
+
+def test_unexpected_error_does_not_end_reconnecting(monkeypatch):
+    monkeypatch.setattr(reconnect, "backoff_delay", lambda attempt: 0)
+    results = [RuntimeError("adapter gone"), False, True]
+
+    async def connect():
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def run():
+        supervisor = reconnect.ReconnectSupervisor(connect)
+        supervisor.trigger()
+        await supervisor._task
+        return supervisor
+
+    supervisor = asyncio.run(run())
+    assert supervisor.state == reconnect.STATE_CONNECTED
+    assert supervisor.attempts == 3
+    assert supervisor.errors == 1
+    assert supervisor.reconnects == 1